@@ -1,5 +1,8 @@
 import requests
 
+from twitch_bot.exceptions import CircuitOpenError
+from twitch_bot.outbound import outbound_service
+
 class LemonUsageUpdateError(Exception):
     pass
 
@@ -41,7 +44,10 @@ class Lemon():
             }
         }
 
-        r = requests.post(endpoint, json=payload, headers=self.headers)
+        try:
+            r = outbound_service("lemon").post(endpoint, json=payload, headers=self.headers)
+        except (requests.RequestException, CircuitOpenError) as e:
+            raise LemonUsageUpdateError from e
         if 200 > r.status_code or r.status_code >= 300:
             raise LemonUsageUpdateError
         return r.json()
@@ -52,7 +58,10 @@ class Lemon():
         )
         endpoint = self.base_url + path
 
-        r = requests.get(endpoint, headers=self.headers)
+        try:
+            r = outbound_service("lemon").get(endpoint, headers=self.headers)
+        except (requests.RequestException, CircuitOpenError) as e:
+            raise LemonUsageFetchError from e
         if 200 > r.status_code or r.status_code >= 300:
             raise LemonUsageFetchError
 
@@ -62,7 +71,10 @@ class Lemon():
         path = "/customers/{customer_id}".format(customer_id=customer_id)
         endpoint = self.base_url + path
 
-        r = requests.get(endpoint, headers=self.headers)
+        try:
+            r = outbound_service("lemon").get(endpoint, headers=self.headers)
+        except (requests.RequestException, CircuitOpenError) as e:
+            raise LemonCustomerFetchError from e
         if 200 > r.status_code or r.status_code >= 300:
             raise LemonCustomerFetchError
 
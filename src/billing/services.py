@@ -7,6 +7,7 @@ from django.conf import settings
 
 from main.models import SoundEffectRequest
 from main.constants import DONE_STATUS
+from main.broadcasters import broadcaster_routes
 from billing.constants import SubscriptionPlanOptions, LemonSubscriptionEvents, LEMON_WEBHOOK_SIGNATURE_HEADER, LEMON_WEBHOOK_EVENT_NAME_HEADER
 from .client import Lemon, LemonUsageUpdateError
 
@@ -41,12 +42,14 @@ class BillingService:
     def enable_user_subscription(user):
         user.billing_plan = SubscriptionPlanOptions.PAID_PLAN
         user.save()
+        broadcaster_routes.invalidate_user(user.id)
         return user
 
     @staticmethod
     def cancel_user_plan(user):
         user.billing_plan = SubscriptionPlanOptions.CANCELED_PLAN
         user.save()
+        broadcaster_routes.invalidate_user(user.id)
         return user
 
     @staticmethod
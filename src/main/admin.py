@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import AlertPreferences, CheerEventLogEntry, SoundEffectRequest
+from .models import AlertPreferences, CheerEventLogEntry, SoundEffectRequest, SfxGenerationJob, GeneratedAudio, PromptGenerationLease, SfxDeadLetter, StoredSfxFile
 
 
 
@@ -14,7 +14,8 @@ admin.site.register(AlertPreferences, AlertPreferencesAdmin)
 
 
 class CheerLogAdmin(admin.ModelAdmin):
-    list_display = ["broadcaster_user_name", "user_name", "bits", "status"]
+    list_display = ["broadcaster_user_name", "user_name", "bits", "status", "shed_stage"]
+    list_filter = ["status", "shed_stage"]
 
 admin.site.register(CheerEventLogEntry, CheerLogAdmin)
 
@@ -30,4 +31,38 @@ class SoundEffectRequestAdmin(admin.ModelAdmin):
     has_recorded_usage.boolean = True
 
 
-admin.site.register(SoundEffectRequest, SoundEffectRequestAdmin)
\ No newline at end of file
+admin.site.register(SoundEffectRequest, SoundEffectRequestAdmin)
+
+
+class SfxGenerationJobAdmin(admin.ModelAdmin):
+    list_display = ["created", "cheer_event_log", "status", "attempts", "locked_by"]
+    list_filter = ["status"]
+
+admin.site.register(SfxGenerationJob, SfxGenerationJobAdmin)
+
+
+class GeneratedAudioAdmin(admin.ModelAdmin):
+    list_display = ["canonical_prompt", "hits", "size", "last_used_at"]
+    search_fields = ["canonical_prompt"]
+
+admin.site.register(GeneratedAudio, GeneratedAudioAdmin)
+
+class StoredSfxFileAdmin(admin.ModelAdmin):
+    list_display = ["name", "references", "size", "tier", "last_referenced_at"]
+    list_filter = ["tier"]
+    search_fields = ["name"]
+
+admin.site.register(StoredSfxFile, StoredSfxFileAdmin)
+
+class PromptGenerationLeaseAdmin(admin.ModelAdmin):
+    list_display = ["prompt_key", "owner", "expires_at"]
+
+admin.site.register(PromptGenerationLease, PromptGenerationLeaseAdmin)
+
+
+class SfxDeadLetterAdmin(admin.ModelAdmin):
+    list_display = ["created", "cheer_event_log", "failure_class", "attempts", "replayed_at"]
+    list_filter = ["failure_class"]
+    search_fields = ["reason"]
+
+admin.site.register(SfxDeadLetter, SfxDeadLetterAdmin)
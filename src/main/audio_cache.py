@@ -0,0 +1,115 @@
+import logging
+
+from django.db import IntegrityError
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import GeneratedAudio
+from .retention import StoredSfxFiles
+from .similarity import generated_audio_index, minhash_signature, pack_signature
+
+logger = logging.getLogger('django')
+
+
+class GeneratedAudioCache:
+    """Reuses stored sound effects for prompts that were already generated with the same parameters."""
+
+    @staticmethod
+    def _touch(cached):
+        GeneratedAudio.objects.filter(id=cached.id).update(
+            hits=F("hits") + 1,
+            last_used_at=timezone.now()
+        )
+        return cached
+
+    @staticmethod
+    def lookup(prompt_key):
+        cached = GeneratedAudio.objects.filter(prompt_key=prompt_key).first()
+        if cached is None:
+            return None
+        return GeneratedAudioCache._touch(cached)
+
+    @staticmethod
+    def lookup_similar(canonical_prompt, duration_seconds, prompt_influence):
+        """Finds a cached clip, generated with the same parameters, whose prompt is a near duplicate of this one."""
+        match = generated_audio_index.find_similar(canonical_prompt)
+        if match is None:
+            return None
+
+        entry_id, similarity = match
+        cached = GeneratedAudio.objects.filter(id=entry_id).first()
+        if cached is None:
+            # evicted since the index was loaded
+            generated_audio_index.discard(entry_id)
+            return None
+        if cached.duration_seconds != duration_seconds or cached.prompt_influence != prompt_influence:
+            return None
+
+        logger.info(
+            "Audio cache: reusing \"{cached}\" for \"{prompt}\" (similarity {similarity:.2f}).".format(
+                cached=cached.canonical_prompt,
+                prompt=canonical_prompt,
+                similarity=similarity
+            )
+        )
+        return GeneratedAudioCache._touch(cached)
+
+    @staticmethod
+    def store(prompt_key, canonical_prompt, duration_seconds, prompt_influence, stored_file):
+        try:
+            size = stored_file.size
+        except Exception:
+            size = 0
+
+        signature = minhash_signature(canonical_prompt)
+        try:
+            cached = GeneratedAudio.objects.create(
+                prompt_key=prompt_key,
+                canonical_prompt=canonical_prompt,
+                duration_seconds=duration_seconds,
+                prompt_influence=prompt_influence,
+                file=stored_file.name,
+                size=size,
+                minhash=pack_signature(signature) if signature else None
+            )
+        except IntegrityError:
+            # another worker cached the same prompt first, keep theirs
+            return GeneratedAudio.objects.filter(prompt_key=prompt_key).first()
+
+        StoredSfxFiles.acquire(cached.file.name, size)
+        if signature:
+            generated_audio_index.add(cached.id, signature)
+        return cached
+
+    @staticmethod
+    def _evict_entry(entry):
+        generated_audio_index.discard(entry.id)
+        entry.delete()
+        # the file may still back sound effect requests, manage.py gc_sfx_storage deletes it once nothing does
+        StoredSfxFiles.release(entry.file.name)
+
+    @staticmethod
+    def evict(max_entries=None, max_bytes=None):
+        """Drops least recently used entries until the cache fits both limits. Returns the evicted count."""
+        evicted = 0
+        entries = GeneratedAudio.objects.order_by("last_used_at")
+
+        if max_entries is not None:
+            overflow = entries.count() - max_entries
+            if overflow > 0:
+                for entry in entries[:overflow]:
+                    GeneratedAudioCache._evict_entry(entry)
+                    evicted += 1
+
+        if max_bytes is not None:
+            total_bytes = entries.aggregate(total=Sum("size"))["total"] or 0
+            for entry in entries.iterator():
+                if total_bytes <= max_bytes:
+                    break
+                GeneratedAudioCache._evict_entry(entry)
+                total_bytes -= entry.size
+                evicted += 1
+
+        if evicted:
+            logger.info("Audio cache: evicted {n} entries.".format(n=evicted))
+        return evicted
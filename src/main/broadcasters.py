@@ -0,0 +1,150 @@
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from django.conf import settings
+from allauth.socialaccount.models import SocialAccount
+
+from twitch_bot.metrics import metrics
+from .matching import CheerMatcher, parse_command_prefixes
+
+
+@dataclass(frozen=True)
+class BroadcasterRoute:
+    """Everything the webhook path needs to know about a broadcaster, detached from the ORM."""
+    twitch_uid: str
+    user_id: object
+    billing_plan: str
+    match_command: bool
+    command_string: str
+    auto_generate: bool
+    auto_play: bool
+    match_bits: bool
+    min_bits: int
+    max_bits: int
+    command_ignore_case: bool
+    latency_budget_ms: int
+    late_clip_policy: str
+    stale_cheer_policy: str
+    overlay_offline_policy: str
+    matcher: CheerMatcher
+
+
+ROUTE_FIELDS = {
+    "user_id": "user_id",
+    "billing_plan": "user__billing_plan",
+    "match_command": "user__alertpreferences__match_command",
+    "command_string": "user__alertpreferences__command_string",
+    "auto_generate": "user__alertpreferences__auto_generate",
+    "auto_play": "user__alertpreferences__auto_play",
+    "match_bits": "user__alertpreferences__match_bits",
+    "min_bits": "user__alertpreferences__min_bits",
+    "max_bits": "user__alertpreferences__max_bits",
+    "command_ignore_case": "user__alertpreferences__command_ignore_case",
+    "latency_budget_ms": "user__alertpreferences__latency_budget_ms",
+    "late_clip_policy": "user__alertpreferences__late_clip_policy",
+    "stale_cheer_policy": "user__alertpreferences__stale_cheer_policy",
+    "overlay_offline_policy": "user__alertpreferences__overlay_offline_policy",
+}
+
+
+class BroadcasterRoutingCache:
+    """
+    Per-process LRU of twitch uid -> BroadcasterRoute.
+
+    Misses are loaded in bulk with a single query. Unknown uids are cached as
+    None too, so a stale eventsub can't make every event hit the database.
+    Entries are invalidated explicitly when preferences, plans or accounts
+    change in this process, the TTL bounds how stale other processes can get.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, twitch_uids):
+        rows = SocialAccount.objects.filter(
+            provider="twitch",
+            uid__in=twitch_uids
+        ).values("uid", *ROUTE_FIELDS.values())
+
+        routes = {uid: None for uid in twitch_uids}
+        for row in rows:
+            # accounts without preferences are not set up to receive alerts yet
+            if row["user__alertpreferences__min_bits"] is None:
+                continue
+            fields = {field: row[lookup] for field, lookup in ROUTE_FIELDS.items()}
+            routes[row["uid"]] = BroadcasterRoute(
+                twitch_uid=row["uid"],
+                matcher=CheerMatcher(
+                    min_bits=fields["min_bits"],
+                    max_bits=fields["max_bits"],
+                    exact_bits=fields["match_bits"],
+                    command_prefixes=parse_command_prefixes(fields["command_string"]) if fields["match_command"] else (),
+                    ignore_case=fields["command_ignore_case"]
+                ),
+                **fields
+            )
+        return routes
+
+    def get_many(self, twitch_uids):
+        now = time.monotonic()
+        found = {}
+        missing = []
+        with self._lock:
+            for uid in twitch_uids:
+                entry = self._entries.get(uid)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(uid)
+                    found[uid] = entry[1]
+                else:
+                    missing.append(uid)
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        if missing:
+            loaded = self._load(missing)
+            with self._lock:
+                for uid, route in loaded.items():
+                    self._entries[uid] = (now + self.ttl, route)
+                    self._entries.move_to_end(uid)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            found.update(loaded)
+
+        return found
+
+    def get(self, twitch_uid):
+        return self.get_many([twitch_uid])[twitch_uid]
+
+    def invalidate_uid(self, twitch_uid):
+        with self._lock:
+            self._entries.pop(str(twitch_uid), None)
+
+    def invalidate_user(self, user_id):
+        twitch_uids = SocialAccount.objects.filter(
+            provider="twitch",
+            user_id=user_id
+        ).values_list("uid", flat=True)
+        for uid in twitch_uids:
+            self.invalidate_uid(uid)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
+
+
+broadcaster_routes = BroadcasterRoutingCache(
+    max_size=settings.BROADCASTER_ROUTE_CACHE_SIZE,
+    ttl=settings.BROADCASTER_ROUTE_CACHE_TTL
+)
+metrics.register_collector("broadcaster_routes", broadcaster_routes.stats)
@@ -1,3 +1,6 @@
+SFX_DURATION_SECONDS = 4
+SFX_PROMPT_INFLUENCE = 0.3
+
 TWITCH_SUB_EXTERNAL_REFERENCE = "channel.subscription.message"
 TWITCH_CHEER_EXTERNAL_REFERENCE = "channel.cheer"
 
@@ -13,6 +16,7 @@ NEW_STATUS = "N"
 FAILED_STATUS = "E"
 DONE_STATUS = "D"
 IGNORED_STATUS = "I"
+SHED_STATUS = "S"
 
 
 SOUND_EFFECT_REQUEST_STATUS_OPTIONS = [
@@ -26,4 +30,79 @@ CHEER_EVENT_LOG_STATUS_OPTIONS = [
     [IGNORED_STATUS, "Ignored / Didn't match preferences"],
     [FAILED_STATUS, "Failed"],
     [DONE_STATUS, "Done"],
-]
\ No newline at end of file
+    [SHED_STATUS, "Shed / Too old to play"],
+]
+
+QUEUED_STATUS = "Q"
+RUNNING_STATUS = "R"
+
+SFX_JOB_STATUS_OPTIONS = [
+    [QUEUED_STATUS, "Queued"],
+    [RUNNING_STATUS, "Running"],
+    [FAILED_STATUS, "Failed"],
+    [DONE_STATUS, "Done"],
+]
+
+TRANSIENT_FAILURE = "transient"
+RATE_LIMITED_FAILURE = "rate_limited"
+PERMANENT_FAILURE = "permanent"
+LEASE_EXPIRED_FAILURE = "lease_expired"
+INTERNAL_FAILURE = "internal"
+SFX_FAILURE_CLASS_OPTIONS = [
+    [TRANSIENT_FAILURE, "Transient (network, storage, provider errors)"],
+    [RATE_LIMITED_FAILURE, "Rate limited by the provider"],
+    [PERMANENT_FAILURE, "Rejected by the provider"],
+    [LEASE_EXPIRED_FAILURE, "Worker lost the job"],
+    [INTERNAL_FAILURE, "Internal error"],
+]
+
+# where a cheer past its deadline was shed, see main.deadlines
+SHED_AT_INGEST = "ingest"
+SHED_AT_QUEUE = "queue"
+SHED_AT_GENERATION = "generation"
+SHED_AT_DELIVERY = "delivery"
+SHED_STAGE_OPTIONS = [
+    [SHED_AT_INGEST, "Before it was queued"],
+    [SHED_AT_QUEUE, "When a worker picked it up"],
+    [SHED_AT_GENERATION, "Before calling elevenlabs"],
+    [SHED_AT_DELIVERY, "Before sending it to the overlay"],
+]
+
+STALE_CHEER_GENERATE = "G"
+STALE_CHEER_SKIP = "K"
+STALE_CHEER_POLICY_OPTIONS = [
+    [STALE_CHEER_GENERATE, "Generate it without playing it"],
+    [STALE_CHEER_SKIP, "Skip it"],
+]
+
+# where a stored sfx file lives, see main.retention
+STORAGE_TIER_HOT = "H"
+STORAGE_TIER_ARCHIVE = "A"
+STORAGE_TIER_OPTIONS = [
+    [STORAGE_TIER_HOT, "Hot"],
+    [STORAGE_TIER_ARCHIVE, "Archived"],
+]
+
+OVERLAY_OFFLINE_GENERATE = "G"
+OVERLAY_OFFLINE_DEFER = "D"
+OVERLAY_OFFLINE_POLICY_OPTIONS = [
+    [OVERLAY_OFFLINE_GENERATE, "Generate them right away"],
+    [OVERLAY_OFFLINE_DEFER, "Wait until the overlay is open"],
+]
+
+LATE_CLIP_PLAY = "P"
+LATE_CLIP_SAVE = "S"
+LATE_CLIP_POLICY_OPTIONS = [
+    [LATE_CLIP_PLAY, "Play it when it is ready"],
+    [LATE_CLIP_SAVE, "Only save it to the dashboard"],
+]
+
+# stock clips played when a generation misses the broadcaster's latency budget,
+# picked by keyword match against the prompt (static file path, keywords)
+FALLBACK_SOUND_BANK = [
+    ("sfx_demo/car_horns_in_traffic.mp3", ("car", "horn", "horns", "honk", "airhorn", "traffic", "beep", "truck")),
+    ("sfx_demo/cartoon_falling_soun.mp3", ("cartoon", "fall", "falling", "fail", "slip", "whistle", "drop", "bonk")),
+    ("sfx_demo/oonga_boonga.mp3", ("monkey", "ape", "caveman", "jungle", "drum", "drums", "tribal", "oonga", "boonga")),
+    ("sfx_demo/suspense_build_up_en.mp3", ("suspense", "tension", "build", "dramatic", "scary", "horror", "mystery")),
+]
+FALLBACK_DEFAULT_CLIP = "sfx_demo/suspense_build_up_en.mp3"
@@ -1,24 +1,157 @@
-from django.template.loader import get_template
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+import json
+import time
+import asyncio
+from collections import deque
+from urllib.parse import parse_qs
 
-class CheerEventConsumer(WebsocketConsumer):
+from django.conf import settings
+from django.template.loader import render_to_string
+from asgiref.sync import sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+
+from twitch_bot.metrics import metrics
+from .playback import ACK_STARTED, ACK_FINISHED, ACK_FAILED, PlaybackQueue
+from .replay import overlay_events
+from .presence import overlay_presence
+from .services import SoundEffectRequestService
+
+# overlays connect with ?protocol=1 and get {"v": 1, "events": [...]} frames,
+# see templates/overlay/main.html for the client
+OVERLAY_PROTOCOL_VERSION = 1
+# seconds a fast path clip must still be fetchable for when it is sent, see main.fastclips
+FAST_CLIP_MARGIN = 10
+
+class CheerEventConsumer(AsyncWebsocketConsumer):
     
-    def connect(self):
+    async def connect(self):
         self.room_name = self.scope["url_route"]["kwargs"]["user_id"]
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        # overlays opened before the json protocol get html fragments, one clip at a time
+        self.protocol = query.get("protocol", [None])[0]
+        self.playback = PlaybackQueue(
+            self.send_clips,
+            window=1 + settings.OVERLAY_SEND_AHEAD if self.protocol else 1,
+            max_length=settings.OVERLAY_QUEUE_MAX_LENGTH,
+            max_wait=settings.OVERLAY_QUEUE_MAX_WAIT,
+            start_timeout=settings.OVERLAY_ACK_START_TIMEOUT,
+            finish_timeout=settings.OVERLAY_ACK_FINISH_TIMEOUT
+        )
+        # an event can both be replayed and arrive from the group right after connecting
+        self.received_seqs = deque(maxlen=settings.OVERLAY_REPLAY_SIZE)
+        self.resumed = False
         
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.room_name, self.channel_name
         )
         
-        self.accept()
+        await self.accept()
+        await sync_to_async(overlay_presence.add, thread_sensitive=False)(self.room_name, self.channel_name)
+        self.heartbeat = asyncio.create_task(self.keep_present())
 
-    def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)(
+    async def disconnect(self, close_code):
+        self.playback.close()
+        self.heartbeat.cancel()
+        await sync_to_async(overlay_presence.remove, thread_sensitive=False)(self.room_name, self.channel_name)
+        await self.channel_layer.group_discard(
             self.room_name, self.channel_name
         )
 
-    def play_sfx(self, event):
-        template_name = "overlay/partials/sfx_player.html"
-        html = get_template(template_name).render(event)
-        self.send(text_data=html)
\ No newline at end of file
+    async def keep_present(self):
+        # the socket is dropped from the presence set unless refreshed, see main.presence
+        while True:
+            await asyncio.sleep(settings.OVERLAY_HEARTBEAT_INTERVAL)
+            await sync_to_async(overlay_presence.add, thread_sensitive=False)(self.room_name, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # {"resume": last_seq} once connected, then playback acks:
+        # {"ack": "started" | "finished" | "failed", "clip": clip_id}
+        try:
+            message = json.loads(text_data or "")
+        except ValueError:
+            return
+        if not isinstance(message, dict):
+            return
+        if "ack" in message:
+            clip_id = message.get("clip")
+            # clip ids are dict keys in the queue, an unhashable one would crash the consumer
+            if isinstance(clip_id, str) and message["ack"] in (ACK_STARTED, ACK_FINISHED, ACK_FAILED):
+                await self.playback.ack(clip_id, message["ack"])
+        elif "resume" in message:
+            await self.resume(message["resume"])
+
+    async def resume(self, last_seq):
+        """Plays the events the overlay missed while it was disconnected, see main.replay."""
+        if self.resumed or not isinstance(last_seq, int):
+            return
+        self.resumed = True
+        missed = await sync_to_async(overlay_events.since, thread_sensitive=False)(self.room_name, last_seq)
+        missed = [event for event in missed if self.is_new(event)]
+        if missed:
+            # the log keeps the fast path url as it was sent, the stored file outlives it
+            missed = await self.with_stored_urls(missed, replayed=True)
+            # queued together, they go out in one frame
+            await self.playback.enqueue_many(missed)
+            metrics.incr("overlay.replay.replayed", value=len(missed))
+
+    def is_new(self, event):
+        seq = event.get("seq")
+        if seq is None:
+            return True
+        if seq in self.received_seqs:
+            return False
+        self.received_seqs.append(seq)
+        return True
+
+    async def play_sfx(self, event):
+        if self.is_new(event):
+            # played after the clips before it, see main.playback
+            await self.playback.enqueue(event)
+
+    async def with_stored_urls(self, events, replayed=False):
+        """
+        Points fast path clips at their stored file once the short lived copy
+        is about to expire, they may have waited in the playback queue for
+        longer than it lives. Replayed clips always get the stored file. A clip
+        still uploading keeps its copy.
+        """
+        expires_before = time.time() + FAST_CLIP_MARGIN
+        stale = {
+            event["clip_id"] for event in events
+            if event.get("fast_until") and (replayed or event["fast_until"] < expires_before)
+        }
+        if not stale:
+            return events
+
+        urls = await sync_to_async(SoundEffectRequestService.stored_clip_urls, thread_sensitive=False)(
+            [event["cheer"] for event in events if event["clip_id"] in stale]
+        )
+        resolved = []
+        for event in events:
+            url = urls.get(event.get("cheer")) if event["clip_id"] in stale else None
+            if url is None:
+                resolved.append(event)
+                continue
+            resolved.append({**event, "fast_until": None, "message": {**event["message"], "url": url}})
+            metrics.incr("overlay.fast_path.resolved")
+        return resolved
+
+    async def send_clips(self, events):
+        events = await self.with_stored_urls(events)
+        if self.protocol:
+            # built once per event in SoundEffectRequestService._send_event_to_consumers
+            await self.send(text_data=json.dumps(
+                {"v": OVERLAY_PROTOCOL_VERSION, "events": [event["message"] for event in events]},
+                separators=(",", ":")
+            ))
+            return
+
+        for event in events:
+            message = event["message"]
+            await self.send(text_data=render_to_string("overlay/partials/sfx_player.html", {
+                "seq": message["seq"],
+                "clip_id": message["clip"],
+                "sfx_source": message["url"],
+                "username": message["user"],
+                "prompt": message["prompt"],
+                "bits": message["bits"]
+            }))
@@ -0,0 +1,42 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from twitch_bot.metrics import metrics
+from .models import CheerEventLogEntry
+from .constants import SHED_STATUS
+
+
+def cheer_deadline(message_timestamp):
+    """Latest time the cheer may still play on the overlay, None when Twitch sent no timestamp."""
+    if message_timestamp is None:
+        return None
+    return message_timestamp + timedelta(seconds=settings.SFX_CHEER_DEADLINE_SECONDS)
+
+
+def is_expired(cheer_event_log, now=None):
+    deadline = cheer_event_log.deadline
+    return deadline is not None and (now or timezone.now()) >= deadline
+
+
+def record_shed(cheer_event_log, stage, skipped=False):
+    """
+    Records that the cheer went past its deadline at `stage`. Skipped cheers get the
+    shed status, the others are generated without playing and keep their status.
+    Only the first stage is recorded, returns False when the cheer was already shed.
+    """
+    fields = {"shed_stage": stage}
+    if skipped:
+        fields["status"] = SHED_STATUS
+    updated = CheerEventLogEntry.objects.filter(
+        id=cheer_event_log.id,
+        shed_stage=""
+    ).update(**fields)
+    if not updated:
+        return False
+
+    for field, value in fields.items():
+        setattr(cheer_event_log, field, value)
+    metrics.incr("sfx.deadline.shed", stage=stage, outcome="skipped" if skipped else "not_played")
+    return True
@@ -0,0 +1,88 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger('django')
+
+
+class MessageDedupCache:
+    """
+    Bounded TTL/LRU set of Twitch message ids that were already accepted.
+
+    Lookups hit the per-process cache first. When a redis url is configured the
+    ids are also claimed with SET NX so every process shares the same window.
+    The database unique index on CheerEventLogEntry.twitch_message_id stays the
+    last line of defense for anything that falls out of the cache.
+    """
+
+    def __init__(self, max_size, ttl, redis_url=None, key_prefix="twitch:msg:"):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = None
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(
+                redis_url,
+                socket_timeout=0.5,
+                socket_connect_timeout=0.5
+            )
+
+    def _seen_locally(self, message_id, now):
+        """Checks and marks the id in the local cache. Returns True if it was already there."""
+        with self._lock:
+            expires_at = self._entries.get(message_id)
+            if expires_at is not None and expires_at > now:
+                self._entries.move_to_end(message_id)
+                return True
+
+            self._entries[message_id] = now + self.ttl
+            self._entries.move_to_end(message_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return False
+
+    def _seen_in_redis(self, message_id):
+        try:
+            created = self._redis.set(self.key_prefix + message_id, 1, nx=True, ex=self.ttl)
+        except Exception:
+            logger.warning("Twitch dedup: redis unavailable, falling back to the local cache.")
+            return False
+        return not created
+
+    def seen(self, message_id):
+        if self._seen_locally(message_id, time.monotonic()):
+            return True
+        if self._redis is not None:
+            return self._seen_in_redis(message_id)
+        return False
+
+    async def aseen(self, message_id):
+        if self._seen_locally(message_id, time.monotonic()):
+            return True
+        if self._redis is not None:
+            return await sync_to_async(self._seen_in_redis, thread_sensitive=False)(message_id)
+        return False
+
+    def forget(self, message_id):
+        """Drops an id that was marked but could not be accepted, so its retry goes through."""
+        with self._lock:
+            self._entries.pop(message_id, None)
+        if self._redis is not None:
+            try:
+                self._redis.delete(self.key_prefix + message_id)
+            except Exception:
+                logger.warning("Twitch dedup: redis unavailable, could not forget message id.")
+
+
+message_dedup_cache = MessageDedupCache(
+    max_size=settings.TWITCH_DEDUP_CACHE_SIZE,
+    ttl=settings.TWITCH_MESSAGE_MAX_AGE,
+    redis_url=settings.REDIS_URL if settings.TWITCH_DEDUP_USE_REDIS else None
+)
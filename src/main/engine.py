@@ -0,0 +1,460 @@
+import os
+import socket
+import asyncio
+import logging
+import threading
+from collections import Counter
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.base import File
+from django.db import close_old_connections
+from django.utils import timezone
+
+from twitch_bot.client import elevenlabs_astream_sfx
+from twitch_bot.exceptions import ElevenLabsApiError, ElevenLabsRateLimited
+from twitch_bot.metrics import metrics
+from .broadcasters import broadcaster_routes
+from .constants import (
+    DONE_STATUS,
+    LATE_CLIP_PLAY,
+    SHED_AT_QUEUE,
+    SHED_AT_GENERATION,
+    STALE_CHEER_SKIP,
+    SFX_DURATION_SECONDS,
+    SFX_PROMPT_INFLUENCE,
+)
+from .deadlines import is_expired, record_shed
+from .fallbacks import fallback_clip_url
+from .services import SoundEffectRequestService
+from .singleflight import prompt_leases
+from .streaming import ChunkPipe
+
+logger = logging.getLogger('django')
+
+
+def run_in_db_thread(func):
+    """
+    Wraps a blocking ORM function for the engine. It runs in the loop's default
+    executor, so db work is bounded by that pool and not by the in-flight calls.
+    """
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        return func(*args, **kwargs)
+    return sync_to_async(wrapper, thread_sensitive=False)
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = None
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self.updated_at is not None:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def follower_error(error):
+    """
+    A copy of the leader's exception for a single flight follower. Raising the
+    same instance from every waiter would pile all their tracebacks onto it.
+    """
+    copied = error.__class__.__new__(error.__class__, *error.args)
+    copied.__dict__.update(error.__dict__)
+    return copied
+
+
+class Delivery:
+    """
+    Decides what reaches the overlay for one cheer: the generated clip, or a
+    fallback clip once the latency budget ran out. Whichever claims first wins,
+    the clip is claimed from a db thread right before it is sent.
+    With `skip_expired` the generation itself is dropped once the cheer is past its deadline.
+    """
+
+    def __init__(self, send_to_consumers, skip_expired=False):
+        self.send_to_consumers = send_to_consumers
+        self.skip_expired = skip_expired
+        self.clip_sent = False
+        self.fallback_sent = False
+        self._lock = threading.Lock()
+
+    def claim_clip(self):
+        with self._lock:
+            if self.clip_sent:
+                # already played from the fast path, see SoundEffectRequestService._send_fast_clip
+                return False
+            self.clip_sent = self.send_to_consumers
+            return self.clip_sent
+
+    def claim_fallback(self, play_late_clip):
+        with self._lock:
+            if self.clip_sent or not self.send_to_consumers:
+                return False
+            self.fallback_sent = True
+            self.send_to_consumers = play_late_clip
+            return True
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    AIMD window on concurrent ElevenLabs calls. Every success grows the window
+    by about one call per window's worth of successes, a rate limit halves it.
+    Only calls started after the last decrease can shrink it again, so a burst
+    of 429s from one window counts once. A Retry-After pauses new calls.
+    """
+
+    def __init__(self, initial, minimum, maximum, decrease_factor=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self.last_decrease_at = float("-inf")
+        self._changed = asyncio.Condition()
+
+    async def acquire(self):
+        """Waits for a free call slot and returns the loop time the call starts at."""
+        loop = asyncio.get_running_loop()
+        async with self._changed:
+            while True:
+                pause = self.resume_at - loop.time()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(self._changed.wait(), timeout=pause)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return loop.time()
+                await self._changed.wait()
+
+    async def release(self, started_at, succeeded=True, rate_limited=False, retry_after=None):
+        loop = asyncio.get_running_loop()
+        async with self._changed:
+            self.in_flight -= 1
+            if succeeded:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif rate_limited:
+                if started_at >= self.last_decrease_at:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self.last_decrease_at = loop.time()
+                    logger.warning("Sound Effect Generation: elevenlabs is rate limiting, window down to {n}.".format(
+                        n=int(self.limit)
+                    ))
+                if retry_after:
+                    self.resume_at = max(self.resume_at, loop.time() + retry_after)
+            metrics.set_gauge("sfx.engine.concurrency_limit", self.limit)
+            self._changed.notify_all()
+
+
+class GenerationEngine:
+    """
+    Runs sound effect generations as coroutines on one event loop. ElevenLabs
+    calls share a pooled httpx.AsyncClient, so hundreds of in-flight generations
+    cost sockets and coroutines rather than threads.
+
+    Concurrency is capped globally and per broadcaster, and calls are paced by a
+    token bucket matched to the ElevenLabs plan.
+
+    Identical prompts are generated once (single flight): the first cheer holds
+    the prompt lease and the others wait for its audio, in this process on the
+    leader's future, across processes by polling the lease and the audio cache.
+    Each waiter still gets its own SoundEffectRequest pointing at the shared file.
+
+    On top of the caps, concurrent ElevenLabs calls follow an AIMD window driven
+    by 429/503 answers.
+
+    The audio is streamed: chunks go to storage from a db thread while the rest
+    is still downloading, through a small bounded buffer, so memory per job
+    stays flat however many generations are in flight. With SFX_FAST_PATH the
+    overlay plays a short lived copy of the clip as soon as the download ends,
+    while the upload to storage finishes.
+
+    ElevenLabs and storage errors are raised to the caller, the worker decides
+    from their failure class whether the job is retried or dead lettered.
+
+    Broadcasters with a latency budget get a stock clip from the fallback bank
+    when their sound isn't ready in time, the real one is then played late or
+    only saved, following their late clip policy.
+
+    Cheers past their deadline (see main.deadlines) are shed when a worker picks
+    them up and again right before the ElevenLabs call: following the stale cheer
+    policy they are generated without playing, or skipped and generate returns None.
+    """
+
+    def __init__(self, max_in_flight, max_per_broadcaster, requests_per_second, burst,
+                 initial_call_window=None, owner=None):
+        self.owner = owner or "{host}:{pid}".format(host=socket.gethostname(), pid=os.getpid())
+        self.max_in_flight = max_in_flight
+        self.max_per_broadcaster = max_per_broadcaster
+        self.rate_limiter = TokenBucket(requests_per_second, burst)
+        self.call_window = AdaptiveConcurrencyLimit(
+            initial=initial_call_window or max_in_flight,
+            minimum=1,
+            maximum=max_in_flight
+        )
+        self.in_flight = Counter()
+        self._global_slots = asyncio.Semaphore(max_in_flight)
+        self._broadcaster_slots = {}
+        self._flights = {}
+        self.client = None
+
+    @classmethod
+    def from_settings(cls, **overrides):
+        options = {
+            "max_in_flight": settings.SFX_ENGINE_MAX_IN_FLIGHT,
+            "max_per_broadcaster": settings.SFX_ENGINE_MAX_PER_BROADCASTER,
+            "requests_per_second": settings.ELEVENLABS_REQUESTS_PER_SECOND,
+            "burst": settings.ELEVENLABS_REQUESTS_BURST,
+            "initial_call_window": settings.ELEVENLABS_INITIAL_CONCURRENCY,
+        }
+        options.update(overrides)
+        return cls(**options)
+
+    async def __aenter__(self):
+        http_settings = settings.OUTBOUND_HTTP["elevenlabs"]
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                http_settings["read_timeout"],
+                connect=http_settings["connect_timeout"]
+            ),
+            limits=httpx.Limits(
+                max_connections=self.max_in_flight,
+                max_keepalive_connections=self.max_in_flight
+            )
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+        self.client = None
+
+    def _broadcaster_slot(self, user_id):
+        slot = self._broadcaster_slots.get(user_id)
+        if slot is None:
+            slot = self._broadcaster_slots[user_id] = asyncio.Semaphore(self.max_per_broadcaster)
+        return slot
+
+    async def generate(self, user, cheer_event_log, send_to_consumers=True):
+        """Generates the cheer's sound effect, bounded by the engine limits."""
+        route = None
+        if send_to_consumers:
+            route = await run_in_db_thread(broadcaster_routes.get)(cheer_event_log.broadcaster_user_id)
+        skip_expired = route is not None and route.stale_cheer_policy == STALE_CHEER_SKIP
+        if send_to_consumers and is_expired(cheer_event_log):
+            await run_in_db_thread(record_shed)(cheer_event_log, SHED_AT_QUEUE, skipped=skip_expired)
+            if skip_expired:
+                return None
+            send_to_consumers = False
+            route = None
+
+        delivery = Delivery(send_to_consumers, skip_expired=skip_expired)
+        if route is None or route.latency_budget_ms is None:
+            return await self._generate_bounded(user, cheer_event_log, delivery)
+
+        generation = asyncio.ensure_future(self._generate_bounded(user, cheer_event_log, delivery))
+        elapsed = (timezone.now() - cheer_event_log.timestamp).total_seconds()
+        done, _ = await asyncio.wait({generation}, timeout=max(route.latency_budget_ms / 1000 - elapsed, 0))
+        if not done and delivery.claim_fallback(play_late_clip=route.late_clip_policy == LATE_CLIP_PLAY):
+            metrics.incr("sfx.latency_budget.fallbacks")
+            await run_in_db_thread(SoundEffectRequestService._send_event_to_consumers)(
+                fallback_clip_url(cheer_event_log.message),
+                str(user.id),
+                cheer_event_log
+            )
+        return await generation
+
+    async def _generate_bounded(self, user, cheer_event_log, delivery):
+        user_id = user.id
+        self.in_flight[user_id] += 1
+        metrics.set_gauge("sfx.engine.in_flight", sum(self.in_flight.values()))
+        try:
+            # broadcaster slot first, so a channel over its cap never holds global slots
+            async with self._broadcaster_slot(user_id), self._global_slots:
+                return await self._generate(user, cheer_event_log, delivery)
+        finally:
+            self.in_flight[user_id] -= 1
+            if not self.in_flight[user_id]:
+                del self.in_flight[user_id]
+                del self._broadcaster_slots[user_id]
+            metrics.set_gauge("sfx.engine.in_flight", sum(self.in_flight.values()))
+
+    async def _generate(self, user, cheer_event_log, delivery):
+        sfx_request, canonical_prompt, prompt_key = await run_in_db_thread(
+            SoundEffectRequestService._prepare_generation
+        )(user, cheer_event_log, delivery.claim_clip)
+        if sfx_request is not None:
+            return sfx_request
+        if not prompt_key:
+            # the broadcaster opted out of reusing audio
+            return await self._call_elevenlabs(user, cheer_event_log, delivery, canonical_prompt, prompt_key)
+
+        while prompt_key in self._flights:
+            metrics.incr("sfx.singleflight.coalesced")
+            outcome = await asyncio.shield(self._flights[prompt_key])
+            if isinstance(outcome, Exception):
+                # the leader's failure is ours as well, the worker retries or dead letters us the same way
+                raise follower_error(outcome) from outcome
+            if outcome is False:
+                return await run_in_db_thread(SoundEffectRequestService._fail_sfx_request)(
+                    cheer_event_log,
+                    "Failed trying to generate sfx."
+                )
+            if outcome:
+                sfx_request = await run_in_db_thread(SoundEffectRequestService._reuse_generated_audio)(
+                    user, cheer_event_log, delivery.claim_clip, prompt_key
+                )
+                if sfx_request is not None:
+                    return sfx_request
+            # evicted in the meantime, or the leader was cancelled or its cheer shed: the first
+            # follower back leads a new flight and the others wait on that one
+
+        flight = self._flights[prompt_key] = asyncio.get_running_loop().create_future()
+        # True, False, the exception the followers fail with as well, or None when nothing
+        # was generated, the leader being cancelled included
+        outcome = None
+        try:
+            sfx_request = await self._generate_with_lease(
+                user, cheer_event_log, delivery, canonical_prompt, prompt_key
+            )
+            outcome = None if sfx_request is None else sfx_request.status == DONE_STATUS
+            return sfx_request
+        except Exception as e:
+            outcome = e
+            raise
+        finally:
+            flight.set_result(outcome)
+            if self._flights.get(prompt_key) is flight:
+                del self._flights[prompt_key]
+
+    async def _generate_with_lease(self, user, cheer_event_log, delivery, canonical_prompt, prompt_key):
+        loop = asyncio.get_running_loop()
+        waited_since = loop.time()
+        coalesced = False
+        while not await run_in_db_thread(prompt_leases.acquire)(prompt_key, self.owner):
+            if not coalesced:
+                metrics.incr("sfx.singleflight.coalesced_remote")
+                coalesced = True
+            await asyncio.sleep(settings.SFX_SINGLEFLIGHT_POLL_INTERVAL)
+            sfx_request = await run_in_db_thread(SoundEffectRequestService._reuse_generated_audio)(
+                user, cheer_event_log, delivery.claim_clip, prompt_key
+            )
+            if sfx_request is not None:
+                return sfx_request
+            if loop.time() - waited_since > prompt_leases.ttl:
+                logger.warning("Sound Effect Generation: gave up waiting on the lease for a prompt.")
+                return await self._call_elevenlabs(user, cheer_event_log, delivery, canonical_prompt, prompt_key)
+
+        try:
+            if coalesced:
+                # the previous holder may have stored the audio just before releasing the lease
+                sfx_request = await run_in_db_thread(SoundEffectRequestService._reuse_generated_audio)(
+                    user, cheer_event_log, delivery.claim_clip, prompt_key
+                )
+                if sfx_request is not None:
+                    return sfx_request
+            return await self._call_elevenlabs(user, cheer_event_log, delivery, canonical_prompt, prompt_key)
+        finally:
+            await run_in_db_thread(prompt_leases.release)(prompt_key, self.owner)
+
+    async def _call_elevenlabs(self, user, cheer_event_log, delivery, canonical_prompt, prompt_key):
+        loop = asyncio.get_running_loop()
+        started_at = await self.call_window.acquire()
+        answered = False
+        rate_limit = None
+        try:
+            await self.rate_limiter.acquire()
+            if delivery.skip_expired and is_expired(cheer_event_log):
+                # waited too long for a slot, don't pay for a sound nobody will hear
+                await run_in_db_thread(record_shed)(cheer_event_log, SHED_AT_GENERATION, skipped=True)
+                return None
+            async with elevenlabs_astream_sfx(
+                self.client,
+                cheer_event_log.message,
+                duration_seconds=SFX_DURATION_SECONDS,
+                prompt_influence=SFX_PROMPT_INFLUENCE
+            ) as response:
+                answered = True
+                metrics.observe("sfx.engine.elevenlabs_seconds", loop.time() - started_at)
+                return await self._stream_to_storage(
+                    response, user, cheer_event_log, delivery, canonical_prompt, prompt_key
+                )
+        except ElevenLabsRateLimited as e:
+            metrics.incr("sfx.engine.rate_limited")
+            rate_limit = e
+            raise
+        except ElevenLabsApiError:
+            logger.error("Sound Effect Generation: API call to elevenlabs failed.")
+            raise
+        finally:
+            await self.call_window.release(
+                started_at,
+                succeeded=answered,
+                rate_limited=rate_limit is not None,
+                retry_after=rate_limit.retry_after if rate_limit else None
+            )
+
+    async def _stream_to_storage(self, response, user, cheer_event_log, delivery, canonical_prompt, prompt_key):
+        """Saves the audio from a db thread while it downloads, the request is recorded once it is stored."""
+        pipe = ChunkPipe(settings.SFX_STREAM_BUFFER_BYTES)
+
+        def complete_generation():
+            try:
+                return SoundEffectRequestService._complete_generation(
+                    user,
+                    cheer_event_log,
+                    delivery.claim_clip,
+                    File(pipe),
+                    canonical_prompt,
+                    prompt_key
+                )
+            finally:
+                pipe.close()
+
+        saving = asyncio.ensure_future(run_in_db_thread(complete_generation)())
+        fast_clip = bytearray() if settings.SFX_FAST_PATH and delivery.send_to_consumers else None
+        try:
+            async for chunk in response.aiter_bytes(settings.SFX_STREAM_CHUNK_SIZE):
+                if fast_clip is not None:
+                    if len(fast_clip) + len(chunk) > settings.SFX_FAST_PATH_MAX_BYTES:
+                        fast_clip = None
+                    else:
+                        fast_clip += chunk
+                await pipe.put(chunk)
+        except BrokenPipeError:
+            # storage failed, its error is raised from `saving` below
+            pass
+        except BaseException as e:
+            pipe.finish(error=e)
+            try:
+                # the upload fails on the same error, its partial file is deleted by then
+                await saving
+            except Exception:
+                pass
+            raise
+        pipe.finish()
+
+        if fast_clip is not None and not saving.done():
+            await run_in_db_thread(SoundEffectRequestService._send_fast_clip)(
+                user,
+                cheer_event_log,
+                delivery.claim_clip,
+                bytes(fast_clip)
+            )
+        return await saving
@@ -0,0 +1,43 @@
+import random
+
+from botocore.exceptions import BotoCoreError, ClientError
+from django.conf import settings
+from django.db import DatabaseError
+
+from twitch_bot.exceptions import (
+    CircuitOpenError,
+    ElevenLabsApiError,
+    ElevenLabsRateLimited,
+    ElevenLabsRequestRejected,
+)
+from .constants import (
+    TRANSIENT_FAILURE,
+    RATE_LIMITED_FAILURE,
+    PERMANENT_FAILURE,
+    LEASE_EXPIRED_FAILURE,
+    INTERNAL_FAILURE,
+)
+
+# failure classes worth another attempt, the others are dead lettered right away
+RETRYABLE_FAILURES = {TRANSIENT_FAILURE, RATE_LIMITED_FAILURE, LEASE_EXPIRED_FAILURE}
+
+
+def classify_failure(error):
+    if isinstance(error, ElevenLabsRateLimited):
+        return RATE_LIMITED_FAILURE
+    if isinstance(error, ElevenLabsRequestRejected):
+        return PERMANENT_FAILURE
+    if isinstance(error, (ElevenLabsApiError, CircuitOpenError)):
+        # network errors, provider 5xx and open circuits
+        return TRANSIENT_FAILURE
+    if isinstance(error, (BotoCoreError, ClientError, OSError, DatabaseError)):
+        # storage and database hiccups
+        return TRANSIENT_FAILURE
+    # a bug won't fix itself by retrying, the job is kept for replay after the fix
+    return INTERNAL_FAILURE
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with equal jitter, in seconds, before retrying after the given attempt."""
+    delay = min(settings.SFX_RETRY_MAX_DELAY, settings.SFX_RETRY_BASE_DELAY * 2 ** max(attempt - 1, 0))
+    return delay / 2 + random.uniform(0, delay / 2)
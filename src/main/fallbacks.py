@@ -0,0 +1,27 @@
+import re
+
+from django.templatetags.static import static
+
+from .constants import FALLBACK_SOUND_BANK, FALLBACK_DEFAULT_CLIP
+
+WORD_REGEX = re.compile(r"\w+")
+
+_KEYWORD_INDEX = {}
+for _path, _keywords in FALLBACK_SOUND_BANK:
+    for _keyword in _keywords:
+        _KEYWORD_INDEX.setdefault(_keyword, []).append(_path)
+
+
+def choose_fallback_clip(prompt):
+    """Path of the bank clip sharing the most keywords with the prompt, or the default clip."""
+    scores = {}
+    for word in set(WORD_REGEX.findall(prompt.casefold())):
+        for path in _KEYWORD_INDEX.get(word, ()):
+            scores[path] = scores.get(path, 0) + 1
+    if not scores:
+        return FALLBACK_DEFAULT_CLIP
+    return max(scores, key=scores.get)
+
+
+def fallback_clip_url(prompt):
+    return static(choose_fallback_clip(prompt))
@@ -0,0 +1,95 @@
+import os
+import time
+import uuid
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger('django')
+
+
+class FastClipStore:
+    """
+    Short lived copies of freshly generated clips. The overlay plays them from the
+    web process while the durable upload to storage is still running, instead of
+    waiting for the upload and then fetching the file back from the bucket.
+
+    Clips live in redis (SET EX) when a redis url is configured, in a local
+    directory otherwise; in that case the web and worker processes must share it.
+    Overlays that get a clip after its copy expired (it waited in the playback
+    queue) are sent the stored file, see CheerEventConsumer.with_stored_urls.
+    """
+
+    def __init__(self, ttl, max_bytes, redis_url=None, directory=None, key_prefix="sfx:clip:"):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.key_prefix = key_prefix
+        self._redis = None
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(
+                redis_url,
+                socket_timeout=0.5,
+                socket_connect_timeout=0.5
+            )
+
+    def _path(self, token):
+        return os.path.join(self.directory, "{token}.mp3".format(token=token))
+
+    def put(self, content):
+        """Stores the clip and returns its token, or None when it could not be stored."""
+        if len(content) > self.max_bytes:
+            return None
+        token = uuid.uuid4()
+        try:
+            if self._redis is not None:
+                self._redis.set(self.key_prefix + str(token), content, ex=self.ttl)
+            else:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(self._path(token), "wb") as clip_file:
+                    clip_file.write(content)
+        except Exception:
+            logger.warning("Fast clips: failed to store a clip, the overlay waits for the upload.")
+            return None
+        return token
+
+    def get(self, token):
+        if self._redis is not None:
+            try:
+                return self._redis.get(self.key_prefix + str(token))
+            except Exception:
+                logger.warning("Fast clips: redis unavailable.")
+                return None
+
+        path = self._path(token)
+        try:
+            if os.path.getmtime(path) < time.time() - self.ttl:
+                return None
+            with open(path, "rb") as clip_file:
+                return clip_file.read()
+        except OSError:
+            return None
+
+    def purge_expired(self):
+        """Deletes expired clips from the local directory, redis expires its own."""
+        if self._redis is not None or not os.path.isdir(self.directory):
+            return 0
+        expired_before = time.time() - self.ttl
+        purged = 0
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime < expired_before:
+                    os.remove(entry.path)
+                    purged += 1
+            except OSError:
+                continue
+        return purged
+
+
+fast_clips = FastClipStore(
+    ttl=settings.SFX_FAST_PATH_TTL,
+    max_bytes=settings.SFX_FAST_PATH_MAX_BYTES,
+    redis_url=settings.REDIS_URL,
+    directory=settings.SFX_FAST_PATH_DIR
+)
@@ -2,6 +2,7 @@ from django import forms
 from django.core.exceptions import ValidationError
 
 from.models import AlertPreferences, SoundEffectRequest
+from .broadcasters import broadcaster_routes
 
 class AlertPreferencesForm(forms.ModelForm):
     class Meta:
@@ -16,6 +17,20 @@ class AlertPreferencesForm(forms.ModelForm):
 
         return data
 
+    def clean(self):
+        cleaned_data = super().clean()
+        min_bits = cleaned_data.get("min_bits")
+        max_bits = cleaned_data.get("max_bits")
+        if min_bits and max_bits is not None and max_bits < min_bits:
+            self.add_error("max_bits", "Can't be less than the bits ammount")
+
+        return cleaned_data
+
+    def save(self, commit=True):
+        alert_preferences = super().save(commit=commit)
+        broadcaster_routes.invalidate_user(alert_preferences.user_id)
+        return alert_preferences
+
 
 class GenerateSfxForm(forms.ModelForm):
     class Meta:
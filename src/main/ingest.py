@@ -0,0 +1,111 @@
+import atexit
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .services import SoundEffectRequestService
+
+logger = logging.getLogger('django')
+
+
+@dataclass(frozen=True)
+class CheerIngestEvent:
+    twitch_message_id: str
+    event_data: dict
+    #Twitch-Eventsub-Message-Timestamp, the cheer's deadline is derived from it
+    message_timestamp: datetime = None
+
+
+class CheerIngestBuffer:
+    """
+    In-process buffer between the webhook view and the database.
+
+    The view only appends to the buffer, so Twitch gets its ack without waiting
+    on any query. A background thread drains it in micro-batches (on size or
+    on the flush interval) and writes each batch with bulk inserts.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_pending):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._exit_hook_registered = False
+
+    def submit(self, ingest_event):
+        """Returns False when the buffer is full and the event was not accepted."""
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                return False
+            self._pending.append(ingest_event)
+            pending = len(self._pending)
+            self._ensure_started()
+
+        if pending >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="cheer-ingest", daemon=True)
+        self._thread.start()
+        if not self._exit_hook_registered:
+            atexit.register(self.close)
+            self._exit_hook_registered = True
+
+    def _drain(self):
+        with self._lock:
+            batch_length = min(len(self._pending), self.batch_size)
+            return [self._pending.popleft() for _ in range(batch_length)]
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        batch = self._drain()
+        while batch:
+            self._write(batch)
+            batch = self._drain()
+
+    def _write(self, batch):
+        close_old_connections()
+        try:
+            SoundEffectRequestService.save_cheer_events(batch)
+        except Exception:
+            logger.exception(
+                "Cheer ingest: failed to write a batch of {n} events, retrying one by one.".format(n=len(batch))
+            )
+            for ingest_event in batch:
+                try:
+                    SoundEffectRequestService.save_cheer_events([ingest_event])
+                except Exception:
+                    logger.exception(
+                        "Cheer ingest: dropped event {id}.".format(id=ingest_event.twitch_message_id)
+                    )
+
+    def close(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self.flush()
+
+
+cheer_ingest_buffer = CheerIngestBuffer(
+    batch_size=settings.CHEER_INGEST_BATCH_SIZE,
+    flush_interval=settings.CHEER_INGEST_FLUSH_INTERVAL,
+    max_pending=settings.CHEER_INGEST_MAX_PENDING
+)
@@ -0,0 +1,60 @@
+import random
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from main.models import AlertPreferences
+from main.matching import CheerMatcher
+
+SAMPLE_MESSAGES = [
+    "Cheer100 $fx huge explosion",
+    "$FX airhorn",
+    "Cheer500 BibleThump100 $sfx crowd cheering",
+    "Cheer100 fart",
+    "just some support, love the stream",
+    "Cheer1000",
+]
+
+
+class Command(BaseCommand):
+    help = "Measures the per-event cost of matching cheers against broadcaster preferences."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=100000)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        events = [
+            (rng.choice([100, 200, 500, 1000]), rng.choice(SAMPLE_MESSAGES))
+            for _ in range(options["events"])
+        ]
+        cases = {
+            "bits only": AlertPreferences(min_bits=200, match_bits=False),
+            "exact bits": AlertPreferences(min_bits=100, match_bits=True),
+            "bits range + commands": AlertPreferences(
+                min_bits=100,
+                max_bits=1000,
+                match_bits=False,
+                match_command=True,
+                command_string="$fx, $sfx",
+            ),
+        }
+
+        self.stdout.write("{n} events, best of {r} runs".format(n=len(events), r=options["repeat"]))
+        for name, alert_preferences in cases.items():
+            matcher = CheerMatcher.from_preferences(alert_preferences)
+
+            def run():
+                for bits, message in events:
+                    matcher.matches(bits, message)
+
+            best = min(timeit.repeat(run, number=1, repeat=options["repeat"]))
+            accepted = sum(matcher.matches(bits, message) for bits, message in events)
+            self.stdout.write(
+                "{name:<24} {ns:>8.0f} ns/event  ({accepted} accepted)".format(
+                    name=name,
+                    ns=best / len(events) * 1e9,
+                    accepted=accepted
+                )
+            )
@@ -0,0 +1,95 @@
+import time
+import random
+
+from django.core.management.base import BaseCommand
+
+from main.similarity import PromptSimilarityIndex, minhash_signature, shingles
+
+WORDS = [
+    "huge", "explosion", "airhorn", "fart", "crowd", "cheering", "laser", "sword",
+    "dragon", "roar", "cartoon", "falling", "car", "horn", "traffic", "suspense",
+    "drum", "roll", "glass", "breaking", "thunder", "storm", "evil", "laugh",
+    "robot", "beep", "cat", "meow", "dog", "bark", "door", "creak", "rain",
+    "spaceship", "engine", "bubble", "pop", "scream", "whistle", "bell",
+]
+
+
+def jaccard(a, b):
+    a, b = shingles(a), shingles(b)
+    return len(a & b) / len(a | b) if a | b else 0.0
+
+
+def perturb(prompt, rng):
+    """Small edits streamers make to the same idea: articles, punctuation, one changed word."""
+    words = prompt.split()
+    edit = rng.randrange(3)
+    if edit == 0:
+        words.insert(0, rng.choice(["a", "the", "some"]))
+    elif edit == 1:
+        words[-1] = words[-1] + rng.choice(["!!", "!", "...", "?"])
+    else:
+        words.append(rng.choice(WORDS))
+    return " ".join(words)
+
+
+class Command(BaseCommand):
+    help = "Measures recall against lookup latency of the MinHash/LSH prompt index for a few band settings."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--entries", type=int, default=100000)
+        parser.add_argument("--queries", type=int, default=2000)
+        parser.add_argument("--threshold", type=float, default=0.8)
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        prompts = list({
+            " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5)))
+            for _ in range(options["entries"])
+        })
+        start = time.perf_counter()
+        signatures = [minhash_signature(prompt) for prompt in prompts]
+        signing_time = (time.perf_counter() - start) / len(prompts)
+
+        queries = []
+        for _ in range(options["queries"]):
+            source = rng.randrange(len(prompts))
+            query = perturb(prompts[source], rng)
+            queries.append((query, minhash_signature(query), jaccard(query, prompts[source])))
+
+        self.stdout.write("{n} indexed prompts, {q} queries, threshold {t}, {s:.1f}us to sign a prompt".format(
+            n=len(prompts),
+            q=len(queries),
+            t=options["threshold"],
+            s=signing_time * 1e6
+        ))
+        for bands, min_band_hits in ((8, 1), (16, 1), (16, 2), (32, 3)):
+            index = PromptSimilarityIndex(
+                bands=bands,
+                threshold=options["threshold"],
+                min_band_hits=min_band_hits
+            )
+            for slot, signature in enumerate(signatures):
+                index.add(slot, signature)
+
+            relevant = 0
+            found = 0
+            latencies = []
+            for query, signature, true_similarity in queries:
+                start = time.perf_counter()
+                match = index.query(signature)
+                latencies.append(time.perf_counter() - start)
+                if true_similarity >= options["threshold"]:
+                    relevant += 1
+                    if match is not None and jaccard(query, prompts[match[0]]) >= options["threshold"]:
+                        found += 1
+
+            latencies.sort()
+            self.stdout.write(
+                "bands={bands:<3} min_hits={hits}  recall={recall:.3f}  p50={p50:.1f}us  p99={p99:.1f}us".format(
+                    bands=bands,
+                    hits=min_band_hits,
+                    recall=found / relevant if relevant else 0.0,
+                    p50=latencies[len(latencies) // 2] * 1e6,
+                    p99=latencies[int(len(latencies) * 0.99)] * 1e6
+                )
+            )
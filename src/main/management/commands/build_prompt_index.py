@@ -0,0 +1,101 @@
+from django.core.management.base import BaseCommand
+
+from main.models import GeneratedAudio, SoundEffectRequest
+from main.constants import DONE_STATUS, SFX_DURATION_SECONDS, SFX_PROMPT_INFLUENCE
+from main.matching import parse_command_prefixes
+from main.prompts import canonicalize_prompt, prompt_cache_key
+from main.similarity import minhash_signature, pack_signature
+
+
+class Command(BaseCommand):
+    help = (
+        "Computes MinHash signatures for cached audio that has none, and optionally "
+        "seeds the audio cache from past generated sound effects."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--from-history",
+            action="store_true",
+            help="Also create cache entries for done sound effect requests that have none."
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        if options["from_history"]:
+            created = self._seed_from_history(batch_size)
+            self.stdout.write("Seeded {n} cache entries from history.".format(n=created))
+
+        signed = self._sign_missing(batch_size)
+        self.stdout.write("Computed {n} signatures.".format(n=signed))
+
+    def _sign_missing(self, batch_size):
+        signed = 0
+        batch = []
+        for entry in GeneratedAudio.objects.filter(minhash__isnull=True).only(
+            "id", "canonical_prompt"
+        ).iterator(chunk_size=batch_size):
+            signature = minhash_signature(entry.canonical_prompt)
+            if signature is None:
+                continue
+            entry.minhash = pack_signature(signature)
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                GeneratedAudio.objects.bulk_update(batch, ["minhash"])
+                signed += len(batch)
+                batch = []
+
+        if batch:
+            GeneratedAudio.objects.bulk_update(batch, ["minhash"])
+            signed += len(batch)
+        return signed
+
+    def _seed_from_history(self, batch_size):
+        created = 0
+        batch = {}
+        sfx_requests = SoundEffectRequest.objects.filter(
+            status=DONE_STATUS
+        ).exclude(
+            generated_file=""
+        ).exclude(
+            generated_file__isnull=True
+        ).select_related(
+            "cheer_event_log__internal_broadcaster_user__alertpreferences"
+        ).order_by("timestamp")
+
+        for sfx_request in sfx_requests.iterator(chunk_size=batch_size):
+            cheer_event_log = sfx_request.cheer_event_log
+            broadcaster = cheer_event_log.internal_broadcaster_user
+            alert_preferences = getattr(broadcaster, "alertpreferences", None) if broadcaster else None
+            if alert_preferences is None or not alert_preferences.reuse_cached_audio:
+                continue
+
+            canonical_prompt = canonicalize_prompt(
+                cheer_event_log.message,
+                parse_command_prefixes(alert_preferences.command_string)
+            )
+            if not canonical_prompt:
+                continue
+
+            prompt_key = prompt_cache_key(canonical_prompt, SFX_DURATION_SECONDS, SFX_PROMPT_INFLUENCE)
+            batch.setdefault(prompt_key, GeneratedAudio(
+                prompt_key=prompt_key,
+                canonical_prompt=canonical_prompt,
+                duration_seconds=SFX_DURATION_SECONDS,
+                prompt_influence=SFX_PROMPT_INFLUENCE,
+                file=sfx_request.generated_file.name,
+                last_used_at=sfx_request.timestamp
+            ))
+            if len(batch) >= batch_size:
+                created += self._insert(batch)
+                batch = {}
+
+        if batch:
+            created += self._insert(batch)
+        return created
+
+    def _insert(self, batch):
+        existing = GeneratedAudio.objects.filter(prompt_key__in=batch.keys()).count()
+        GeneratedAudio.objects.bulk_create(batch.values(), ignore_conflicts=True)
+        return len(batch) - existing
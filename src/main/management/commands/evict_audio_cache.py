@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main.audio_cache import GeneratedAudioCache
+
+
+class Command(BaseCommand):
+    help = "Evicts least recently used generated audio cache entries until the cache fits its limits."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-entries",
+            type=int,
+            default=settings.SFX_AUDIO_CACHE_MAX_ENTRIES
+        )
+        parser.add_argument(
+            "--max-bytes",
+            type=int,
+            default=settings.SFX_AUDIO_CACHE_MAX_BYTES
+        )
+
+    def handle(self, *args, **options):
+        evicted = GeneratedAudioCache.evict(
+            max_entries=options["max_entries"],
+            max_bytes=options["max_bytes"]
+        )
+        self.stdout.write("Evicted {n} cached sound effects.".format(n=evicted))
@@ -0,0 +1,22 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from main.storage import SpoolingS3Storage
+
+
+class Command(BaseCommand):
+    help = (
+        "Uploads the generated files waiting in the local spool to the bucket, "
+        "for instance those left behind by a worker that was stopped."
+    )
+
+    def handle(self, *args, **options):
+        if not isinstance(default_storage, SpoolingS3Storage):
+            raise CommandError("The default storage is not spooling, set USE_S3 and USE_SFX_SPOOL.")
+
+        flushed = default_storage.flush()
+        stats = default_storage.spool_stats()
+        self.stdout.write("Uploaded {n} spooled files, {bytes} bytes left in the spool.".format(
+            n=flushed,
+            bytes=stats["bytes"]
+        ))
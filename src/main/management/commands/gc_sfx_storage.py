@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main.retention import SfxStorageSweeper
+
+
+class Command(BaseCommand):
+    help = (
+        "Applies the retention policy to the generated sound effect files: recounts their references, "
+        "expires files past their plan's retention, archives cold files and deletes unreferenced ones."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.SFX_STORAGE_GC_BATCH_SIZE
+        )
+        parser.add_argument(
+            "--archive-after-days",
+            type=int,
+            default=settings.SFX_ARCHIVE_AFTER_DAYS,
+            help="0 to skip archiving."
+        )
+
+    def handle(self, *args, **options):
+        stats = SfxStorageSweeper(
+            batch_size=options["batch_size"],
+            archive_after_days=options["archive_after_days"]
+        ).run()
+        self.stdout.write(
+            "Fixed {recounted} reference counts, expired {expired} sound effects, archived {archived} files, "
+            "deleted {deleted} unreferenced files and {incoming} abandoned uploads.".format(**stats)
+        )
@@ -0,0 +1,113 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from main.constants import QUEUED_STATUS, RUNNING_STATUS, SFX_FAILURE_CLASS_OPTIONS
+from main.models import SfxDeadLetter, SfxGenerationJob
+from main.queue import SfxJobQueue
+
+
+def parse_time(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise CommandError("Invalid date time: {value}".format(value=value))
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-enqueues dead lettered sound effect generations, filtered by time range, "
+        "broadcaster or failure. Keeps at most --max-in-flight replays queued or running "
+        "at once, so a recovery doesn't hammer the provider."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", type=parse_time, help="Only failures dead lettered after this date time.")
+        parser.add_argument("--until", type=parse_time, help="Only failures dead lettered before this date time.")
+        parser.add_argument(
+            "--broadcaster",
+            action="append",
+            default=[],
+            help="Broadcaster username, can be repeated."
+        )
+        parser.add_argument(
+            "--failure-class",
+            action="append",
+            default=[],
+            choices=[option[0] for option in SFX_FAILURE_CLASS_OPTIONS]
+        )
+        parser.add_argument("--reason", help="Only failures whose reason contains this text.")
+        parser.add_argument("--include-replayed", action="store_true", help="Also replay failures replayed before.")
+        parser.add_argument("--play", action="store_true", help="Send the replayed sound effects to the overlays.")
+        parser.add_argument("--limit", type=int)
+        parser.add_argument("--max-in-flight", type=int, default=20)
+        parser.add_argument("--poll-interval", type=float, default=2.0)
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        dead_letters = self._filter(options)
+        total = dead_letters.count()
+        if options["limit"] is not None:
+            total = min(total, options["limit"])
+        self.stdout.write("{n} dead lettered generations to replay.".format(n=total))
+        if options["dry_run"] or not total:
+            return
+
+        max_in_flight = max(1, options["max_in_flight"])
+        pending_job_ids = set()
+        replayed = 0
+        for dead_letter in dead_letters.select_related("user", "cheer_event_log").iterator(chunk_size=500):
+            if replayed >= total:
+                break
+
+            while len(pending_job_ids) >= max_in_flight:
+                time.sleep(options["poll_interval"])
+                pending_job_ids = self._still_pending(pending_job_ids)
+
+            job = SfxJobQueue.build_job(
+                dead_letter.user_id,
+                dead_letter.cheer_event_log,
+                options["play"],
+                dead_letter.user.billing_plan
+            )
+            with transaction.atomic():
+                job.save()
+                SfxDeadLetter.objects.filter(id=dead_letter.id).update(
+                    replayed_at=timezone.now(),
+                    replay_job=job
+                )
+            pending_job_ids.add(job.id)
+            replayed += 1
+            if replayed % 100 == 0:
+                self.stdout.write("Replayed {n}/{total}.".format(n=replayed, total=total))
+
+        self.stdout.write("Replayed {n} generations.".format(n=replayed))
+
+    def _filter(self, options):
+        dead_letters = SfxDeadLetter.objects.order_by("created")
+        if not options["include_replayed"]:
+            dead_letters = dead_letters.filter(replayed_at__isnull=True)
+        if options["since"]:
+            dead_letters = dead_letters.filter(created__gte=options["since"])
+        if options["until"]:
+            dead_letters = dead_letters.filter(created__lt=options["until"])
+        if options["broadcaster"]:
+            dead_letters = dead_letters.filter(user__username__in=options["broadcaster"])
+        if options["failure_class"]:
+            dead_letters = dead_letters.filter(failure_class__in=options["failure_class"])
+        if options["reason"]:
+            dead_letters = dead_letters.filter(reason__icontains=options["reason"])
+        return dead_letters
+
+    def _still_pending(self, job_ids):
+        return set(
+            SfxGenerationJob.objects.filter(
+                id__in=job_ids,
+                status__in=[QUEUED_STATUS, RUNNING_STATUS]
+            ).values_list("id", flat=True)
+        )
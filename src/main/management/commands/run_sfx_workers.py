@@ -0,0 +1,204 @@
+import os
+import random
+import signal
+import socket
+import asyncio
+import logging
+from datetime import timedelta
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from main.constants import INTERNAL_FAILURE, RATE_LIMITED_FAILURE, OVERLAY_OFFLINE_DEFER
+from main.broadcasters import broadcaster_routes
+from main.deadlines import is_expired
+from main.engine import GenerationEngine, run_in_db_thread
+from main.fastclips import fast_clips
+from main.failures import classify_failure
+from main.presence import overlay_presence
+from main.queue import SfxJobQueue
+from main.similarity import generated_audio_index
+from main.singleflight import prompt_leases
+from twitch_bot.exceptions import ElevenLabsRateLimited
+from twitch_bot.metrics import metrics, metrics_exporter
+
+logger = logging.getLogger('django')
+
+RECOVERY_INTERVAL_SECONDS = 30
+CLAIM_BATCH_SIZE = 20
+
+
+class Command(BaseCommand):
+    help = "Runs the async sound effect generation engine on the SfxGenerationJob queue."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=settings.SFX_ENGINE_MAX_IN_FLIGHT,
+            help="Maximum number of generations in flight in this process."
+        )
+        parser.add_argument(
+            "--db-threads",
+            type=int,
+            default=settings.SFX_ENGINE_DB_THREADS,
+            help="Threads running the blocking database and storage work."
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=settings.SFX_WORKER_POLL_INTERVAL,
+            help="Seconds to wait before polling again when the queue is empty."
+        )
+
+    def handle(self, *args, **options):
+        asyncio.run(self._run(
+            max(1, options["concurrency"]),
+            max(1, options["db_threads"]),
+            options["poll_interval"]
+        ))
+
+    async def _run(self, concurrency, db_threads, poll_interval):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=db_threads))
+
+        stop_event = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self._request_stop, stop_event)
+
+        worker_id = "{host}:{pid}".format(host=socket.gethostname(), pid=os.getpid())
+        running = {}
+        last_recovery = None
+
+        logger.info("SFX workers: starting engine with {n} slots.".format(n=concurrency))
+        if not settings.USE_REDIS:
+            # the in-memory channel layer only reaches consumers of this process, and there are none
+            logger.warning("SFX workers: USE_REDIS is off, generated clips won't reach the overlays.")
+        await run_in_db_thread(generated_audio_index.warm)()
+        heartbeat = asyncio.create_task(self._keep_leases(running))
+        publishing = asyncio.create_task(self._publish_metrics(worker_id))
+        async with GenerationEngine.from_settings(max_in_flight=concurrency, owner=worker_id) as engine:
+            while not stop_event.is_set():
+                jobs = []
+                try:
+                    if last_recovery is None or loop.time() - last_recovery > RECOVERY_INTERVAL_SECONDS:
+                        await run_in_db_thread(SfxJobQueue.recover_expired)()
+                        await run_in_db_thread(prompt_leases.purge_expired)()
+                        await run_in_db_thread(fast_clips.purge_expired)()
+                        last_recovery = loop.time()
+
+                    free_slots = concurrency - len(running)
+                    if free_slots > 0:
+                        jobs = await run_in_db_thread(SfxJobQueue.claim)(
+                            worker_id,
+                            limit=min(free_slots, CLAIM_BATCH_SIZE),
+                            exclude_user_ids=self._saturated_broadcasters(running, engine)
+                        )
+                except Exception:
+                    logger.exception("SFX workers: failed to claim jobs.")
+
+                for job in jobs:
+                    task = asyncio.create_task(self._run_job(engine, job))
+                    running[task] = job
+                    task.add_done_callback(running.pop)
+
+                if not jobs:
+                    # sleeps until a job finishes, the poll interval passes or a stop is requested
+                    waiters = [asyncio.ensure_future(stop_event.wait()), *running]
+                    await asyncio.wait(waiters, timeout=poll_interval, return_when=asyncio.FIRST_COMPLETED)
+                    waiters[0].cancel()
+
+            if running:
+                logger.info("SFX workers: shutdown requested, finishing {n} in-flight jobs.".format(n=len(running)))
+                await asyncio.gather(*running, return_exceptions=True)
+            heartbeat.cancel()
+            publishing.cancel()
+
+        logger.info("SFX workers: stopped.")
+
+    async def _keep_leases(self, running):
+        """Extends the leases of the running jobs, they may wait on the engine for longer than the timeout."""
+        while True:
+            await asyncio.sleep(settings.SFX_JOB_HEARTBEAT_INTERVAL)
+            jobs = list(running.values())
+            try:
+                held = await run_in_db_thread(SfxJobQueue.extend_leases)(jobs)
+            except Exception:
+                logger.exception("SFX workers: failed to extend job leases.")
+                continue
+            if held < len(jobs):
+                # finished in the meantime, or recovered by another worker after a stall
+                metrics.incr("sfx.queue.leases_lost", value=len(jobs) - held)
+
+    async def _publish_metrics(self, worker_id):
+        """The engine and queue metrics are recorded here, /internal/metrics/ shows them from the web process."""
+        while True:
+            try:
+                await run_in_db_thread(lambda: metrics_exporter.publish(worker_id, metrics.snapshot()))()
+            except Exception:
+                logger.exception("SFX workers: failed to publish metrics.")
+            await asyncio.sleep(settings.METRICS_PUBLISH_INTERVAL)
+
+    def _request_stop(self, stop_event):
+        stop_event.set()
+
+    def _saturated_broadcasters(self, running, engine):
+        claimed = Counter(job.user_id for job in running.values())
+        return [user_id for user_id, count in claimed.items() if count >= engine.max_per_broadcaster]
+
+    async def _wait_for_overlay(self, job):
+        """
+        Defers the job while the broadcaster's overlay is closed, for broadcasters
+        who asked to. Returns True when it was deferred. Stops waiting at the
+        job's give up time, and for cheers past their deadline, which can't play anyway.
+        """
+        if not job.send_to_consumers or not overlay_presence.shared or is_expired(job.cheer_event_log):
+            return False
+        route = await run_in_db_thread(broadcaster_routes.get)(job.cheer_event_log.broadcaster_user_id)
+        if route is None or route.overlay_offline_policy != OVERLAY_OFFLINE_DEFER:
+            return False
+        if await run_in_db_thread(overlay_presence.is_live)(str(job.user_id)):
+            return False
+
+        delay = settings.OVERLAY_OFFLINE_RETRY_SECONDS * random.uniform(1, 1.5)
+        if job.give_up_at and timezone.now() + timedelta(seconds=delay) >= job.give_up_at:
+            return False
+        await run_in_db_thread(SfxJobQueue.defer)(job, delay, reason="Waiting for the overlay to open.")
+        metrics.incr("sfx.presence.deferred")
+        return True
+
+    async def _run_job(self, engine, job):
+        try:
+            if await self._wait_for_overlay(job):
+                return
+            await engine.generate(
+                job.user,
+                job.cheer_event_log,
+                send_to_consumers=job.send_to_consumers
+            )
+        except ElevenLabsRateLimited as e:
+            # jittered so the deferred jobs don't all come back in the same instant
+            delay = (e.retry_after or settings.ELEVENLABS_DEFAULT_RETRY_AFTER) * random.uniform(1, 1.5)
+            if job.give_up_at and timezone.now() + timedelta(seconds=delay) >= job.give_up_at:
+                await run_in_db_thread(SfxJobQueue.fail)(job, RATE_LIMITED_FAILURE, "Rate limited by elevenlabs.")
+            else:
+                await run_in_db_thread(SfxJobQueue.defer)(job, delay, reason="Rate limited by elevenlabs.")
+            return
+        except Exception as e:
+            failure_class = classify_failure(e)
+            if failure_class == INTERNAL_FAILURE:
+                logger.exception("SFX workers: job {id} crashed.".format(id=job.id))
+            else:
+                logger.warning("SFX workers: job {id} failed ({failure_class}): {error!r}".format(
+                    id=job.id,
+                    failure_class=failure_class,
+                    error=e
+                ))
+            await run_in_db_thread(SfxJobQueue.fail)(job, failure_class, repr(e))
+            return
+
+        if not await run_in_db_thread(SfxJobQueue.complete)(job):
+            logger.warning("SFX workers: lease for job {id} expired before it finished.".format(id=job.id))
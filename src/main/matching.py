@@ -0,0 +1,62 @@
+import re
+from dataclasses import dataclass, field
+
+# cheermotes (Cheer100, BibleThump50...) that Twitch puts in front of the actual message
+CHEERMOTE_PATTERN = r"[A-Za-z]+\d+(?=\s|$)"
+
+
+def parse_command_prefixes(command_string):
+    """Splits the comma separated command setting into the list of accepted prefixes."""
+    return tuple(
+        prefix.strip() for prefix in (command_string or "").split(",") if prefix.strip()
+    )
+
+
+@dataclass(frozen=True)
+class CheerMatcher:
+    """
+    A broadcaster's cheer requirements compiled once, so matching an event is
+    a couple of int comparisons and at most one precompiled regex match.
+    """
+    min_bits: int
+    max_bits: int = None
+    exact_bits: bool = False
+    command_prefixes: tuple = ()
+    ignore_case: bool = True
+    _command_regex: re.Pattern = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if not self.command_prefixes:
+            return
+        flags = re.IGNORECASE if self.ignore_case else 0
+        alternatives = "|".join(re.escape(prefix) for prefix in self.command_prefixes)
+        command_regex = re.compile(
+            r"\s*(?:{cheermote}\s*)*(?:{alternatives})".format(
+                cheermote=CHEERMOTE_PATTERN,
+                alternatives=alternatives
+            ),
+            flags
+        )
+        object.__setattr__(self, "_command_regex", command_regex)
+
+    @classmethod
+    def from_preferences(cls, alert_preferences):
+        prefixes = parse_command_prefixes(alert_preferences.command_string) if alert_preferences.match_command else ()
+        return cls(
+            min_bits=alert_preferences.min_bits,
+            max_bits=alert_preferences.max_bits,
+            exact_bits=alert_preferences.match_bits,
+            command_prefixes=prefixes,
+            ignore_case=alert_preferences.command_ignore_case
+        )
+
+    def matches(self, bits, message):
+        if self.exact_bits:
+            if bits != self.min_bits:
+                return False
+        elif bits < self.min_bits or (self.max_bits is not None and bits > self.max_bits):
+            return False
+
+        if self._command_regex is None:
+            return True
+        return self._command_regex.match(message) is not None
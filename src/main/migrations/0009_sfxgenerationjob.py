@@ -0,0 +1,48 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:42
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_rename_timestmap_cheereventlogentry_timestamp'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='cheereventlogentry',
+            options={'ordering': ['-timestamp']},
+        ),
+        migrations.AlterModelOptions(
+            name='soundeffectrequest',
+            options={'ordering': ['-timestamp']},
+        ),
+        migrations.CreateModel(
+            name='SfxGenerationJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('send_to_consumers', models.BooleanField(default=True)),
+                ('status', models.CharField(choices=[('Q', 'Queued'), ('R', 'Running'), ('E', 'Failed'), ('D', 'Done')], default='Q', max_length=1)),
+                ('attempts', models.IntegerField(default=0)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('lease_id', models.UUIDField(blank=True, null=True)),
+                ('locked_by', models.CharField(blank=True, max_length=150)),
+                ('locked_until', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('cheer_event_log', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.cheereventlogentry')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['available_at'],
+                'indexes': [models.Index(fields=['status', 'available_at'], name='main_sfxgen_status_67dd7a_idx'), models.Index(fields=['status', 'locked_until'], name='main_sfxgen_status_b5e61c_idx')],
+            },
+        ),
+    ]
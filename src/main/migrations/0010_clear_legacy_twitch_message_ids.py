@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+def clear_legacy_message_ids(apps, schema_editor):
+    # legacy rows stored the eventsub subscription id here, which repeats for every
+    # cheer of a channel and can't be made unique. The real message id was never kept.
+    CheerEventLogEntry = apps.get_model("main", "CheerEventLogEntry")
+    CheerEventLogEntry.objects.update(twitch_message_id=None)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0009_sfxgenerationjob"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="cheereventlogentry",
+            name="twitch_message_id",
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.RunPython(clear_legacy_message_ids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0010_clear_legacy_twitch_message_ids"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="cheereventlogentry",
+            name="twitch_message_id",
+            field=models.TextField(blank=True, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_cheereventlogentry_unique_twitch_message_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alertpreferences',
+            name='command_ignore_case',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='alertpreferences',
+            name='max_bits',
+            field=models.IntegerField(blank=True, help_text='Upper bound of the bits range. Ignored when the ammount has to be exact.', null=True),
+        ),
+        migrations.AlterField(
+            model_name='alertpreferences',
+            name='command_string',
+            field=models.CharField(default='$fx', help_text='Separate several accepted commands with commas.', max_length=100),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:48
+
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_alertpreferences_cheer_ranges_and_prefixes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeneratedAudio',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('prompt_key', models.CharField(max_length=64, unique=True)),
+                ('canonical_prompt', models.TextField()),
+                ('duration_seconds', models.FloatField()),
+                ('prompt_influence', models.FloatField()),
+                ('file', models.FileField(max_length=255, upload_to='')),
+                ('size', models.IntegerField(default=0)),
+                ('hits', models.IntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ['-last_used_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='alertpreferences',
+            name='reuse_cached_audio',
+            field=models.BooleanField(default=True, help_text='If enabled, cheers with a prompt that was already generated reuse that sound instead of generating a new one.'),
+        ),
+    ]
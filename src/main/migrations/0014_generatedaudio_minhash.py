@@ -0,0 +1,23 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_generatedaudio'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alertpreferences',
+            name='reuse_similar_audio',
+            field=models.BooleanField(default=False, help_text='If enabled, prompts that are very similar to an already generated one also reuse that sound.'),
+        ),
+        migrations.AddField(
+            model_name='generatedaudio',
+            name='minhash',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
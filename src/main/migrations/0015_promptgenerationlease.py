@@ -0,0 +1,21 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_generatedaudio_minhash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PromptGenerationLease',
+            fields=[
+                ('prompt_key', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('owner', models.CharField(max_length=150)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
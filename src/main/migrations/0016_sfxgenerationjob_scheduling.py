@@ -0,0 +1,43 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:59
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def rank_existing_jobs(apps, schema_editor):
+    # jobs queued before priorities existed keep their FIFO position
+    SfxGenerationJob = apps.get_model("main", "SfxGenerationJob")
+    SfxGenerationJob.objects.update(rank_at=F("available_at"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_promptgenerationlease'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sfxgenerationjob',
+            name='priority',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='sfxgenerationjob',
+            name='rank_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='sfxgenerationjob',
+            name='weight',
+            field=models.FloatField(default=1),
+        ),
+        migrations.RunPython(rank_existing_jobs, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='sfxgenerationjob',
+            index=models.Index(fields=['status', 'user', 'rank_at'], name='main_sfxgen_status_edb24c_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.0.6 on 2026-10-18 20:02
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0016_sfxgenerationjob_scheduling'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sfxgenerationjob',
+            name='attempt_history',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='sfxgenerationjob',
+            name='give_up_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='SfxDeadLetter',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('failure_class', models.CharField(choices=[('transient', 'Transient (network, storage, provider errors)'), ('rate_limited', 'Rate limited by the provider'), ('permanent', 'Rejected by the provider'), ('lease_expired', 'Worker lost the job'), ('internal', 'Internal error')], max_length=20)),
+                ('reason', models.TextField(blank=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('attempt_history', models.JSONField(blank=True, default=list)),
+                ('replayed_at', models.DateTimeField(blank=True, null=True)),
+                ('cheer_event_log', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.cheereventlogentry')),
+                ('job', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='dead_letters', to='main.sfxgenerationjob')),
+                ('replay_job', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='replayed_dead_letters', to='main.sfxgenerationjob')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created'],
+                'indexes': [models.Index(fields=['failure_class', 'created'], name='main_sfxdea_failure_f1dbee_idx')],
+            },
+        ),
+    ]
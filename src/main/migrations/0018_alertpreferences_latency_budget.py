@@ -0,0 +1,23 @@
+# Generated by Django 5.0.6 on 2026-10-18 20:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0017_sfxdeadletter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alertpreferences',
+            name='late_clip_policy',
+            field=models.CharField(choices=[('P', 'Play it when it is ready'), ('S', 'Only save it to the dashboard')], default='P', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='alertpreferences',
+            name='latency_budget_ms',
+            field=models.PositiveIntegerField(blank=True, help_text="If a sound effect isn't ready this long after the cheer, a stock sound plays instead. Empty to always wait.", null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.6 on 2026-10-18 20:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0018_alertpreferences_latency_budget'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alertpreferences',
+            name='stale_cheer_policy',
+            field=models.CharField(choices=[('G', 'Generate it without playing it'), ('K', 'Skip it')], default='G', help_text='What to do with cheers that are too old to play, after an outage or a backlog.', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='cheereventlogentry',
+            name='deadline',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cheereventlogentry',
+            name='shed_stage',
+            field=models.CharField(blank=True, choices=[('ingest', 'Before it was queued'), ('queue', 'When a worker picked it up'), ('generation', 'Before calling elevenlabs'), ('delivery', 'Before sending it to the overlay')], max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='cheereventlogentry',
+            name='status',
+            field=models.CharField(choices=[('N', 'New'), ('I', "Ignored / Didn't match preferences"), ('E', 'Failed'), ('D', 'Done'), ('S', 'Shed / Too old to play')], default='N', max_length=1),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.0.6 on 2026-10-18 20:19
+
+import django.utils.timezone
+import main.models
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0019_cheereventlogentry_deadline'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredSfxFile',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.BigIntegerField(default=0)),
+                ('references', models.IntegerField(default=0)),
+                ('tier', models.CharField(choices=[('H', 'Hot'), ('A', 'Archived')], default='H', max_length=1)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('last_referenced_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ['-last_referenced_at'],
+            },
+        ),
+        migrations.AlterField(
+            model_name='soundeffectrequest',
+            name='generated_file',
+            field=models.FileField(blank=True, max_length=255, null=True, upload_to=main.models.SoundEffectRequest.upload_sfx_file),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 20:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0020_storedsfxfile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alertpreferences',
+            name='overlay_offline_policy',
+            field=models.CharField(choices=[('G', 'Generate them right away'), ('D', 'Wait until the overlay is open')], default='G', help_text="What to do with cheers that come in while the overlay isn't open.", max_length=1),
+        ),
+    ]
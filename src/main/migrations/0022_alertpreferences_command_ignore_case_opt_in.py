@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+def match_case_again(apps, schema_editor):
+    # 0012 added the field switched on, which made every existing command case
+    # insensitive without the broadcaster asking. Matching is case sensitive again
+    # until they turn it on.
+    AlertPreferences = apps.get_model("main", "AlertPreferences")
+    AlertPreferences.objects.update(command_ignore_case=False)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0021_alertpreferences_overlay_offline_policy"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="alertpreferences",
+            name="command_ignore_case",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(match_case_again, migrations.RunPython.noop),
+    ]
@@ -7,14 +7,27 @@ from django.dispatch import receiver
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.db.models.signals import post_save
+from django.utils import timezone
 from twitch_bot.exceptions import TwitchEventSubCreationFailed
 
 from .constants import (
     SOUND_EFFECT_REQUEST_STATUS_OPTIONS, 
     CHEER_EVENT_LOG_STATUS_OPTIONS,
+    SFX_JOB_STATUS_OPTIONS,
+    SFX_FAILURE_CLASS_OPTIONS,
+    LATE_CLIP_POLICY_OPTIONS,
+    LATE_CLIP_PLAY,
+    SHED_STAGE_OPTIONS,
+    STALE_CHEER_POLICY_OPTIONS,
+    STALE_CHEER_GENERATE,
+    OVERLAY_OFFLINE_POLICY_OPTIONS,
+    OVERLAY_OFFLINE_GENERATE,
+    STORAGE_TIER_OPTIONS,
+    STORAGE_TIER_HOT,
     TWITCH_CHEER_EXTERNAL_REFERENCE,
     NEW_STATUS,
-    DONE_STATUS
+    DONE_STATUS,
+    QUEUED_STATUS
 )
 from allauth.account.signals import user_signed_up
 
@@ -37,7 +50,8 @@ class CheerEventLogEntry(models.Model):
     )
     status = models.CharField(choices=CHEER_EVENT_LOG_STATUS_OPTIONS, default=NEW_STATUS, max_length=1)
     #twitch notification fields
-    twitch_message_id = models.TextField(null = False)
+    #Twitch-Eventsub-Message-Id header, unique per delivered notification (null on legacy rows)
+    twitch_message_id = models.TextField(null=True, blank=True, unique=True)
     is_anonymous = models.BooleanField(default=False)
     user_id = models.CharField(max_length=50, null=True, blank=True)
     user_login = models.CharField(max_length=150, null=True, blank=True)
@@ -47,6 +61,10 @@ class CheerEventLogEntry(models.Model):
     broadcaster_user_name = models.CharField(max_length=150)
     message = models.TextField()
     bits = models.IntegerField(default=0)
+    #Twitch message timestamp plus SFX_CHEER_DEADLINE_SECONDS, past it the cheer is too old to play
+    deadline = models.DateTimeField(null=True, blank=True)
+    #set when the cheer went past its deadline, see main.deadlines
+    shed_stage = models.CharField(choices=SHED_STAGE_OPTIONS, max_length=20, blank=True)
 
     def __str__(self):
         return str(self.broadcaster_user_name)
@@ -67,16 +85,47 @@ class AlertPreferences(models.Model):
     )
     match_command = models.BooleanField(default=False)
     command_string = models.CharField(
-        max_length=20, 
-        default="$fx"
+        max_length=100, 
+        default="$fx",
+        help_text="Separate several accepted commands with commas."
     )
+    command_ignore_case = models.BooleanField(default=False)
     auto_generate = models.BooleanField(default=True)
     auto_play = models.BooleanField (default=True)
     match_bits = models.BooleanField(
         default=True, 
         help_text="If enabled, the match ammount has to be exact to generate a sfx. Otherwise, anything over the set bit ammount will generate a sfx.")
     min_bits = models.IntegerField(default=200)
+    max_bits = models.IntegerField(
+        null=True, 
+        blank=True,
+        help_text="Upper bound of the bits range. Ignored when the ammount has to be exact.")
     cheer_eventsub_id = models.TextField(null=True, blank=True)
+    reuse_cached_audio = models.BooleanField(
+        default=True,
+        help_text="If enabled, cheers with a prompt that was already generated reuse that sound instead of generating a new one.")
+    reuse_similar_audio = models.BooleanField(
+        default=False,
+        help_text="If enabled, prompts that are very similar to an already generated one also reuse that sound.")
+    latency_budget_ms = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="If a sound effect isn't ready this long after the cheer, a stock sound plays instead. Empty to always wait.")
+    late_clip_policy = models.CharField(
+        choices=LATE_CLIP_POLICY_OPTIONS,
+        max_length=1,
+        default=LATE_CLIP_PLAY
+    )
+    stale_cheer_policy = models.CharField(
+        choices=STALE_CHEER_POLICY_OPTIONS,
+        max_length=1,
+        default=STALE_CHEER_GENERATE,
+        help_text="What to do with cheers that are too old to play, after an outage or a backlog.")
+    overlay_offline_policy = models.CharField(
+        choices=OVERLAY_OFFLINE_POLICY_OPTIONS,
+        max_length=1,
+        default=OVERLAY_OFFLINE_GENERATE,
+        help_text="What to do with cheers that come in while the overlay isn't open.")
 
     def __str__(self):
         return self.user.username + " preferences"
@@ -103,7 +152,7 @@ class SoundEffectRequest(models.Model):
         max_length=1,
         default=NEW_STATUS
     )
-    generated_file = models.FileField(upload_to=upload_sfx_file, null=True, blank=True)
+    generated_file = models.FileField(upload_to=upload_sfx_file, max_length=255, null=True, blank=True)
     failed_reason = models.TextField(blank=True)
     is_metered = models.BooleanField(default=False)
     usage_record_id = models.TextField(null=True, blank=True)
@@ -116,6 +165,180 @@ class SoundEffectRequest(models.Model):
         ordering = ["-timestamp"]
 
 
+class GeneratedAudio(models.Model):
+    """
+    Cache entry pointing a canonicalized prompt (plus generation parameters)
+    at a file that was already generated and stored.
+    """
+    id = models.UUIDField(
+        default=uuid.uuid4, 
+        primary_key=True, 
+        editable=False
+    )
+    prompt_key = models.CharField(max_length=64, unique=True)
+    canonical_prompt = models.TextField()
+    duration_seconds = models.FloatField()
+    prompt_influence = models.FloatField()
+    file = models.FileField(max_length=255)
+    size = models.IntegerField(default=0)
+    hits = models.IntegerField(default=0)
+    #packed MinHash signature of the canonical prompt, see main.similarity
+    minhash = models.BinaryField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return self.canonical_prompt
+
+    class Meta:
+        ordering = ["-last_used_at"]
+
+
+class StoredSfxFile(models.Model):
+    """
+    A generated file in storage and how many sound effect requests and audio
+    cache entries point at it. Files are stored under their content hash, so
+    the same audio is shared; manage.py gc_sfx_storage recounts the references
+    and deletes files nobody points at anymore.
+    """
+    id = models.UUIDField(
+        default=uuid.uuid4, 
+        primary_key=True, 
+        editable=False
+    )
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField(default=0)
+    references = models.IntegerField(default=0)
+    tier = models.CharField(
+        choices=STORAGE_TIER_OPTIONS,
+        max_length=1,
+        default=STORAGE_TIER_HOT
+    )
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    last_referenced_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        ordering = ["-last_referenced_at"]
+
+
+class SfxGenerationJob(models.Model):
+    """
+    A pending sound effect generation. Rows are claimed by the
+    run_sfx_workers processes, never by the web workers.
+    """
+    id = models.UUIDField(
+        default=uuid.uuid4, 
+        primary_key=True, 
+        editable=False
+    )
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    user = models.ForeignKey(
+        get_user_model(), 
+        on_delete=models.CASCADE
+    )
+    cheer_event_log = models.ForeignKey(CheerEventLogEntry, on_delete=models.CASCADE)
+    send_to_consumers = models.BooleanField(default=True)
+    status = models.CharField(
+        choices=SFX_JOB_STATUS_OPTIONS,
+        max_length=1,
+        default=QUEUED_STATUS
+    )
+    attempts = models.IntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    #scheduling, see main.scheduling: jobs run by rank_at (available_at minus the
+    #priority head start in seconds), interleaved across broadcasters by weight
+    priority = models.FloatField(default=0)
+    rank_at = models.DateTimeField(default=timezone.now)
+    weight = models.FloatField(default=1)
+    lease_id = models.UUIDField(null=True, blank=True)
+    locked_by = models.CharField(max_length=150, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    #no retries are scheduled past this point, see SfxJobQueue.fail
+    give_up_at = models.DateTimeField(null=True, blank=True)
+    #one {"attempt", "at", "failure_class", "error"} entry per failed attempt
+    attempt_history = models.JSONField(default=list, blank=True)
+
+    def __str__(self):
+        return str(self.cheer_event_log_id) + " job"
+
+    class Meta:
+        ordering = ["available_at"]
+        indexes = [
+            models.Index(fields=["status", "available_at"]),
+            models.Index(fields=["status", "locked_until"]),
+            models.Index(fields=["status", "user", "rank_at"]),
+        ]
+
+
+
+
+class SfxDeadLetter(models.Model):
+    """
+    A generation job that failed for good, kept with its attempt history
+    so it can be inspected and replayed with manage.py replay_failed_sfx.
+    """
+    id = models.UUIDField(
+        default=uuid.uuid4, 
+        primary_key=True, 
+        editable=False
+    )
+    created = models.DateTimeField(auto_now_add=True, editable=False, db_index=True)
+    user = models.ForeignKey(
+        get_user_model(), 
+        on_delete=models.CASCADE
+    )
+    cheer_event_log = models.ForeignKey(CheerEventLogEntry, on_delete=models.CASCADE)
+    job = models.ForeignKey(
+        SfxGenerationJob, 
+        on_delete=models.SET_NULL, 
+        null=True, 
+        blank=True,
+        related_name="dead_letters"
+    )
+    failure_class = models.CharField(
+        choices=SFX_FAILURE_CLASS_OPTIONS,
+        max_length=20
+    )
+    reason = models.TextField(blank=True)
+    attempts = models.IntegerField(default=0)
+    attempt_history = models.JSONField(default=list, blank=True)
+    replayed_at = models.DateTimeField(null=True, blank=True)
+    replay_job = models.ForeignKey(
+        SfxGenerationJob, 
+        on_delete=models.SET_NULL, 
+        null=True, 
+        blank=True,
+        related_name="replayed_dead_letters"
+    )
+
+    def __str__(self):
+        return str(self.cheer_event_log_id) + " " + self.failure_class
+
+    class Meta:
+        ordering = ["-created"]
+        indexes = [
+            models.Index(fields=["failure_class", "created"]),
+        ]
+
+class PromptGenerationLease(models.Model):
+    """
+    Held by the worker currently generating a prompt key, so identical prompts
+    arriving on other workers wait for its audio instead of generating it again.
+    Only used when redis is not available, see main.singleflight.
+    """
+    prompt_key = models.CharField(max_length=64, primary_key=True)
+    owner = models.CharField(max_length=150)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.prompt_key
+
+
 @receiver(user_signed_up)
 def create_settings_for_new_user(request, user, **kwargs):
     client = TwitchClient(settings.TWITCH_APP_CLIENT_ID, settings.TWITCH_APP_CLIENT_SECRET)
@@ -129,6 +352,9 @@ def create_settings_for_new_user(request, user, **kwargs):
         eventsub_id = None
     AlertPreferences.objects.create(user=user, cheer_eventsub_id=eventsub_id)
 
+    from .broadcasters import broadcaster_routes
+    broadcaster_routes.invalidate_uid(twitch_uid)
+
 @receiver(post_save, sender=SoundEffectRequest)    
 def update_cheer_log_status(sender, instance, created, *args, **kwargs):
     cheer_log = instance.cheer_event_log
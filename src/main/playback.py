@@ -0,0 +1,130 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+from twitch_bot.metrics import metrics
+
+logger = logging.getLogger('django')
+
+ACK_STARTED = "started"
+ACK_FINISHED = "finished"
+ACK_FAILED = "failed"
+
+
+class PlaybackQueue:
+    """
+    Clips waiting to play on one overlay connection. The overlay plays clips
+    one after the other; up to `window` of them are sent before it finished the
+    ones ahead so it can preload them, the rest wait here instead of piling up
+    in the browser. Clips ready at the same time are sent together.
+
+    The overlay acks "started" then "finished" (or "failed"). When the oldest
+    clip sent isn't started within start_timeout seconds of its turn, or
+    finished within finish_timeout, it is given up on and the window moves on,
+    an overlay that never acks still gets every clip. At most max_length clips
+    wait, the oldest are dropped past that or once they have waited max_wait
+    seconds.
+    """
+
+    def __init__(self, send, window, max_length, max_wait, start_timeout, finish_timeout):
+        self._send = send
+        self.window = window
+        self.max_length = max_length
+        self.max_wait = max_wait
+        self.start_timeout = start_timeout
+        self.finish_timeout = finish_timeout
+        self._waiting = deque()
+        # clip id -> when it started playing, in the order they were sent
+        self._in_flight = OrderedDict()
+        self._head_since = None
+        self._lock = asyncio.Lock()
+        self._timer = None
+
+    async def enqueue(self, event):
+        await self.enqueue_many([event])
+
+    async def enqueue_many(self, events):
+        async with self._lock:
+            queued_at = time.monotonic()
+            self._waiting.extend((queued_at, event) for event in events)
+            while len(self._waiting) > self.max_length:
+                self._waiting.popleft()
+                metrics.incr("overlay.playback.dropped", reason="overflow")
+            metrics.observe("overlay.playback.queue_length", len(self._waiting))
+            await self._fill()
+
+    async def ack(self, clip_id, state):
+        async with self._lock:
+            if clip_id not in self._in_flight:
+                # late ack for a clip already given up on
+                return
+            now = time.monotonic()
+            is_head = clip_id == next(iter(self._in_flight))
+            if state == ACK_STARTED and self._in_flight[clip_id] is None:
+                self._in_flight[clip_id] = now
+                if is_head:
+                    metrics.observe("overlay.playback.start_latency_ms", (now - self._head_since) * 1000)
+                    self._arm_timer(self.finish_timeout)
+            elif state in (ACK_FINISHED, ACK_FAILED):
+                started_at = self._in_flight.pop(clip_id)
+                if started_at is not None:
+                    metrics.observe("overlay.playback.played_ms", (now - started_at) * 1000)
+                metrics.incr("overlay.playback.clips", outcome=state)
+                if is_head:
+                    self._next_head()
+                await self._fill()
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._waiting.clear()
+        self._in_flight.clear()
+
+    def _next_head(self):
+        """The next clip sent gets its turn. Called with the lock held."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._in_flight:
+            return
+        self._head_since = time.monotonic()
+        head_started = next(iter(self._in_flight.values()))
+        self._arm_timer(self.start_timeout if head_started is None else self.finish_timeout)
+
+    async def _fill(self):
+        """Sends the clips that fit the window and haven't waited too long. Called with the lock held."""
+        batch = []
+        while self._waiting and len(self._in_flight) < self.window:
+            queued_at, event = self._waiting.popleft()
+            now = time.monotonic()
+            if now - queued_at > self.max_wait:
+                metrics.incr("overlay.playback.dropped", reason="stale")
+                continue
+            metrics.observe("overlay.playback.queue_wait_ms", (now - queued_at) * 1000)
+            self._in_flight[event["clip_id"]] = None
+            batch.append(event)
+
+        if not batch:
+            return
+        if len(self._in_flight) == len(batch):
+            self._next_head()
+        await self._send(batch)
+
+    def _arm_timer(self, timeout):
+        if self._timer is not None:
+            self._timer.cancel()
+        head = next(iter(self._in_flight))
+        self._timer = asyncio.create_task(self._time_out(head, timeout))
+
+    async def _time_out(self, clip_id, timeout):
+        await asyncio.sleep(timeout)
+        async with self._lock:
+            if not self._in_flight or clip_id != next(iter(self._in_flight)):
+                return
+            # cleared first, _next_head would cancel this very task
+            self._timer = None
+            self._in_flight.pop(clip_id)
+            metrics.incr("overlay.playback.clips", outcome="timeout")
+            self._next_head()
+            await self._fill()
@@ -0,0 +1,114 @@
+import time
+import logging
+import threading
+
+from django.conf import settings
+
+from twitch_bot.metrics import metrics
+
+logger = logging.getLogger('django')
+
+
+class OverlayPresence:
+    """
+    Which broadcasters have an overlay open. CheerEventConsumer registers its
+    socket on connect, refreshes it every heartbeat and removes it on
+    disconnect; the sockets of a process that died expire after `ttl` seconds.
+
+    Sockets live in redis sorted sets (member the channel name, score the
+    expiry) when a redis url is configured. Otherwise only the sockets of this
+    process are known and `shared` is False; the clips are generated in the
+    run_sfx_workers process, which never sees them, so every overlay is then
+    taken to be live and nothing is skipped or held back.
+    """
+
+    def __init__(self, ttl, redis_url=None, key_prefix="overlay:presence:"):
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self._sockets = {}
+        self._lock = threading.Lock()
+        self._redis = None
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(
+                redis_url,
+                socket_timeout=0.5,
+                socket_connect_timeout=0.5
+            )
+        metrics.register_collector("overlay_presence", lambda: {"connected": self.count()})
+
+    @property
+    def shared(self):
+        return self._redis is not None
+
+    def _key(self, user_id):
+        return self.key_prefix + user_id
+
+    def add(self, user_id, channel_name):
+        """Registers the socket, or extends it for another `ttl` seconds."""
+        expires_at = time.time() + self.ttl
+        if self._redis is None:
+            with self._lock:
+                self._sockets.setdefault(user_id, {})[channel_name] = expires_at
+            return
+
+        all_key = self._key("all")
+        try:
+            pipeline = self._redis.pipeline()
+            pipeline.zadd(self._key(user_id), {channel_name: expires_at})
+            pipeline.expire(self._key(user_id), self.ttl)
+            pipeline.zadd(all_key, {channel_name: expires_at})
+            pipeline.zremrangebyscore(all_key, "-inf", time.time())
+            pipeline.execute()
+        except Exception:
+            logger.warning("Overlay presence: redis unavailable.")
+
+    def remove(self, user_id, channel_name):
+        if self._redis is None:
+            with self._lock:
+                sockets = self._sockets.get(user_id, {})
+                sockets.pop(channel_name, None)
+                if not sockets:
+                    self._sockets.pop(user_id, None)
+            return
+
+        try:
+            pipeline = self._redis.pipeline()
+            pipeline.zrem(self._key(user_id), channel_name)
+            pipeline.zrem(self._key("all"), channel_name)
+            pipeline.execute()
+        except Exception:
+            logger.warning("Overlay presence: redis unavailable.")
+
+    def is_live(self, user_id):
+        """Whether an overlay of the broadcaster is connected. True when it can't be told."""
+        if self._redis is None:
+            # the overlay may be connected to another process
+            return True
+
+        now = time.time()
+        try:
+            return self._redis.zcount(self._key(user_id), now, "+inf") > 0
+        except Exception:
+            logger.warning("Overlay presence: redis unavailable, assuming the overlay is live.")
+            return True
+
+    def count(self):
+        """Connected overlays, across processes with redis."""
+        now = time.time()
+        if self._redis is None:
+            with self._lock:
+                return sum(
+                    expires_at > now for sockets in self._sockets.values() for expires_at in sockets.values()
+                )
+
+        try:
+            return self._redis.zcount(self._key("all"), now, "+inf")
+        except Exception:
+            return None
+
+
+overlay_presence = OverlayPresence(
+    ttl=settings.OVERLAY_PRESENCE_TTL,
+    redis_url=settings.REDIS_URL
+)
@@ -0,0 +1,34 @@
+import re
+import hashlib
+
+from .matching import CHEERMOTE_PATTERN
+
+CHEERMOTE_REGEX = re.compile(r"(?<!\S)" + CHEERMOTE_PATTERN)
+WHITESPACE_REGEX = re.compile(r"\s+")
+
+
+def canonicalize_prompt(message, command_prefixes=()):
+    """
+    Reduces a cheer message to the part that decides what the sound is:
+    no cheermotes, no command prefix, collapsed whitespace, casefolded.
+    "Cheer100 $FX  Airhorn" and "$fx airhorn" both become "airhorn".
+    """
+    prompt = CHEERMOTE_REGEX.sub(" ", message)
+    prompt = WHITESPACE_REGEX.sub(" ", prompt).strip().casefold()
+
+    for prefix in sorted(command_prefixes, key=len, reverse=True):
+        prefix = prefix.casefold()
+        if prompt.startswith(prefix):
+            prompt = prompt[len(prefix):].strip()
+            break
+
+    return prompt
+
+
+def prompt_cache_key(canonical_prompt, duration_seconds, prompt_influence):
+    key = "{prompt}|{duration}|{influence}".format(
+        prompt=canonical_prompt,
+        duration=float(duration_seconds),
+        influence=float(prompt_influence)
+    )
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
@@ -0,0 +1,290 @@
+import uuid
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Count, FloatField, Window
+from django.db.models.functions import Cast, RowNumber
+from django.utils import timezone
+
+from twitch_bot.metrics import metrics
+from .models import SfxGenerationJob, SfxDeadLetter, SoundEffectRequest
+from .constants import (
+    QUEUED_STATUS, 
+    RUNNING_STATUS, 
+    DONE_STATUS, 
+    FAILED_STATUS, 
+    LEASE_EXPIRED_FAILURE
+)
+from .failures import RETRYABLE_FAILURES, backoff_delay
+from .scheduling import schedule_fields
+
+logger = logging.getLogger('django')
+
+
+class SfxJobQueue:
+    """
+    Durable queue for sound effect generations backed by the SfxGenerationJob table.
+
+    Postgres claims rows with SELECT ... FOR UPDATE SKIP LOCKED so concurrent
+    workers never block on each other. SQLite (dev) has no row locks, there the
+    conditional status update acts as the compare-and-set and the lease id tells
+    each worker which rows it actually won.
+
+    Claims follow weighted fair queuing: broadcasters take turns (a broadcaster
+    with weight 2 gets two turns for every one of a weight 1 broadcaster), and
+    within a broadcaster jobs run by rank_at, see main.scheduling.
+    """
+
+    @staticmethod
+    def build_job(user_id, cheer_event_log, send_to_consumers, billing_plan):
+        """Unsaved job with its scheduling fields, for enqueue_many."""
+        fields = schedule_fields(cheer_event_log.bits, billing_plan)
+        return SfxGenerationJob(
+            user_id=user_id,
+            cheer_event_log=cheer_event_log,
+            send_to_consumers=send_to_consumers,
+            give_up_at=fields["available_at"] + timedelta(seconds=settings.SFX_JOB_RETRY_DEADLINE),
+            **fields
+        )
+
+    @staticmethod
+    def enqueue(user, cheer_event_log, send_to_consumers=True):
+        job = SfxJobQueue.build_job(user.id, cheer_event_log, send_to_consumers, user.billing_plan)
+        job.save()
+        return job
+
+    @staticmethod
+    def enqueue_many(jobs):
+        """Bulk enqueues unsaved SfxGenerationJob instances."""
+        return SfxGenerationJob.objects.bulk_create(jobs)
+
+    @staticmethod
+    def claim(worker_id, limit=1, exclude_user_ids=()):
+        """
+        Leases up to `limit` due jobs to this worker. Jobs of `exclude_user_ids`
+        (broadcasters already at their concurrency cap here) are left for others.
+        """
+        now = timezone.now()
+        lease_id = uuid.uuid4()
+
+        candidates = SfxGenerationJob.objects.filter(
+            status=QUEUED_STATUS,
+            available_at__lte=now
+        )
+        if exclude_user_ids:
+            candidates = candidates.exclude(user_id__in=exclude_user_ids)
+
+        # n-th job of a broadcaster finishes its turn at n / weight, earliest turns go first.
+        # Over-fetched since other workers may lock some of them before we do.
+        fair_order = list(
+            candidates.annotate(
+                turn=Window(
+                    RowNumber(),
+                    partition_by=[F("user_id")],
+                    order_by=[F("rank_at").asc(), F("id").asc()]
+                )
+            ).annotate(
+                virtual_finish=Cast(F("turn"), FloatField()) / F("weight")
+            ).order_by(
+                "virtual_finish", "rank_at"
+            ).values_list("id", flat=True)[:limit * 4]
+        )
+        if not fair_order:
+            return []
+
+        with transaction.atomic():
+            # window functions can't be combined with FOR UPDATE, the rows are locked in a second query
+            available = SfxGenerationJob.objects.filter(id__in=fair_order, status=QUEUED_STATUS)
+            if connection.features.has_select_for_update_skip_locked:
+                available = available.select_for_update(skip_locked=True)
+            available_ids = set(available.values_list("id", flat=True))
+
+            ids = [job_id for job_id in fair_order if job_id in available_ids][:limit]
+            if not ids:
+                return []
+
+            SfxGenerationJob.objects.filter(id__in=ids, status=QUEUED_STATUS).update(
+                status=RUNNING_STATUS,
+                lease_id=lease_id,
+                locked_by=worker_id,
+                locked_until=now + timedelta(seconds=settings.SFX_JOB_VISIBILITY_TIMEOUT),
+                attempts=F("attempts") + 1
+            )
+
+        jobs = list(
+            SfxGenerationJob.objects.filter(lease_id=lease_id).select_related(
+                "user",
+                "cheer_event_log"
+            )
+        )
+        for job in jobs:
+            metrics.observe(
+                "sfx.queue.wait_seconds",
+                (now - job.available_at).total_seconds(),
+                channel=str(job.user_id)
+            )
+        return jobs
+
+    @staticmethod
+    def extend_leases(jobs):
+        """
+        Pushes the visibility timeout of jobs still running here forward, so
+        recover_expired doesn't hand them to another worker while they wait on
+        the engine's limits. Returns how many leases were still held.
+        """
+        if not jobs:
+            return 0
+        return SfxGenerationJob.objects.filter(
+            id__in=[job.id for job in jobs],
+            lease_id__in={job.lease_id for job in jobs},
+            status=RUNNING_STATUS
+        ).update(
+            locked_until=timezone.now() + timedelta(seconds=settings.SFX_JOB_VISIBILITY_TIMEOUT)
+        )
+
+    @staticmethod
+    def complete(job):
+        """Marks the job as done. Returns False if the lease expired and another worker took it."""
+        updated = SfxGenerationJob.objects.filter(id=job.id, lease_id=job.lease_id).update(
+            status=DONE_STATUS,
+            lease_id=None,
+            locked_until=None,
+            finished_at=timezone.now()
+        )
+        return bool(updated)
+
+    @staticmethod
+    def fail(job, failure_class, error=""):
+        """
+        Records the failed attempt. Retryable failures go back in the queue after an
+        exponential backoff, as long as the job has attempts left and the retry
+        still lands before give_up_at. Anything else is dead lettered: the job is
+        marked failed, an SfxDeadLetter keeps its history and the cheer gets a
+        failed SoundEffectRequest for the dashboard.
+        Returns True when the job was dead lettered.
+        """
+        now = timezone.now()
+        error = str(error)[:1000]
+        attempt_history = job.attempt_history + [{
+            "attempt": job.attempts,
+            "at": now.isoformat(),
+            "failure_class": failure_class,
+            "error": error,
+        }]
+        retry_at = now + timedelta(seconds=backoff_delay(job.attempts))
+        retryable = (
+            failure_class in RETRYABLE_FAILURES
+            and job.attempts < settings.SFX_JOB_MAX_ATTEMPTS
+            and (job.give_up_at is None or retry_at < job.give_up_at)
+        )
+        owned = SfxGenerationJob.objects.filter(id=job.id, lease_id=job.lease_id)
+
+        if retryable:
+            owned.update(
+                status=QUEUED_STATUS,
+                lease_id=None,
+                locked_by="",
+                locked_until=None,
+                available_at=retry_at,
+                last_error=error,
+                attempt_history=attempt_history
+            )
+            return False
+
+        with transaction.atomic():
+            updated = owned.update(
+                status=FAILED_STATUS,
+                lease_id=None,
+                locked_until=None,
+                finished_at=now,
+                last_error=error,
+                attempt_history=attempt_history
+            )
+            if not updated:
+                # lease lost, whoever holds the job now decides
+                return False
+            SfxDeadLetter.objects.create(
+                user_id=job.user_id,
+                cheer_event_log_id=job.cheer_event_log_id,
+                job_id=job.id,
+                failure_class=failure_class,
+                reason=error,
+                attempts=job.attempts,
+                attempt_history=attempt_history
+            )
+            SoundEffectRequest.objects.create(
+                cheer_event_log_id=job.cheer_event_log_id,
+                status=FAILED_STATUS,
+                is_metered=False,
+                failed_reason="Failed trying to generate sfx."
+            )
+
+        logger.warning("SFX queue: job {id} dead lettered after {n} attempts ({failure_class}).".format(
+            id=job.id,
+            n=job.attempts,
+            failure_class=failure_class
+        ))
+        return True
+
+    @staticmethod
+    def defer(job, delay, reason=""):
+        """
+        Puts the job back in the queue to run after `delay` seconds, without using
+        up an attempt. For upstream rate limits, which say nothing about the job.
+        """
+        updated = SfxGenerationJob.objects.filter(id=job.id, lease_id=job.lease_id).update(
+            status=QUEUED_STATUS,
+            lease_id=None,
+            locked_by="",
+            locked_until=None,
+            available_at=timezone.now() + timedelta(seconds=delay),
+            attempts=F("attempts") - 1,
+            last_error=reason
+        )
+        return bool(updated)
+
+    @staticmethod
+    def recover_expired():
+        """
+        Releases jobs whose worker died (or hung) past the visibility timeout.
+        Jobs that already used all their attempts are dead lettered instead.
+        """
+        now = timezone.now()
+        expired = SfxGenerationJob.objects.filter(
+            status=RUNNING_STATUS,
+            locked_until__lt=now
+        )
+        failed = 0
+        for job in expired.filter(attempts__gte=settings.SFX_JOB_MAX_ATTEMPTS):
+            if SfxJobQueue.fail(job, LEASE_EXPIRED_FAILURE, "Worker lease expired too many times."):
+                failed += 1
+        requeued = expired.update(
+            status=QUEUED_STATUS,
+            lease_id=None,
+            locked_by="",
+            locked_until=None,
+            available_at=now
+        )
+        if failed or requeued:
+            logger.warning(
+                "SFX queue: recovered {requeued} expired jobs, {failed} gave up.".format(
+                    requeued=requeued,
+                    failed=failed
+                )
+            )
+        return requeued
+
+    @staticmethod
+    def queue_depths(limit=50):
+        """Queued jobs per broadcaster, deepest first."""
+        rows = SfxGenerationJob.objects.filter(
+            status=QUEUED_STATUS
+        ).values("user_id").annotate(
+            depth=Count("id")
+        ).order_by("-depth")[:limit]
+        return {str(row["user_id"]): row["depth"] for row in rows}
+
+
+metrics.register_collector("sfx_queue_depth", SfxJobQueue.queue_depths)
@@ -0,0 +1,140 @@
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+logger = logging.getLogger('django')
+
+
+class OverlayEventLog:
+    """
+    The last `size` overlay events of each broadcaster, numbered with a per
+    broadcaster sequence. The channel layer keeps no history, an overlay that
+    reconnects (OBS reloading the browser source, a dropped socket) asks for
+    the events after the last sequence it saw and they are played again.
+
+    Events live in redis (a capped list per broadcaster, expiring after
+    max_age seconds) when a redis url is configured, in this process otherwise,
+    for at most max_channels broadcasters. Recording is O(1) either way.
+
+    A broadcaster whose log expired starts over from sequence 1, an overlay
+    asking for a sequence past the current one gets the whole log.
+    """
+
+    def __init__(self, size, max_age, max_channels, redis_url=None, key_prefix="overlay:events:"):
+        self.size = size
+        self.max_age = max_age
+        self.max_channels = max_channels
+        self.key_prefix = key_prefix
+        self._channels = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = None
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(
+                redis_url,
+                socket_timeout=0.5,
+                socket_connect_timeout=0.5
+            )
+
+    def _keys(self, channel):
+        return self.key_prefix + channel + ":seq", self.key_prefix + channel
+
+    def _local(self, channel):
+        """This process' log of the channel, evicting the least recently used ones. Called with the lock held."""
+        log = self._channels.get(channel)
+        if log is None:
+            log = self._channels[channel] = {"seq": 0, "events": deque(maxlen=self.size)}
+            while len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+        self._channels.move_to_end(channel)
+        return log
+
+    def next_seq(self, channel):
+        """Sequence number of the channel's next event, None when the log is unavailable."""
+        if self._redis is None:
+            with self._lock:
+                log = self._local(channel)
+                log["seq"] += 1
+                return log["seq"]
+
+        seq_key, _ = self._keys(channel)
+        try:
+            pipeline = self._redis.pipeline()
+            pipeline.incr(seq_key)
+            pipeline.expire(seq_key, self.max_age)
+            return pipeline.execute()[0]
+        except Exception:
+            logger.warning("Overlay replay: redis unavailable, the event can't be replayed.")
+            return None
+
+    def record(self, channel, seq, event):
+        entry = {"seq": seq, "at": time.time(), "event": event}
+        if self._redis is None:
+            with self._lock:
+                self._local(channel)["events"].append(entry)
+            return
+
+        _, events_key = self._keys(channel)
+        try:
+            pipeline = self._redis.pipeline()
+            pipeline.lpush(events_key, json.dumps(entry))
+            pipeline.ltrim(events_key, 0, self.size - 1)
+            pipeline.expire(events_key, self.max_age)
+            pipeline.execute()
+        except Exception:
+            logger.warning("Overlay replay: redis unavailable, the event can't be replayed.")
+
+    def head(self, channel):
+        """Last sequence number handed out for the channel, 0 when there is none."""
+        if self._redis is None:
+            with self._lock:
+                log = self._channels.get(channel)
+                return log["seq"] if log else 0
+
+        seq_key, _ = self._keys(channel)
+        try:
+            return int(self._redis.get(seq_key) or 0)
+        except Exception:
+            logger.warning("Overlay replay: redis unavailable.")
+            return 0
+
+    def since(self, channel, last_seq):
+        """Events of the channel after last_seq and younger than max_age, oldest first."""
+        if self._redis is None:
+            with self._lock:
+                log = self._channels.get(channel)
+                entries = list(log["events"]) if log else []
+                head = log["seq"] if log else 0
+        else:
+            seq_key, events_key = self._keys(channel)
+            try:
+                pipeline = self._redis.pipeline()
+                pipeline.get(seq_key)
+                pipeline.lrange(events_key, 0, -1)
+                head, raw_entries = pipeline.execute()
+            except Exception:
+                logger.warning("Overlay replay: redis unavailable, nothing to replay.")
+                return []
+            head = int(head or 0)
+            entries = [json.loads(raw_entry) for raw_entry in raw_entries]
+
+        if last_seq > head:
+            # seen before the log expired and started over
+            last_seq = 0
+        oldest = time.time() - self.max_age
+        return [
+            entry["event"] for entry in sorted(entries, key=lambda entry: entry["seq"])
+            if entry["seq"] > last_seq and entry["at"] >= oldest
+        ]
+
+
+overlay_events = OverlayEventLog(
+    size=settings.OVERLAY_REPLAY_SIZE,
+    max_age=settings.OVERLAY_REPLAY_MAX_AGE,
+    max_channels=settings.OVERLAY_REPLAY_MAX_CHANNELS,
+    redis_url=settings.REDIS_URL
+)
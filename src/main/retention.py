@@ -0,0 +1,275 @@
+import logging
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from twitch_bot.metrics import metrics
+from .constants import STORAGE_TIER_HOT, STORAGE_TIER_ARCHIVE
+from .models import StoredSfxFile, SoundEffectRequest, GeneratedAudio
+from .storage import INCOMING_PREFIX, move_file
+
+logger = logging.getLogger('django')
+
+
+def _references():
+    """Every column pointing at a stored file, as (queryset, field)."""
+    return [
+        (SoundEffectRequest.objects.exclude(generated_file__isnull=True).exclude(generated_file=""), "generated_file"),
+        (GeneratedAudio.objects.exclude(file=""), "file"),
+    ]
+
+
+def _batches(queryset, key, batch_size):
+    """Distinct values of `key`, in order, batch_size at a time. Pages on the key instead of an OFFSET."""
+    last = None
+    while True:
+        page = queryset if last is None else queryset.filter(**{key + "__gt": last})
+        values = list(page.order_by(key).values_list(key, flat=True).distinct()[:batch_size])
+        if not values:
+            return
+        yield values
+        last = values[-1]
+
+
+class StoredSfxFiles:
+    """
+    Reference counts of the stored files, kept as requests and cache entries
+    start or stop pointing at them. Writes that bypass them (bulk creates,
+    cascading deletes) are caught up by SfxStorageSweeper.recount.
+    """
+
+    @staticmethod
+    def acquire(name, size=0):
+        if not name:
+            return
+        now = timezone.now()
+        referenced = StoredSfxFile.objects.filter(name=name)
+        if referenced.update(references=F("references") + 1, last_referenced_at=now):
+            return
+        try:
+            with transaction.atomic():
+                StoredSfxFile.objects.create(name=name, size=size, references=1, last_referenced_at=now)
+        except IntegrityError:
+            # created by another worker in between
+            referenced.update(references=F("references") + 1, last_referenced_at=now)
+
+    @staticmethod
+    def release(name, count=1):
+        if name:
+            StoredSfxFile.objects.filter(name=name).update(references=F("references") - count)
+
+    @staticmethod
+    def touch(name):
+        """Marks the file as used, sent again from the dashboard. Keeps it out of the archive."""
+        if name:
+            StoredSfxFile.objects.filter(name=name).update(last_referenced_at=timezone.now())
+
+
+class SfxStorageSweeper:
+    """
+    Retention policy for the generated files, applied by manage.py gc_sfx_storage:
+
+    - sound effects of broadcasters on a plan in retention_days_by_plan lose
+      their file after that many days, the request row stays for history and
+      billing;
+    - files nothing referenced or sent again for archive_after_days move
+      under archive_prefix, where the storage gives them a cheaper storage
+      class;
+    - files nothing references anymore, and uploads abandoned halfway, are
+      deleted once they are older than grace_seconds.
+
+    The tables are walked batch_size rows at a time.
+    """
+
+    def __init__(self, storage=None, batch_size=None, retention_days_by_plan=None, archive_after_days=None,
+                 archive_prefix=None, grace_seconds=None):
+        self.storage = storage or default_storage
+        self.batch_size = batch_size or settings.SFX_STORAGE_GC_BATCH_SIZE
+        self.retention_days_by_plan = (
+            settings.SFX_RETENTION_DAYS_BY_PLAN if retention_days_by_plan is None else retention_days_by_plan
+        )
+        self.archive_after_days = settings.SFX_ARCHIVE_AFTER_DAYS if archive_after_days is None else archive_after_days
+        self.archive_prefix = archive_prefix or settings.SFX_ARCHIVE_PREFIX
+        self.grace_seconds = settings.SFX_STORAGE_GC_GRACE_SECONDS if grace_seconds is None else grace_seconds
+        self.now = timezone.now()
+
+    def run(self):
+        stats = {
+            "recounted": self.recount(),
+            "expired": self.expire_requests(),
+            "archived": self.archive_cold_files(),
+            "deleted": self.collect_garbage(),
+            "incoming": self.purge_incoming(),
+        }
+        logger.info("SFX storage: {stats}.".format(stats=stats))
+        return stats
+
+    def _count_references(self, names):
+        counts = dict.fromkeys(names, 0)
+        for queryset, field in _references():
+            rows = queryset.filter(**{field + "__in": names}).order_by().values(field).annotate(n=Count("pk"))
+            for row in rows:
+                counts[row[field]] += row["n"]
+        return counts
+
+    def recount(self):
+        """
+        Sets every file's reference count from the tables, adding the files
+        stored before reference counting. Returns how many counts were wrong.
+
+        Only the count is written, a file referenced again during the recount
+        has a fresh last_referenced_at and is not collected before the next one.
+        """
+        for queryset, field in _references():
+            for names in _batches(queryset, field, self.batch_size):
+                StoredSfxFile.objects.bulk_create(
+                    [StoredSfxFile(name=name, references=0) for name in names],
+                    ignore_conflicts=True
+                )
+
+        corrected = 0
+        for names in _batches(StoredSfxFile.objects.all(), "name", self.batch_size):
+            counts = self._count_references(names)
+            stale = [
+                stored for stored in StoredSfxFile.objects.filter(name__in=names)
+                if stored.references != counts[stored.name]
+            ]
+            for stored in stale:
+                stored.references = counts[stored.name]
+            StoredSfxFile.objects.bulk_update(stale, ["references"])
+            corrected += len(stale)
+        return corrected
+
+    def expire_requests(self):
+        """Drops the files of sound effects older than their broadcaster's plan keeps them. Returns the count."""
+        expired = 0
+        for plan, days in self.retention_days_by_plan.items():
+            sfx_requests = SoundEffectRequest.objects.filter(
+                cheer_event_log__internal_broadcaster_user__billing_plan=plan,
+                timestamp__lt=self.now - timedelta(days=days)
+            ).exclude(
+                generated_file__isnull=True
+            ).exclude(
+                generated_file=""
+            )
+            while True:
+                batch = list(sfx_requests.values_list("id", "generated_file")[:self.batch_size])
+                if not batch:
+                    break
+                SoundEffectRequest.objects.filter(id__in=[id for id, _ in batch]).update(generated_file=None)
+                for name, count in Counter(name for _, name in batch).items():
+                    StoredSfxFiles.release(name, count)
+                expired += len(batch)
+
+        if expired:
+            metrics.incr("sfx.storage.expired", value=expired)
+        return expired
+
+    def archive_name(self, name):
+        # sfx_files/ab/<hash>.mp3 -> sfx_files/archive/ab/<hash>.mp3
+        return self.archive_prefix + name.split("/", 1)[-1]
+
+    def archive_cold_files(self):
+        """Moves files nothing referenced or sent again lately to the archive prefix. Returns the count."""
+        if not self.archive_after_days:
+            return 0
+        cutoff = self.now - timedelta(days=self.archive_after_days)
+        cold = StoredSfxFile.objects.filter(
+            tier=STORAGE_TIER_HOT,
+            references__gt=0,
+            last_referenced_at__lt=cutoff
+        )
+
+        archived = 0
+        for ids in _batches(cold, "id", self.batch_size):
+            for stored in StoredSfxFile.objects.filter(id__in=ids):
+                if self._archive(stored, cutoff):
+                    archived += 1
+        return archived
+
+    def _archive(self, stored, cutoff):
+        # claimed first, a file played again since the batch was read stays hot
+        if not StoredSfxFile.objects.filter(id=stored.id, last_referenced_at__lt=cutoff).update(tier=STORAGE_TIER_ARCHIVE):
+            return False
+
+        new_name = self.archive_name(stored.name)
+        try:
+            move_file(self.storage, stored.name, new_name)
+        except Exception:
+            StoredSfxFile.objects.filter(id=stored.id).update(tier=STORAGE_TIER_HOT)
+            metrics.incr("sfx.storage.archive_failures")
+            logger.exception("SFX storage: failed to archive {name}.".format(name=stored.name))
+            return False
+
+        with transaction.atomic():
+            SoundEffectRequest.objects.filter(generated_file=stored.name).update(generated_file=new_name)
+            GeneratedAudio.objects.filter(file=stored.name).update(file=new_name)
+            archived = StoredSfxFile.objects.filter(name=new_name)
+            if archived.exists():
+                # the same audio was archived before, the rows now share that file
+                archived.update(references=F("references") + stored.references)
+                StoredSfxFile.objects.filter(id=stored.id).delete()
+            else:
+                StoredSfxFile.objects.filter(id=stored.id).update(name=new_name)
+        metrics.incr("sfx.storage.archived")
+        return True
+
+    def collect_garbage(self):
+        """Deletes the files nothing references, once past the grace period. Returns the count."""
+        cutoff = self.now - timedelta(seconds=self.grace_seconds)
+        garbage = StoredSfxFile.objects.filter(references__lte=0, last_referenced_at__lt=cutoff)
+
+        deleted = 0
+        for ids in _batches(garbage, "id", self.batch_size):
+            for id in ids:
+                try:
+                    if self._delete(garbage, id):
+                        deleted += 1
+                except Exception:
+                    # the row is kept, the next sweep tries again
+                    logger.exception("SFX storage: failed to delete {id}.".format(id=id))
+
+        if deleted:
+            metrics.incr("sfx.storage.deleted", value=deleted)
+        return deleted
+
+    def _delete(self, garbage, id):
+        """
+        Deletes the file with its row locked. A save deduplicating onto the file
+        references it before checking it is stored (see save_content_addressed),
+        either that waits for the delete and stores the file again, or the
+        count is no longer zero here.
+        """
+        with transaction.atomic():
+            stored = garbage.select_for_update().filter(id=id).first()
+            if stored is None:
+                return False
+            self.storage.delete(stored.name)
+            stored.delete()
+        return True
+
+    def purge_incoming(self):
+        """Deletes temporary uploads left in the incoming prefix by a worker that died while saving."""
+        cutoff = self.now - timedelta(seconds=self.grace_seconds)
+        try:
+            _, filenames = self.storage.listdir(INCOMING_PREFIX)
+        except FileNotFoundError:
+            return 0
+
+        purged = 0
+        for filename in filenames:
+            name = INCOMING_PREFIX + filename
+            try:
+                if self.storage.get_modified_time(name) >= cutoff:
+                    continue
+                self.storage.delete(name)
+            except FileNotFoundError:
+                # moved to its content key in the meantime
+                continue
+            purged += 1
+        return purged
@@ -0,0 +1,35 @@
+import math
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+
+def job_priority(bits, billing_plan):
+    """
+    Head start of a generation job in seconds. Jobs run in order of
+    `available_at - priority`, so a bigger cheer or a paid plan jumps ahead
+    of newer work, but never ahead of work that has waited longer than that.
+    """
+    bits_bonus = settings.SFX_PRIORITY_SECONDS_PER_BITS_DOUBLING * math.log2(
+        max(bits, settings.SFX_PRIORITY_BASE_BITS) / settings.SFX_PRIORITY_BASE_BITS
+    )
+    plan_bonus = settings.SFX_PLAN_PRIORITY_SECONDS.get(billing_plan, 0)
+    return min(bits_bonus + plan_bonus, settings.SFX_PRIORITY_MAX_SECONDS)
+
+
+def job_weight(billing_plan):
+    """Share of the workers a broadcaster gets when several channels have queued work."""
+    return settings.SFX_PLAN_WEIGHTS.get(billing_plan, 1.0)
+
+
+def schedule_fields(bits, billing_plan, available_at=None):
+    """Scheduling columns for a new SfxGenerationJob."""
+    available_at = available_at or timezone.now()
+    priority = job_priority(bits, billing_plan)
+    return {
+        "available_at": available_at,
+        "priority": priority,
+        "rank_at": available_at - timedelta(seconds=priority),
+        "weight": job_weight(billing_plan),
+    }
@@ -1,18 +1,45 @@
 import hmac
+import time
+import uuid
 import hashlib
-import after_response
 import json
 import logging 
+from django.conf import settings
 from django.core.files.base import ContentFile, File
-from allauth.socialaccount.models import SocialAccount
+from django.db import transaction
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from secrets import compare_digest
-from twitch_bot.client import elevenlabs_create_sfx
 from .models import SoundEffectRequest, CheerEventLogEntry, AlertPreferences
+from .queue import SfxJobQueue
+from .broadcasters import broadcaster_routes
+from .matching import parse_command_prefixes
+from .prompts import canonicalize_prompt, prompt_cache_key
+from .audio_cache import GeneratedAudioCache
+from .deadlines import cheer_deadline, is_expired, record_shed
+from .fastclips import fast_clips
+from .replay import overlay_events
+from .presence import overlay_presence
+from .storage import save_content_addressed
+from .retention import StoredSfxFiles
 from twitch_bot.constants import *
 from twitch_bot.exceptions import ElevenLabsApiError
-from .constants import NEW_STATUS, IGNORED_STATUS, FAILED_STATUS, DONE_STATUS
+from twitch_bot.metrics import metrics
+from .constants import (
+    NEW_STATUS, 
+    IGNORED_STATUS, 
+    FAILED_STATUS, 
+    DONE_STATUS,
+    SHED_STATUS,
+    SHED_AT_INGEST,
+    SHED_AT_DELIVERY,
+    STALE_CHEER_SKIP,
+    SFX_DURATION_SECONDS,
+    SFX_PROMPT_INFLUENCE
+)
 from billing.services import BillingService
 
 logger = logging.getLogger('django')
@@ -27,14 +54,18 @@ class TwitchWebhookHandler:
 
 
     def is_verified(self):
-        message_id = self.headers[WEBHOOK_ID_HEADER]
-        message_timestamp = self.headers[WEBHOOK_TIMESTAMP_HEADER]
-        message_signature = self.headers[WEBHOOK_SIGNATURE_HEADER]
-        
-        local_message = message_id + message_timestamp + bytes.decode(self.body, 'utf-8')
-        local_message_bytes = bytes(local_message, 'utf-8')
-        key = bytes(self.secret, 'utf-8')
-        local_message_signature = "sha256=" + hmac.new(key, local_message_bytes, hashlib.sha256).hexdigest()
+        """Checks the HMAC over the raw body bytes, before anything is parsed."""
+        message_id = self.headers.get(WEBHOOK_ID_HEADER)
+        message_timestamp = self.headers.get(WEBHOOK_TIMESTAMP_HEADER)
+        message_signature = self.headers.get(WEBHOOK_SIGNATURE_HEADER)
+        if not (message_id and message_timestamp and message_signature):
+            return False
+
+        local_message = hmac.new(bytes(self.secret, 'utf-8'), digestmod=hashlib.sha256)
+        local_message.update(bytes(message_id, 'utf-8'))
+        local_message.update(bytes(message_timestamp, 'utf-8'))
+        local_message.update(self.body)
+        local_message_signature = "sha256=" + local_message.hexdigest()
 
         return compare_digest(bytes(message_signature, 'utf-8'), bytes(local_message_signature, 'utf-8'))
 
@@ -44,6 +75,22 @@ class TwitchWebhookHandler:
         return event_type == "webhook_callback_verification"
 
 
+    def get_message_id(self):
+        return self.headers[WEBHOOK_ID_HEADER]
+
+
+    def get_message_timestamp(self):
+        return parse_datetime(self.headers[WEBHOOK_TIMESTAMP_HEADER])
+
+
+    def is_fresh(self, max_age):
+        """Twitch recommends dropping messages older than 10 minutes to prevent replays."""
+        message_timestamp = self.get_message_timestamp()
+        if message_timestamp is None:
+            return False
+        return abs((timezone.now() - message_timestamp).total_seconds()) <= max_age
+
+
     def is_duplicate(self):
         if self.headers.get(WEBHOOK_RESEND_HEADER, False):
             return True
@@ -52,103 +99,194 @@ class TwitchWebhookHandler:
 class SoundEffectRequestService:
 
     @staticmethod
-    def _send_event_to_consumers(sfx_source, user_id, cheer_log):
+    def _send_event_to_consumers(sfx_source, user_id, cheer_log, enforce_deadline=True, duration=None,
+                                 fast_until=None):
+        """
+        Plays the sound on the broadcaster's overlays, `duration` in seconds when
+        known. A fast path clip's source is gone after `fast_until`, a clip sent
+        later gets the stored file instead. Returns False when the cheer is past
+        its deadline.
+        """
+        if enforce_deadline and is_expired(cheer_log):
+            record_shed(cheer_log, SHED_AT_DELIVERY)
+            return False
+
         channel_layer = get_channel_layer()
+        # acked by the overlay when it starts and finishes playing, see main.playback
+        clip_id = uuid.uuid4().hex
+        # overlays that reconnect get the events after the last sequence they saw, see main.replay
+        seq = overlay_events.next_seq(user_id)
         event = {
             "type": "play_sfx",
-            "sfx_source": sfx_source,
-            "username": cheer_log.user_name if not cheer_log.is_anonymous else "Anonymous",
-            "prompt": cheer_log.message,
-            "bits": cheer_log.bits
+            "seq": seq,
+            "clip_id": clip_id,
+            "cheer": str(cheer_log.id),
+            "fast_until": fast_until,
+            # what the overlay gets, see OVERLAY_PROTOCOL_VERSION in main.consumers
+            "message": {
+                "seq": seq,
+                "clip": clip_id,
+                "url": sfx_source,
+                "duration": duration,
+                "user": cheer_log.user_name if not cheer_log.is_anonymous else "Anonymous",
+                "prompt": cheer_log.message,
+                "bits": cheer_log.bits
+            }
         }
+        if seq is not None:
+            # a fast path clip is replayed from its stored file, found again by the cheer id
+            overlay_events.record(user_id, seq, event)
+        if not overlay_presence.is_live(user_id):
+            # nobody would get it, an overlay connecting later replays it
+            metrics.incr("overlay.fanout.skipped")
+            return True
         async_to_sync(channel_layer.group_send)(
             user_id, event
         )
+        return True
 
 
     @staticmethod
-    def _validate_cheer_with_preferences(alert_preferences, cheer_event_data):
-        command_string_length = len(alert_preferences.command_string)
-        command_validated = True
-        bits_validated = cheer_event_data["bits"] >= alert_preferences.min_bits
-
-        if alert_preferences.match_command and command_string_length:
-            command_validated = alert_preferences.command_string != "" and cheer_event_data["message"].startsWith(
-                alert_preferences.command_string, 
-                0, 
-                command_string_length
+    def save_cheer_events(ingest_events):
+        """
+        Persists a micro-batch of webhook cheer notifications with one bulk insert
+        and enqueues the generations for the ones that match preferences.
+        """
+        if not ingest_events:
+            return []
+
+        routes = broadcaster_routes.get_many(
+            {e.event_data["broadcaster_user_id"] for e in ingest_events}
+        )
+
+        cheer_event_logs = []
+        jobs = []
+        batch_message_ids = set()
+        for ingest_event in ingest_events:
+            if ingest_event.twitch_message_id in batch_message_ids:
+                continue
+            batch_message_ids.add(ingest_event.twitch_message_id)
+
+            route = routes[ingest_event.event_data["broadcaster_user_id"]]
+            if route is None:
+                logger.warning("Twitch webhook: Missing social account for twitch user.")
+                continue
+
+            meets_requirements = route.matcher.matches(
+                ingest_event.event_data["bits"],
+                ingest_event.event_data["message"]
             )
+            cheer_event_log = CheerEventLogEntry(
+                internal_broadcaster_user_id=route.user_id, 
+                twitch_message_id=ingest_event.twitch_message_id,
+                status=NEW_STATUS if meets_requirements else IGNORED_STATUS,
+                deadline=cheer_deadline(ingest_event.message_timestamp),
+                **ingest_event.event_data
+            )
+            cheer_event_logs.append(cheer_event_log)
+
+            if not (meets_requirements and route.auto_generate):
+                continue
 
-        if alert_preferences.match_bits:
-            bits_validated = cheer_event_data["bits"] == alert_preferences.min_bits
+            send_to_consumers = route.auto_play
+            if send_to_consumers and is_expired(cheer_event_log):
+                # already too old when it reached us, Twitch retried it or ingest fell behind
+                cheer_event_log.shed_stage = SHED_AT_INGEST
+                if route.stale_cheer_policy == STALE_CHEER_SKIP:
+                    cheer_event_log.status = SHED_STATUS
+                    metrics.incr("sfx.deadline.shed", stage=SHED_AT_INGEST, outcome="skipped")
+                    continue
+                metrics.incr("sfx.deadline.shed", stage=SHED_AT_INGEST, outcome="not_played")
+                send_to_consumers = False
+
+            jobs.append(SfxJobQueue.build_job(
+                route.user_id,
+                cheer_event_log,
+                send_to_consumers,
+                route.billing_plan
+            ))
+
+        with transaction.atomic():
+            # retries that slipped past the dedup cache hit the unique index and are skipped here
+            CheerEventLogEntry.objects.bulk_create(cheer_event_logs, ignore_conflicts=True)
+            inserted_ids = set(
+                CheerEventLogEntry.objects.filter(
+                    id__in=[log.id for log in cheer_event_logs]
+                ).values_list("id", flat=True)
+            )
+            SfxJobQueue.enqueue_many([job for job in jobs if job.cheer_event_log.id in inserted_ids])
+
+        duplicates = len(cheer_event_logs) - len(inserted_ids)
+        if duplicates:
+            logger.info("Twitch webhook: {n} duplicate event messages already handled.".format(n=duplicates))
+
+        return [log for log in cheer_event_logs if log.id in inserted_ids]
 
-        return command_validated and bits_validated
-        
 
     @staticmethod
-    def save_cheer_event(user, alert_preferences, cheer_event_data, twitch_message_id):
-        meets_requirements = SoundEffectRequestService._validate_cheer_with_preferences(
-            alert_preferences, 
-            cheer_event_data
-        )
-        status = NEW_STATUS if meets_requirements else IGNORED_STATUS
+    def _find_cached_audio(user, cheer_event_log):
+        """
+        Looks for stored audio this cheer can reuse, following the broadcaster's preferences.
+        Returns (cached_audio, canonical_prompt, prompt_key); the key is None when reuse is disabled.
+        """
+        alert_preferences = AlertPreferences.objects.filter(user=user).first()
+        if alert_preferences is None or not alert_preferences.reuse_cached_audio:
+            return None, None, None
 
-        cheer_event_log = CheerEventLogEntry.objects.create(
-            internal_broadcaster_user=user, 
-            twitch_message_id=twitch_message_id,
-            status=status,
-            **cheer_event_data
+        canonical_prompt = canonicalize_prompt(
+            cheer_event_log.message,
+            parse_command_prefixes(alert_preferences.command_string)
         )
-        return cheer_event_log, meets_requirements
-    
+        if not canonical_prompt:
+            return None, None, None
 
-    @staticmethod
-    @after_response.enable
-    def generate_sfx(user, cheer_event_log, send_to_consumers=True):
-        
-        if not BillingService._is_valid_billing_status(user):
-            sfx_request = SoundEffectRequest.objects.create(
-                cheer_event_log=cheer_event_log,
-                status=FAILED_STATUS,
-                is_metered=False,
-                failed_reason="Not enough credits. Upgrade billing plan."
-            )
-            return sfx_request
-        
-        try:
-            response = elevenlabs_create_sfx(
-                cheer_event_log.message,
-                duration_seconds=4
-            )
-        except ElevenLabsApiError:
-            logger.error("Sound Effect Generation: API call to elevenlabs failed.")
-            sfx_request = SoundEffectRequest.objects.create(
-                cheer_event_log=cheer_event_log,
-                status=FAILED_STATUS,
-                is_metered=False,
-                failed_reason="Failed trying to generate sfx."
+        prompt_key = prompt_cache_key(
+            canonical_prompt, 
+            SFX_DURATION_SECONDS, 
+            SFX_PROMPT_INFLUENCE
+        )
+        cached_audio = GeneratedAudioCache.lookup(prompt_key)
+        if cached_audio is None and alert_preferences.reuse_similar_audio:
+            cached_audio = GeneratedAudioCache.lookup_similar(
+                canonical_prompt,
+                SFX_DURATION_SECONDS, 
+                SFX_PROMPT_INFLUENCE
             )
-            return sfx_request
 
-        file = response.content 
-        
+        return cached_audio, canonical_prompt, prompt_key
+
+
+    @staticmethod
+    def _finish_sfx_request(user, cheer_event_log, send_to_consumers, content=None, stored_name=None):
+        """
+        Records a successful generation, either from new audio content (bytes or a
+        file streaming the download) or an already stored file.
+        """
         is_metered = BillingService._has_metered_usage(user)
-        sfx_request = SoundEffectRequest.objects.create(
+        sfx_request = SoundEffectRequest(
             cheer_event_log=cheer_event_log,
             status=DONE_STATUS,
-            is_metered = is_metered
-        )
-        sfx_request.generated_file.save(
-            f"{sfx_request.id}.mp3", 
-            ContentFile(file), 
-            save=True
+            is_metered = is_metered,
+            generated_file=stored_name
         )
+        if content is not None:
+            if isinstance(content, bytes):
+                content = ContentFile(content)
+            # stored before the row exists, a download failing halfway leaves no done request behind
+            sfx_request.generated_file, _ = save_content_addressed(content, reference=StoredSfxFiles.acquire)
+        else:
+            StoredSfxFiles.acquire(stored_name)
+        sfx_request.save()
 
+        if callable(send_to_consumers):
+            # decided at the last moment, see main.engine.Delivery
+            send_to_consumers = send_to_consumers()
         if send_to_consumers:
             SoundEffectRequestService._send_event_to_consumers(
                 sfx_request.generated_file.url, 
                 str(user.id),
-                cheer_event_log
+                cheer_event_log,
+                duration=SFX_DURATION_SECONDS
             )
 
         if is_metered:    
@@ -157,4 +295,119 @@ class SoundEffectRequestService:
         return sfx_request
 
 
-    
\ No newline at end of file
+    @staticmethod
+    def _send_fast_clip(user, cheer_event_log, send_to_consumers, content):
+        """
+        Plays freshly generated audio from a short lived copy, before it is stored.
+        Returns True when the overlay got it, _finish_sfx_request then only records it.
+        """
+        token = fast_clips.put(content)
+        if token is None:
+            return False
+        if callable(send_to_consumers):
+            send_to_consumers = send_to_consumers()
+        if not send_to_consumers:
+            return False
+
+        sent = SoundEffectRequestService._send_event_to_consumers(
+            reverse("overlay-clip", kwargs={"token": token}),
+            str(user.id),
+            cheer_event_log,
+            duration=SFX_DURATION_SECONDS,
+            fast_until=time.time() + settings.SFX_FAST_PATH_TTL
+        )
+        if sent:
+            metrics.incr("sfx.fast_path.sent")
+        return sent
+
+
+    @staticmethod
+    def stored_clip_urls(cheer_event_log_ids):
+        """Storage urls of the clips generated for the cheers, by cheer id. Cheers still uploading are left out."""
+        sfx_requests = SoundEffectRequest.objects.filter(
+            cheer_event_log_id__in=cheer_event_log_ids,
+            status=DONE_STATUS
+        ).exclude(
+            generated_file__isnull=True
+        ).exclude(
+            generated_file=""
+        ).order_by("timestamp")
+        return {str(sfx_request.cheer_event_log_id): sfx_request.generated_file.url for sfx_request in sfx_requests}
+
+
+    @staticmethod
+    def _fail_sfx_request(cheer_event_log, failed_reason):
+        return SoundEffectRequest.objects.create(
+            cheer_event_log=cheer_event_log,
+            status=FAILED_STATUS,
+            is_metered=False,
+            failed_reason=failed_reason
+        )
+
+
+    @staticmethod
+    def _prepare_generation(user, cheer_event_log, send_to_consumers=True):
+        """
+        Everything that runs before the ElevenLabs call.
+        Returns (sfx_request, canonical_prompt, prompt_key). The request is set when
+        the cheer was resolved without generating (billing failure or cached audio).
+        """
+        if not BillingService._is_valid_billing_status(user):
+            sfx_request = SoundEffectRequestService._fail_sfx_request(
+                cheer_event_log,
+                "Not enough credits. Upgrade billing plan."
+            )
+            return sfx_request, None, None
+
+        cached_audio, canonical_prompt, prompt_key = SoundEffectRequestService._find_cached_audio(
+            user, 
+            cheer_event_log
+        )
+        if cached_audio is not None:
+            metrics.incr("sfx.audio_cache.hits")
+            sfx_request = SoundEffectRequestService._finish_sfx_request(
+                user, 
+                cheer_event_log, 
+                send_to_consumers, 
+                stored_name=cached_audio.file.name
+            )
+            return sfx_request, canonical_prompt, prompt_key
+        if prompt_key:
+            metrics.incr("sfx.audio_cache.misses")
+
+        return None, canonical_prompt, prompt_key
+
+
+    @staticmethod
+    def _reuse_generated_audio(user, cheer_event_log, send_to_consumers, prompt_key):
+        """Finishes the cheer with audio another worker generated for the same prompt, if it is stored yet."""
+        cached_audio = GeneratedAudioCache.lookup(prompt_key)
+        if cached_audio is None:
+            return None
+        return SoundEffectRequestService._finish_sfx_request(
+            user,
+            cheer_event_log,
+            send_to_consumers,
+            stored_name=cached_audio.file.name
+        )
+
+
+    @staticmethod
+    def _complete_generation(user, cheer_event_log, send_to_consumers, content, canonical_prompt, prompt_key):
+        """Everything that runs after ElevenLabs returned the audio."""
+        sfx_request = SoundEffectRequestService._finish_sfx_request(
+            user, 
+            cheer_event_log, 
+            send_to_consumers, 
+            content=content
+        )
+        if prompt_key:
+            GeneratedAudioCache.store(
+                prompt_key, 
+                canonical_prompt, 
+                SFX_DURATION_SECONDS, 
+                SFX_PROMPT_INFLUENCE, 
+                sfx_request.generated_file
+            )
+
+        return sfx_request
@@ -0,0 +1,213 @@
+import re
+import time
+import hashlib
+import logging
+import threading
+from array import array
+from operator import eq
+from collections import Counter
+
+from django.conf import settings
+
+from .models import GeneratedAudio
+
+logger = logging.getLogger('django')
+
+NUM_PERMUTATIONS = 64
+SHINGLE_SIZE = 3
+# each shingle gets one 32 bit hash value per permutation, all read from a single SHAKE digest
+SHINGLE_DIGEST_SIZE = NUM_PERMUTATIONS * 4
+
+NON_WORD_REGEX = re.compile(r"[^\w]+")
+
+
+def shingles(prompt, size=SHINGLE_SIZE):
+    text = " ".join(NON_WORD_REGEX.sub(" ", prompt.casefold()).split())
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def _shingle_hashes(shingle):
+    hashes = array("I")
+    hashes.frombytes(hashlib.shake_128(shingle.encode("utf-8")).digest(SHINGLE_DIGEST_SIZE))
+    return hashes
+
+
+def minhash_signature(prompt):
+    """
+    Signature whose i-th value is the minimum of the i-th hash over the
+    prompt shingles. Signatures are persisted, so the hashing must never change.
+    """
+    rows = [_shingle_hashes(shingle) for shingle in shingles(prompt)]
+    if not rows:
+        return None
+    return tuple(map(min, zip(*rows)))
+
+
+def pack_signature(signature):
+    return array("I", signature).tobytes()
+
+
+def unpack_signature(data):
+    signature = array("I")
+    signature.frombytes(bytes(data))
+    return tuple(signature)
+
+
+def estimated_similarity(signature, other):
+    return sum(map(eq, signature, other)) / len(signature)
+
+
+class PromptSimilarityIndex:
+    """
+    MinHash/LSH index over prompts. A signature is split in `bands` bands and
+    two prompts become candidates when at least `min_band_hits` bands hash to
+    the same bucket; the candidates are then ranked by their estimated Jaccard
+    similarity. Lookups touch `bands` dict buckets, so their cost doesn't grow
+    with the index size.
+
+    Signatures are kept packed back to back in one array, slot i owning the
+    NUM_PERMUTATIONS values from i * NUM_PERMUTATIONS. Discarded slots are
+    unlinked from their buckets and reused by the next add.
+    """
+
+    def __init__(self, bands=16, threshold=0.8, min_band_hits=2):
+        if NUM_PERMUTATIONS % bands:
+            raise ValueError("bands must divide the number of permutations")
+        self.bands = bands
+        self.rows = NUM_PERMUTATIONS // bands
+        self.threshold = threshold
+        self.min_band_hits = min(min_band_hits, bands)
+        self._buckets = [{} for _ in range(bands)]
+        self._entry_ids = []
+        self._signatures = array("I")
+        self._slots = {}
+        self._free_slots = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _band_keys(self, signature):
+        rows = self.rows
+        return [hash(signature[band * rows:(band + 1) * rows].tobytes()) for band in range(self.bands)]
+
+    def _signature(self, slot):
+        return self._signatures[slot * NUM_PERMUTATIONS:(slot + 1) * NUM_PERMUTATIONS]
+
+    def add(self, entry_id, signature):
+        signature = array("I", signature)
+        with self._lock:
+            if entry_id in self._slots:
+                return False
+            if self._free_slots:
+                slot = self._free_slots.pop()
+                self._entry_ids[slot] = entry_id
+                self._signatures[slot * NUM_PERMUTATIONS:(slot + 1) * NUM_PERMUTATIONS] = signature
+            else:
+                slot = len(self._entry_ids)
+                self._entry_ids.append(entry_id)
+                self._signatures.extend(signature)
+            self._slots[entry_id] = slot
+            for bucket, key in zip(self._buckets, self._band_keys(signature)):
+                bucket.setdefault(key, []).append(slot)
+            return True
+
+    def discard(self, entry_id):
+        """Removes an entry from its buckets and frees its slot for the next add."""
+        with self._lock:
+            slot = self._slots.pop(entry_id, None)
+            if slot is None:
+                return
+            for bucket, key in zip(self._buckets, self._band_keys(self._signature(slot))):
+                slots = bucket[key]
+                slots.remove(slot)
+                if not slots:
+                    del bucket[key]
+            self._entry_ids[slot] = None
+            self._free_slots.append(slot)
+
+    def query(self, signature):
+        """Returns (entry_id, similarity) of the most similar entry above the threshold, or None."""
+        signature = array("I", signature)
+        band_keys = self._band_keys(signature)
+        best = None
+        # slots are reused, so the candidates must be read in one piece with their signatures
+        with self._lock:
+            band_hits = Counter()
+            for bucket, key in zip(self._buckets, band_keys):
+                band_hits.update(bucket.get(key, ()))
+
+            for slot, hits in band_hits.items():
+                if hits < self.min_band_hits:
+                    continue
+                similarity = estimated_similarity(signature, self._signature(slot))
+                if similarity >= self.threshold and (best is None or similarity > best[1]):
+                    best = (self._entry_ids[slot], similarity)
+        return best
+
+
+class GeneratedAudioSimilarityIndex(PromptSimilarityIndex):
+    """
+    PromptSimilarityIndex over the GeneratedAudio cache, loaded from the stored
+    signatures by warm() when the worker starts and topped up with newer rows
+    every `refresh_interval`.
+    """
+
+    def __init__(self, refresh_interval=60, **kwargs):
+        super().__init__(**kwargs)
+        self.refresh_interval = refresh_interval
+        self._loaded_until = None
+        self._last_refresh = None
+        self._refresh_lock = threading.Lock()
+
+    def _refresh(self):
+        entries = GeneratedAudio.objects.filter(minhash__isnull=False)
+        if self._loaded_until is not None:
+            entries = entries.filter(created__gte=self._loaded_until)
+
+        loaded = 0
+        for entry_id, minhash, created in entries.order_by("created").values_list(
+            "id", "minhash", "created"
+        ).iterator(chunk_size=5000):
+            if self.add(entry_id, unpack_signature(minhash)):
+                loaded += 1
+            self._loaded_until = created
+
+        if loaded:
+            logger.info("Prompt similarity index: loaded {n} signatures.".format(n=loaded))
+
+    def ensure_fresh(self):
+        now = time.monotonic()
+        if self._last_refresh is not None and now - self._last_refresh < self.refresh_interval:
+            return
+        with self._refresh_lock:
+            if self._last_refresh is not None and now - self._last_refresh < self.refresh_interval:
+                return
+            self._refresh()
+            self._last_refresh = time.monotonic()
+
+    def warm(self):
+        """Loads the stored signatures up front so the first lookup doesn't pay for it."""
+        started = time.monotonic()
+        self.ensure_fresh()
+        logger.info("Prompt similarity index: {n} signatures ready in {s:.1f}s.".format(
+            n=len(self),
+            s=time.monotonic() - started
+        ))
+
+    def find_similar(self, prompt):
+        signature = minhash_signature(prompt)
+        if signature is None:
+            return None
+        self.ensure_fresh()
+        return self.query(signature)
+
+
+generated_audio_index = GeneratedAudioSimilarityIndex(
+    bands=settings.SFX_SIMILARITY_BANDS,
+    threshold=settings.SFX_SIMILARITY_THRESHOLD,
+    min_band_hits=settings.SFX_SIMILARITY_MIN_BAND_HITS,
+    refresh_interval=settings.SFX_SIMILARITY_REFRESH_INTERVAL
+)
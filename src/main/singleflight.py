@@ -0,0 +1,80 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import PromptGenerationLease
+
+logger = logging.getLogger('django')
+
+# deletes the key only if this owner still holds it
+REDIS_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class PromptLeases:
+    """
+    Cross-process leases on prompt keys. The holder generates the prompt, every
+    other worker waits for the audio to show up in the GeneratedAudio cache.
+
+    Leases live in redis (SET NX EX) when a redis url is configured, in the
+    PromptGenerationLease table otherwise. They expire after `ttl` seconds so a
+    crashed worker never blocks a prompt for longer than that.
+    """
+
+    def __init__(self, ttl, redis_url=None, key_prefix="sfx:lease:"):
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self._redis = None
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(
+                redis_url,
+                socket_timeout=0.5,
+                socket_connect_timeout=0.5
+            )
+            self._release_script = self._redis.register_script(REDIS_RELEASE_SCRIPT)
+
+    def acquire(self, prompt_key, owner):
+        if self._redis is not None:
+            try:
+                return bool(self._redis.set(self.key_prefix + prompt_key, owner, nx=True, ex=self.ttl))
+            except Exception:
+                logger.warning("Prompt leases: redis unavailable, falling back to the database.")
+
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                PromptGenerationLease.objects.filter(prompt_key=prompt_key, expires_at__lte=now).delete()
+                PromptGenerationLease.objects.create(
+                    prompt_key=prompt_key,
+                    owner=owner,
+                    expires_at=now + timedelta(seconds=self.ttl)
+                )
+        except IntegrityError:
+            return False
+        return True
+
+    def release(self, prompt_key, owner):
+        if self._redis is not None:
+            try:
+                self._release_script(keys=[self.key_prefix + prompt_key], args=[owner])
+                return
+            except Exception:
+                logger.warning("Prompt leases: redis unavailable, falling back to the database.")
+        PromptGenerationLease.objects.filter(prompt_key=prompt_key, owner=owner).delete()
+
+    def purge_expired(self):
+        return PromptGenerationLease.objects.filter(expires_at__lte=timezone.now()).delete()[0]
+
+
+prompt_leases = PromptLeases(
+    ttl=settings.SFX_SINGLEFLIGHT_LEASE_TTL,
+    redis_url=settings.REDIS_URL
+)
@@ -0,0 +1,414 @@
+import os
+import time
+import datetime
+import uuid
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.urls import reverse
+from django.utils import timezone
+from django.utils._os import safe_join
+from storages.backends.s3 import S3Storage
+from storages.utils import clean_name
+
+from twitch_bot.metrics import metrics
+from .streaming import HashingReader
+
+logger = logging.getLogger('django')
+
+PARTIAL_SUFFIX = ".part"
+# new files are written here while they are hashed, then moved to their content key
+INCOMING_PREFIX = "sfx_files/incoming/"
+
+
+def content_key(digest, extension=".mp3"):
+    return "sfx_files/{prefix}/{digest}{extension}".format(
+        prefix=digest[:2],
+        digest=digest,
+        extension=extension
+    )
+
+
+def move_file(storage, old_name, new_name):
+    """Renames a stored file: a server side copy on S3, a rename on disk."""
+    if hasattr(storage, "move"):
+        return storage.move(old_name, new_name)
+    if isinstance(storage, FileSystemStorage):
+        new_path = storage.path(new_name)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.replace(storage.path(old_name), new_path)
+        return new_name
+    with storage.open(old_name) as old_file:
+        new_name = storage.save(new_name, old_file)
+    storage.delete(old_name)
+    return new_name
+
+
+def discard_file(storage, name):
+    """Deletes a file that may only be partly written, or not at all. Never raises."""
+    try:
+        storage.delete(name)
+    except Exception:
+        # left to SfxStorageSweeper.purge_incoming
+        logger.warning("SFX storage: failed to delete the partial upload {name}.".format(name=name))
+
+
+def save_content_addressed(content, storage=None, extension=".mp3", reference=None):
+    """
+    Saves the content under the key of its sha256, so identical audio is stored
+    once and a stored file never changes, its urls can be cached for good. The
+    content streams to a temporary name while it is hashed and is then moved to
+    its key, or dropped when that key is already stored. Returns the key and the
+    size of the content.
+
+    reference(key, size) is called once the key is known, before looking for
+    it: a file deduplicated onto is referenced before the garbage collector
+    could delete it, see SfxStorageSweeper._delete.
+    """
+    storage = storage or default_storage
+    hashing = HashingReader(content)
+    temporary_name = "{prefix}{id}{extension}".format(prefix=INCOMING_PREFIX, id=uuid.uuid4().hex, extension=extension)
+    try:
+        temporary_name = storage.save(temporary_name, File(hashing))
+    except BaseException:
+        # the download failed halfway, what was written of it is of no use
+        discard_file(storage, temporary_name)
+        raise
+    name = content_key(hashing.hexdigest(), extension)
+    if reference is not None:
+        reference(name, hashing.size)
+    if storage.exists(name):
+        storage.delete(temporary_name)
+        metrics.incr("sfx.storage.duplicates")
+        return name, hashing.size
+    return move_file(storage, temporary_name, name), hashing.size
+
+
+class SfxS3Storage(S3Storage):
+    """
+    S3Storage for generated sound effects, stored under their content hash (see
+    save_content_addressed) with an immutable Cache-Control.
+
+    Urls are cached per process. Signing one is a crypto operation per file per
+    render, and a new signature every render also defeats browser and CDN
+    caching. Signed urls are reused until url_cache_margin seconds before they
+    expire, unsigned ones until they fall out of the LRU.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._urls = OrderedDict()
+        self._urls_lock = threading.Lock()
+
+    def get_default_settings(self):
+        default_settings = super().get_default_settings()
+        default_settings.update({
+            "url_cache_size": settings.SFX_URL_CACHE_SIZE,
+            "url_cache_margin": settings.SFX_URL_CACHE_MARGIN,
+            "archive_prefix": settings.SFX_ARCHIVE_PREFIX,
+            "archive_storage_class": settings.SFX_ARCHIVE_STORAGE_CLASS,
+        })
+        return default_settings
+
+    def _get_write_parameters(self, name, content=None):
+        params = super()._get_write_parameters(name, content)
+        # files moved to the archive by main.retention
+        if self.archive_storage_class and name.startswith(self.archive_prefix):
+            params["StorageClass"] = self.archive_storage_class
+        return params
+
+    def url(self, name, parameters=None, expire=None, http_method=None):
+        if parameters or expire is not None or http_method:
+            return super().url(name, parameters=parameters, expire=expire, http_method=http_method)
+
+        now = time.monotonic()
+        with self._urls_lock:
+            cached = self._urls.get(name)
+            if cached is not None and cached[0] > now:
+                self._urls.move_to_end(name)
+                return cached[1]
+
+        url = super().url(name)
+        signed = self.querystring_auth and not self.custom_domain
+        expires_at = now + self.querystring_expire - self.url_cache_margin if signed else float("inf")
+        with self._urls_lock:
+            self._urls[name] = (expires_at, url)
+            self._urls.move_to_end(name)
+            while len(self._urls) > self.url_cache_size:
+                self._urls.popitem(last=False)
+        return url
+
+    def move(self, old_name, new_name):
+        old_key = self._normalize_name(clean_name(old_name))
+        new_key = self._normalize_name(clean_name(new_name))
+        self.connection.meta.client.copy_object(
+            Bucket=self.bucket_name,
+            Key=new_key,
+            CopySource={"Bucket": self.bucket_name, "Key": old_key},
+            # the write parameters (acl, cache control, content type) are not copied otherwise
+            MetadataDirective="REPLACE",
+            **self._get_write_parameters(new_name)
+        )
+        self.delete(old_name)
+        return new_name
+
+    def delete(self, name):
+        with self._urls_lock:
+            self._urls.pop(name, None)
+        super().delete(name)
+
+
+class SpoolingS3Storage(SfxS3Storage):
+    """
+    S3Storage that writes new files to a local spool directory and returns right
+    away, a background thread uploads them to the bucket in batches. Until the
+    upload is confirmed the file is served from the spool (see
+    main.views.spooled_media), then the local copy is removed and url() points
+    at the bucket.
+
+    The spool directory is the queue, so files left by a stopped process are
+    uploaded by the next one that flushes. When the spool holds more than
+    spool_max_bytes new files go straight to the bucket instead.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._spooled_bytes = 0
+        self._retries = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._exit_hook_registered = False
+        metrics.register_collector("sfx_spool", self.spool_stats)
+
+    def get_default_settings(self):
+        default_settings = super().get_default_settings()
+        default_settings.update({
+            "spool_location": settings.SFX_SPOOL_DIR,
+            "spool_max_bytes": settings.SFX_SPOOL_MAX_BYTES,
+            "flush_interval": settings.SFX_SPOOL_FLUSH_INTERVAL,
+            "flush_batch_size": settings.SFX_SPOOL_FLUSH_BATCH_SIZE,
+            "flush_concurrency": settings.SFX_SPOOL_FLUSH_CONCURRENCY,
+            "flush_max_delay": settings.SFX_SPOOL_FLUSH_MAX_DELAY,
+            "partial_max_age": settings.SFX_STORAGE_GC_GRACE_SECONDS,
+        })
+        return default_settings
+
+    def spool_path(self, name):
+        return safe_join(self.spool_location, name)
+
+    def _is_spooled(self, name):
+        return os.path.isfile(self.spool_path(name))
+
+    def _save(self, name, content):
+        if self._spooled_bytes >= self.spool_max_bytes:
+            metrics.incr("sfx.spool.bypassed")
+            return super()._save(name, content)
+
+        path = self.spool_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a temporary name, the flusher never uploads half a file
+        partial_path = path + PARTIAL_SUFFIX
+        size = 0
+        try:
+            with open(partial_path, "wb") as spool_file:
+                for chunk in content.chunks():
+                    spool_file.write(chunk)
+                    size += len(chunk)
+            os.replace(partial_path, path)
+        except BaseException:
+            # the download failed halfway, nothing would ever pick up the rest
+            try:
+                os.remove(partial_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        with self._lock:
+            self._spooled_bytes += size
+        self._ensure_flushing()
+        self._wakeup.set()
+        return name
+
+    def _open(self, name, mode="rb"):
+        if self._is_spooled(name):
+            return open(self.spool_path(name), mode)
+        return super()._open(name, mode)
+
+    def exists(self, name):
+        return self._is_spooled(name) or super().exists(name)
+
+    def size(self, name):
+        try:
+            return os.path.getsize(self.spool_path(name))
+        except OSError:
+            return super().size(name)
+
+    def delete(self, name):
+        try:
+            os.remove(self.spool_path(name))
+        except FileNotFoundError:
+            pass
+        super().delete(name)
+
+    def listdir(self, path):
+        directories, files = super().listdir(path)
+        spool_directory = self.spool_path(path)
+        if os.path.isdir(spool_directory):
+            for entry in os.scandir(spool_directory):
+                if entry.is_dir():
+                    if entry.name not in directories:
+                        directories.append(entry.name)
+                elif not entry.name.endswith(PARTIAL_SUFFIX) and entry.name not in files:
+                    files.append(entry.name)
+        return directories, files
+
+    def get_modified_time(self, name):
+        if not self._is_spooled(name):
+            return super().get_modified_time(name)
+        modified = datetime.datetime.fromtimestamp(
+            os.path.getmtime(self.spool_path(name)),
+            datetime.timezone.utc
+        )
+        return modified if settings.USE_TZ else timezone.make_naive(modified)
+
+    def move(self, old_name, new_name):
+        if not self._is_spooled(old_name):
+            return super().move(old_name, new_name)
+        new_path = self.spool_path(new_name)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.replace(self.spool_path(old_name), new_path)
+        self._wakeup.set()
+        return new_name
+
+    def url(self, name, parameters=None, expire=None, http_method=None):
+        if self._is_spooled(name):
+            return reverse("spooled-media", kwargs={"name": name})
+        return super().url(name, parameters=parameters, expire=expire, http_method=http_method)
+
+    def _ensure_flushing(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="sfx-spool-flusher", daemon=True)
+            self._thread.start()
+            if not self._exit_hook_registered:
+                atexit.register(self.close)
+                self._exit_hook_registered = True
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("SFX spool: flush failed.")
+            if self._stopped.is_set():
+                return
+
+    def _pending(self):
+        """
+        Spooled files due for upload, oldest first, and the bytes the spool holds.
+        Partial files nobody wrote to for partial_max_age, left by a process that
+        died while saving, are deleted.
+        """
+        now = time.monotonic()
+        partial_before = time.time() - self.partial_max_age
+        pending = []
+        spooled_bytes = 0
+        for directory, _, filenames in os.walk(self.spool_location):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                    if filename.endswith(PARTIAL_SUFFIX) and stat.st_mtime < partial_before:
+                        os.remove(path)
+                        metrics.incr("sfx.spool.partials_purged")
+                        continue
+                except FileNotFoundError:
+                    continue
+                spooled_bytes += stat.st_size
+                if filename.endswith(PARTIAL_SUFFIX):
+                    continue
+                name = os.path.relpath(path, self.spool_location).replace("\\", "/")
+                if name.startswith(INCOMING_PREFIX):
+                    # still being hashed, it is uploaded under its content key
+                    continue
+                retry = self._retries.get(name)
+                if retry is None or retry[1] <= now:
+                    pending.append((stat.st_mtime, name))
+        pending.sort()
+        return [name for _, name in pending], spooled_bytes
+
+    def flush(self):
+        """Uploads every due spooled file, flush_batch_size at a time. Returns how many were uploaded."""
+        pending, spooled_bytes = self._pending()
+        with self._lock:
+            self._spooled_bytes = spooled_bytes
+        if not pending:
+            return 0
+
+        flushed = 0
+        with ThreadPoolExecutor(max_workers=self.flush_concurrency) as executor:
+            for start in range(0, len(pending), self.flush_batch_size):
+                if self._stopped.is_set() and start:
+                    break
+                batch = pending[start:start + self.flush_batch_size]
+                flushed += sum(executor.map(self._flush_file, batch))
+        return flushed
+
+    def _flush_file(self, name):
+        path = self.spool_path(name)
+        try:
+            with open(path, "rb") as spool_file:
+                super()._save(name, spool_file)
+        except FileNotFoundError:
+            # flushed by another process sharing the spool
+            return False
+        except Exception as e:
+            attempts = self._retries.get(name, (0, 0))[0] + 1
+            delay = min(self.flush_max_delay, 2 ** attempts)
+            self._retries[name] = (attempts, time.monotonic() + delay)
+            metrics.incr("sfx.spool.upload_failures")
+            logger.warning("SFX spool: upload of {name} failed ({n} attempts), retrying in {delay}s: {error!r}".format(
+                name=name,
+                n=attempts,
+                delay=delay,
+                error=e
+            ))
+            return False
+
+        # the upload returned, the bucket has the file and url() can point at it
+        size = 0
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        self._retries.pop(name, None)
+        with self._lock:
+            self._spooled_bytes = max(0, self._spooled_bytes - size)
+        metrics.incr("sfx.spool.flushed")
+        return True
+
+    def spool_stats(self):
+        with self._lock:
+            return {
+                "bytes": self._spooled_bytes,
+                "retrying": len(self._retries),
+            }
+
+    def close(self):
+        """Stops the flusher after one last pass, files it can't upload stay in the spool."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=30)
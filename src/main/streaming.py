@@ -0,0 +1,104 @@
+import io
+import asyncio
+import hashlib
+import threading
+from collections import deque
+
+
+class HashingReader(io.RawIOBase):
+    """Passes a file through to whoever reads it, hashing the bytes on the way."""
+
+    def __init__(self, file):
+        self._file = file
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._file.read(len(buffer))
+        if not data:
+            return 0
+        n = len(data)
+        buffer[:n] = data
+        self._hash.update(data)
+        self.size += n
+        return n
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class ChunkPipe(io.RawIOBase):
+    """
+    Bounded pipe from a coroutine to a blocking reader. The engine writes audio
+    chunks as they come from ElevenLabs while a db thread saves the read end to
+    storage, so the upload overlaps the download and no more than `max_buffered`
+    bytes wait in between, whatever the size of the file.
+
+    Must be created on the event loop the chunks are written from.
+    """
+
+    def __init__(self, max_buffered):
+        self.max_buffered = max_buffered
+        self._chunks = deque()
+        self._buffered = 0
+        self._eof = False
+        self._error = None
+        self._reader_closed = False
+        self._condition = threading.Condition()
+        self._loop = asyncio.get_running_loop()
+        self._space = asyncio.Event()
+
+    def readable(self):
+        return True
+
+    async def put(self, chunk):
+        """Waits for room in the buffer. Raises BrokenPipeError once the reader is gone."""
+        while True:
+            with self._condition:
+                if self._reader_closed:
+                    raise BrokenPipeError("Storage stopped reading the audio stream.")
+                if self._buffered < self.max_buffered:
+                    self._chunks.append(memoryview(chunk))
+                    self._buffered += len(chunk)
+                    self._condition.notify_all()
+                    return
+                self._space.clear()
+            await self._space.wait()
+
+    def finish(self, error=None):
+        """End of the stream. With an error the reader fails instead of saving a truncated file."""
+        with self._condition:
+            self._eof = True
+            self._error = error
+            self._condition.notify_all()
+
+    def readinto(self, buffer):
+        with self._condition:
+            while not self._chunks and not self._eof:
+                self._condition.wait()
+            if not self._chunks:
+                if self._error is not None:
+                    raise IOError("Audio stream interrupted.") from self._error
+                return 0
+
+            chunk = self._chunks[0]
+            n = min(len(buffer), len(chunk))
+            buffer[:n] = chunk[:n]
+            if n == len(chunk):
+                self._chunks.popleft()
+            else:
+                self._chunks[0] = chunk[n:]
+            self._buffered -= n
+        self._loop.call_soon_threadsafe(self._space.set)
+        return n
+
+    def close(self):
+        """Called by the reader once it is done, successful or not, so the writer never waits forever."""
+        with self._condition:
+            self._reader_closed = True
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._space.set)
+        super().close()
@@ -1,4 +1,32 @@
+from unittest import mock
+
 from django.test import TestCase
 import pytest
-# Create your tests here.
+import requests
+
+from twitch_bot.client import TwitchClient
+from twitch_bot.outbound import outbound_service
+
+
+def _response(status_code, body):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = body
+    return response
+
+
+class TwitchClientTests(TestCase):
+
+    def test_app_access_token_is_requested_with_a_form_body(self):
+        transport = mock.Mock(return_value=_response(200, b'{"access_token": "token"}'))
+        with mock.patch.object(outbound_service("twitch").session, "request", transport):
+            client = TwitchClient("client-id", "secret")
 
+        self.assertEqual(client.access_token, "token")
+        method, url = transport.call_args.args
+        self.assertEqual((method, url), ("POST", "https://id.twitch.tv/oauth2/token"))
+        self.assertEqual(transport.call_args.kwargs["data"], {
+            "client_id": "client-id",
+            "client_secret": "secret",
+            "grant_type": "client_credentials"
+        })
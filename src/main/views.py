@@ -1,8 +1,9 @@
 import logging
 import json
 
-from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponseForbidden, HttpResponse, StreamingHttpResponse
+from django.shortcuts import render, get_object_or_404, redirect
+from django.core.files.storage import default_storage
+from django.http import HttpResponseForbidden, HttpResponse, StreamingHttpResponse, Http404, FileResponse
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
@@ -10,6 +11,7 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST 
 from django_eventstream import send_event
 from django.contrib.auth import get_user_model
+from asgiref.sync import sync_to_async
 
 from allauth.socialaccount.models import SocialAccount
 from .models import AlertPreferences, SoundEffectRequest, CheerEventLogEntry
@@ -19,8 +21,16 @@ from .constants import (
     FAILED_STATUS, 
     IGNORED_STATUS,
     NEW_STATUS,
+    SHED_STATUS,
+    SFX_DURATION_SECONDS,
 )
 from .services import TwitchWebhookHandler, SoundEffectRequestService
+from .queue import SfxJobQueue
+from .ingest import cheer_ingest_buffer, CheerIngestEvent
+from .dedup import message_dedup_cache
+from .fastclips import fast_clips
+from .replay import overlay_events
+from .retention import StoredSfxFiles
 from billing.constants import SubscriptionPlanOptions
 from billing.services import BillingService
 
@@ -29,8 +39,7 @@ logger =  logging.getLogger('django')
 #Public views (Webhook & Overlay)
 @csrf_exempt
 @require_POST
-def twitch_eventsub_callback(request):
-    body = json.loads(bytes.decode(request.body))
+async def twitch_eventsub_callback(request):
     request_handler = TwitchWebhookHandler(
         request, 
         settings.TWITCH_WEBHOOK_SECRET
@@ -40,6 +49,8 @@ def twitch_eventsub_callback(request):
         logger.warning("Twitch webhook: signature mismatch on received event.")
         return HttpResponseForbidden("Signatures don't match")
 
+    body = json.loads(request_handler.body)
+
     if request_handler.is_challenge():
         logger.info("Twitch webhook: challenge request received.")
         return HttpResponse(
@@ -47,50 +58,62 @@ def twitch_eventsub_callback(request):
             content_type="text/plain"
         )
 
-    notification_id = body["subscription"]["id"]
-    notification_type = body["subscription"]["type"]
-
-    if request_handler.is_duplicate() and CheerEventLogEntry.objects.filter(twitch_message_id=notification_id).exists():
-        logger.info("Twitch webhook: Duplicate event message already handled.")
+    if not request_handler.is_fresh(settings.TWITCH_MESSAGE_MAX_AGE):
+        logger.warning("Twitch webhook: message timestamp too old, possible replay.")
         return HttpResponse()
+
+    message_id = request_handler.get_message_id()
+    notification_type = body["subscription"]["type"]
     
     if not notification_type == "channel.cheer":
         logger.warning("Twitch webhook: unallowed event type.")
         return HttpResponse()
 
-    notification_data = body["event"]
-    social_account_id = notification_data["broadcaster_user_id"]    
-    try:
-        social_user = SocialAccount.objects.get(uid=social_account_id)
-        user = social_user.user
-        alert_preferences = user.alertpreferences
-    except:
-        logger.warning("Twitch webhook: Missing social account for twitch user.")
+    if await message_dedup_cache.aseen(message_id):
+        logger.info("Twitch webhook: Duplicate event message already handled.")
         return HttpResponse()
-    
-    cheer_event_log, meets_requirements = SoundEffectRequestService.save_cheer_event(
-        user, 
-        alert_preferences, 
-        notification_data,
-        notification_id
-    )
-    if meets_requirements and alert_preferences.auto_generate:
-        SoundEffectRequestService.generate_sfx.after_response(
-            user,
-            cheer_event_log, 
-            send_to_consumers=alert_preferences.auto_play
-        )
+
+    accepted = cheer_ingest_buffer.submit(CheerIngestEvent(
+        twitch_message_id=message_id,
+        event_data=body["event"],
+        message_timestamp=request_handler.get_message_timestamp()
+    ))
+    if not accepted:
+        logger.error("Twitch webhook: ingest buffer full, asking Twitch to retry.")
+        await sync_to_async(message_dedup_cache.forget, thread_sensitive=False)(message_id)
+        return HttpResponse(status=503)
 
     return HttpResponse()
 
 
+def overlay_fast_clip(request, token):
+    content = fast_clips.get(token)
+    if content is None:
+        raise Http404()
+    response = HttpResponse(content, content_type="audio/mpeg")
+    response["Cache-Control"] = "private, max-age={ttl}".format(ttl=settings.SFX_FAST_PATH_TTL)
+    return response
+
+
+def spooled_media(request, name):
+    """Generated files still waiting in the local spool, the ones flushed since are in the bucket."""
+    try:
+        return FileResponse(open(default_storage.spool_path(name), "rb"), content_type="audio/mpeg")
+    except FileNotFoundError:
+        return redirect(default_storage.url(name))
+
+
 def broadcaster_overlay(request, user_id):
     socket_routing = "/ws/cheers/"
     User = get_user_model()
     user = get_object_or_404(User, id=user_id)
     
     template_name = "overlay/main.html"
-    context = {"socket_url": socket_routing + str(user_id) + "/"}
+    context = {
+        "socket_url": socket_routing + str(user_id) + "/",
+        # where a freshly opened overlay starts, a reloaded one resumes from the last clip it played
+        "replay_from": overlay_events.head(str(user_id))
+    }
 
     return render(request, template_name, context)
 
@@ -107,6 +130,7 @@ def overview(request):
         "failed_status": FAILED_STATUS,
         "done_status": DONE_STATUS,
         "ignored_status": IGNORED_STATUS,
+        "shed_status": SHED_STATUS,
         "new_status": NEW_STATUS
         }
 
@@ -128,6 +152,7 @@ def hx_get_log_details(request, cheer_log_id):
         "failed_status": FAILED_STATUS,
         "done_status": DONE_STATUS,
         "ignored_status": IGNORED_STATUS,
+        "shed_status": SHED_STATUS,
         "new_status": NEW_STATUS,
     }
     return render(request, template_name, context)
@@ -140,7 +165,7 @@ def hx_generate_sfx(request):
 
     toast_template_name = "dashboard/ui/toast.html"
     cheer_log_object = get_object_or_404(CheerEventLogEntry, id=cheer_log_id)
-    SoundEffectRequestService.generate_sfx.after_response(
+    SfxJobQueue.enqueue(
         request.user,
         cheer_log_object, 
         send_to_consumers=False
@@ -161,6 +186,7 @@ def hx_sfx_list_for_cheer_log(request, cheer_log_id):
         "failed_status": FAILED_STATUS,
         "done_status": DONE_STATUS,
         "ignored_status": IGNORED_STATUS,
+        "shed_status": SHED_STATUS,
         "new_status": NEW_STATUS,
         "sfx_list": query
     }
@@ -180,11 +206,20 @@ def hx_send_sfx_to_consumers(request, sfx_request_id):
         AlertPreferences, 
         user=request.user
     )
+
+    if not sfx.generated_file:
+        # removed by the retention policy, see main.retention
+        messages.error(request, "This sound effect expired")
+        return render(request, template_name)
     
+    StoredSfxFiles.touch(sfx.generated_file.name)
+    # sent by hand, the cheer's deadline doesn't apply
     SoundEffectRequestService._send_event_to_consumers(
         sfx.generated_file.url,
         str(request.user.id), 
-        sfx.cheer_event_log
+        sfx.cheer_event_log,
+        enforce_deadline=False,
+        duration=SFX_DURATION_SECONDS
     )
     messages.success(request, "Sent sound effect to your overlay")
     return render(request, template_name)
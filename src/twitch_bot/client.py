@@ -1,8 +1,16 @@
 import json
+import httpx
 import requests
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
 
 from django.conf import settings
+from django.utils import timezone
 import twitch_bot.exceptions as exceptions
+from twitch_bot.outbound import outbound_service
+
+# network failures and open circuits, mapped onto each call's own exception
+OUTBOUND_ERRORS = (requests.RequestException, exceptions.CircuitOpenError)
 
 class TwitchClient:
 
@@ -31,7 +39,10 @@ class TwitchClient:
             "client_secret": self.secret,
             "grant_type": "client_credentials"
         }
-        r = requests.post(oauth_endpoint, payload)
+        try:
+            r = outbound_service("twitch").post(oauth_endpoint, data=payload)
+        except OUTBOUND_ERRORS as e:
+            raise exceptions.TwitchAuthenticationFailed from e
         if not r.status_code in [200, 201]:
             raise exceptions.TwitchAuthenticationFailed
         return r.json()["access_token"]
@@ -45,7 +56,10 @@ class TwitchClient:
             "grant_type": "authorization_code",
             "redirect_uri": settings.get("TWITCH_REDIRECT_URI")
         }
-        r = requests.post(oauth_endpoint, payload)
+        try:
+            r = outbound_service("twitch").post(oauth_endpoint, data=payload)
+        except OUTBOUND_ERRORS as e:
+            raise exceptions.TwitchAuthenticationFailed from e
         if not r.status_code in [200, 201]:
             raise exceptions.TwitchAuthenticationFailed
         return r.json()["access_token"]
@@ -56,7 +70,10 @@ class TwitchClient:
         payload = {
             "broadcaster_user_id": user_id
         }
-        r = requests.get(endpoint, params=payload, headers=self.headers)
+        try:
+            r = outbound_service("twitch").get(endpoint, params=payload, headers=self.headers)
+        except OUTBOUND_ERRORS as e:
+            raise exceptions.TwitchFetchSubscriptionsFailed from e
         if r.status_code != 200:
             raise exceptions.TwitchFetchSubscriptionsFailed
         return r.json()["data"]
@@ -77,7 +94,10 @@ class TwitchClient:
             }
         }
         
-        r = requests.post(endpoint, json=payload, headers=self.headers)
+        try:
+            r = outbound_service("twitch").post(endpoint, json=payload, headers=self.headers)
+        except OUTBOUND_ERRORS as e:
+            raise exceptions.TwitchEventSubCreationFailed from e
         print(r.json())
         if r.status_code != 202:
             raise exceptions.TwitchEventSubCreationFailed
@@ -90,15 +110,17 @@ class TwitchClient:
         eventsubs_to_delete = [e for e in eventsubs if e["type"] == event_type]
 
         for event in eventsubs_to_delete:
-            r = requests.delete(endpoint, params={"id": event["id"]}, headers=self.headers)
+            try:
+                r = outbound_service("twitch").delete(endpoint, params={"id": event["id"]}, headers=self.headers)
+            except OUTBOUND_ERRORS as e:
+                raise exceptions.TwitchEventSubDeleteFailed from e
             if r.status_code != 204:
                 raise exceptions.TwitchEventSubDeleteFailed
 
         return None
 
 
-def elevenlabs_create_sfx(message, duration_seconds=4):
-    url = settings.ELEVENLABS_SFX_ENDPOINT
+def _elevenlabs_request(message, duration_seconds, prompt_influence):
     headers = {
         "Content-Type": "application/json",
         "Xi-Api-Key": settings.ELEVENLABS_API_KEY
@@ -106,11 +128,72 @@ def elevenlabs_create_sfx(message, duration_seconds=4):
     payload = {
         "text": message,
         "duration_seconds": duration_seconds,
-        "prompt_influence": 0.3
+        "prompt_influence": prompt_influence
     }
+    return headers, payload
+
+
+def _parse_retry_after(value):
+    """Retry-After header in seconds, it can be given as a number or as an http date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - timezone.now()).total_seconds())
+    except (TypeError, ValueError):
+        return None
 
-    r = requests.post(url, json=payload, headers=headers)
+
+def _raise_for_elevenlabs_status(r):
+    # 429 and 503 mean slow down, not that the request is bad
+    if r.status_code in (429, 503):
+        raise exceptions.ElevenLabsRateLimited(_parse_retry_after(r.headers.get("Retry-After")))
+    if 400 <= r.status_code < 500:
+        raise exceptions.ElevenLabsRequestRejected(r.status_code)
     if 200 > r.status_code or r.status_code >= 300:
         raise exceptions.ElevenLabsApiError
+
+
+def elevenlabs_create_sfx(message, duration_seconds=4, prompt_influence=0.3):
+    url = settings.ELEVENLABS_SFX_ENDPOINT
+    headers, payload = _elevenlabs_request(message, duration_seconds, prompt_influence)
+
+    try:
+        r = outbound_service("elevenlabs").post(url, json=payload, headers=headers)
+    except OUTBOUND_ERRORS as e:
+        raise exceptions.ElevenLabsApiError from e
+    _raise_for_elevenlabs_status(r)
         
-    return r
\ No newline at end of file
+    return r
+
+
+@asynccontextmanager
+async def elevenlabs_astream_sfx(client, message, duration_seconds=4, prompt_influence=0.3):
+    """
+    Async elevenlabs_create_sfx on a caller owned httpx.AsyncClient. The response
+    body is left unread, the caller streams it with aiter_bytes inside the block.
+    Shares the circuit breaker of the pooled "elevenlabs" outbound service.
+    """
+    url = settings.ELEVENLABS_SFX_ENDPOINT
+    headers, payload = _elevenlabs_request(message, duration_seconds, prompt_influence)
+    breaker = outbound_service("elevenlabs").breaker
+
+    try:
+        breaker.before_call()
+        async with client.stream("POST", url, json=payload, headers=headers) as r:
+            if r.status_code >= 500 and r.status_code != 503:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            _raise_for_elevenlabs_status(r)
+            yield r
+    except exceptions.CircuitOpenError as e:
+        raise exceptions.ElevenLabsApiError from e
+    except httpx.HTTPError as e:
+        # also covers the connection dropping while the audio streams
+        breaker.record_failure()
+        raise exceptions.ElevenLabsApiError from e
+
@@ -16,4 +16,22 @@ class TwitchEventSubDeleteFailed(Exception):
 
 
 class ElevenLabsApiError(Exception):
-    "Raised when the ElevenLabs API returns a non 200 code."
\ No newline at end of file
+    "Raised when the ElevenLabs API returns a non 200 code."
+
+
+class ElevenLabsRateLimited(ElevenLabsApiError):
+    "Raised when ElevenLabs answers 429 or 503, the call can be retried after `retry_after` seconds"
+
+    def __init__(self, retry_after=None):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class ElevenLabsRequestRejected(ElevenLabsApiError):
+    "Raised when ElevenLabs refuses the request itself (4xx), sending it again won't help"
+    pass
+
+
+class CircuitOpenError(Exception):
+    "Raised when calls to an outbound service are short circuited after repeated failures"
+    pass
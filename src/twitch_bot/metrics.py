@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+
+logger = logging.getLogger('django')
+
+
+class MetricsRegistry:
+    """
+    Process-local counters, gauges and summaries.
+
+    Components either push values (incr, set_gauge, observe) or register a
+    collector that is called when a snapshot is taken, for state they already
+    keep themselves (cache sizes, breaker states...).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._summaries = {}
+        self._collectors = {}
+
+    @staticmethod
+    def _key(name, labels):
+        if not labels:
+            return name
+        formatted = ",".join("{k}={v}".format(k=k, v=labels[k]) for k in sorted(labels))
+        return "{name}{{{labels}}}".format(name=name, labels=formatted)
+
+    def incr(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[self._key(name, labels)] += value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            summary = self._summaries.setdefault(key, {"count": 0, "sum": 0.0, "max": value})
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["max"] = max(summary["max"], value)
+
+    def register_collector(self, name, collector):
+        with self._lock:
+            self._collectors[name] = collector
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "summaries": {k: dict(v) for k, v in self._summaries.items()},
+            }
+            collectors = list(self._collectors.items())
+
+        for name, collector in collectors:
+            snapshot[name] = collector()
+        return snapshot
+
+
+class MetricsExporter:
+    """
+    Snapshots of the processes that serve no http (manage.py run_sfx_workers),
+    published every few seconds for /internal/metrics/ to show next to its own.
+    A process that stopped publishing drops out after `ttl` seconds.
+
+    Snapshots live in redis (SET EX) when a redis url is configured, in a local
+    directory otherwise; in that case the web and worker processes must share it.
+    """
+
+    def __init__(self, ttl, redis_url=None, directory=None, key_prefix="metrics:process:"):
+        self.ttl = ttl
+        self.directory = directory
+        self.key_prefix = key_prefix
+        self._redis = None
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(
+                redis_url,
+                socket_timeout=0.5,
+                socket_connect_timeout=0.5
+            )
+
+    def _path(self, process):
+        return os.path.join(self.directory, "{process}.json".format(process=process.replace(":", "-")))
+
+    def publish(self, process, snapshot):
+        payload = json.dumps({"process": process, "at": time.time(), "metrics": snapshot}, default=str)
+        try:
+            if self._redis is not None:
+                self._redis.set(self.key_prefix + process, payload, ex=self.ttl)
+            else:
+                os.makedirs(self.directory, exist_ok=True)
+                path = self._path(process)
+                with open(path + ".tmp", "w") as snapshot_file:
+                    snapshot_file.write(payload)
+                os.replace(path + ".tmp", path)
+        except Exception:
+            logger.warning("Metrics: failed to publish the snapshot of {process}.".format(process=process))
+
+    def collect(self):
+        """The latest snapshot of every process still publishing, by process."""
+        payloads = []
+        try:
+            if self._redis is not None:
+                keys = list(self._redis.scan_iter(match=self.key_prefix + "*"))
+                payloads = [payload for payload in self._redis.mget(keys) if payload] if keys else []
+            elif os.path.isdir(self.directory):
+                for entry in os.scandir(self.directory):
+                    if not entry.name.endswith(".json"):
+                        continue
+                    if entry.stat().st_mtime < time.time() - self.ttl:
+                        # a worker that stopped
+                        os.remove(entry.path)
+                        continue
+                    with open(entry.path) as snapshot_file:
+                        payloads.append(snapshot_file.read())
+        except Exception:
+            logger.warning("Metrics: failed to collect the published snapshots.")
+
+        snapshots = {}
+        for payload in payloads:
+            try:
+                published = json.loads(payload)
+            except ValueError:
+                continue
+            snapshots[published["process"]] = published["metrics"]
+        return snapshots
+
+
+metrics = MetricsRegistry()
+
+metrics_exporter = MetricsExporter(
+    ttl=settings.METRICS_PUBLISH_TTL,
+    redis_url=settings.REDIS_URL,
+    directory=settings.METRICS_DIR
+)
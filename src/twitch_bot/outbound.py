@@ -0,0 +1,233 @@
+import time
+import random
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from django.conf import settings
+
+from .exceptions import CircuitOpenError
+from .metrics import metrics
+
+logger = logging.getLogger('django')
+
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+def was_not_sent(error):
+    """
+    Whether the request failed before reaching the upstream: the connection
+    timed out or could not be opened at all (refused, name resolution).
+    A connection dropped after it was open may have delivered the request.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, NewConnectionError):
+            # NameResolutionError and ConnectTimeoutError's connect failures derive from it
+            return True
+        if isinstance(error, MaxRetryError):
+            error = error.reason
+        elif error.args and isinstance(error.args[0], BaseException):
+            # requests wraps urllib3's error as the first argument
+            error = error.args[0]
+        else:
+            error = error.__cause__ or error.__context__
+    return False
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and fails fast for
+    `reset_timeout` seconds. Then a single trial call is let through
+    (half open): success closes the circuit, failure opens it again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+        raise CircuitOpenError(self.name)
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning("Outbound HTTP: circuit for {name} opened.".format(name=self.name))
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of the traffic, so an upstream outage can't
+    turn into a retry storm. Every request deposits `ratio` tokens, every
+    retry withdraws one.
+    """
+
+    def __init__(self, ratio=0.2, min_tokens=10, max_tokens=100):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(min_tokens)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class OutboundService:
+    """
+    Pooled HTTP client for one upstream service: a keep-alive requests.Session
+    with its own connection pool, default connect/read timeouts, jittered
+    retries limited by a RetryBudget and a CircuitBreaker.
+
+    Every method retries when the connection couldn't be opened, nothing was
+    sent (see was_not_sent). Idempotent methods also retry on dropped
+    connections, read timeouts and 502/503/504. POSTs that may have reached the
+    upstream are never replayed, they may have created or billed something.
+    """
+
+    def __init__(self, name, pool_maxsize=10, connect_timeout=3.05, read_timeout=10,
+                 max_retries=2, backoff=0.25, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.retry_budget = RetryBudget()
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+    def _can_retry(self, attempt):
+        return attempt < self.max_retries and self.retry_budget.withdraw()
+
+    def _sleep_before_retry(self, attempt):
+        # full jitter exponential backoff
+        time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    def request(self, method, url, **kwargs):
+        method = method.upper()
+        kwargs.setdefault("timeout", self.timeout)
+        idempotent = method in IDEMPOTENT_METHODS
+        self.retry_budget.deposit()
+
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            metrics.incr("outbound.requests", service=self.name)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.breaker.record_failure()
+                metrics.incr("outbound.errors", service=self.name)
+                if (idempotent or was_not_sent(e)) and self._can_retry(attempt):
+                    metrics.incr("outbound.retries", service=self.name)
+                    self._sleep_before_retry(attempt)
+                    attempt += 1
+                    continue
+                raise
+
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+            if response.status_code in RETRYABLE_STATUS_CODES and idempotent and self._can_retry(attempt):
+                metrics.incr("outbound.retries", service=self.name)
+                response.close()
+                self._sleep_before_retry(attempt)
+                attempt += 1
+                continue
+
+            return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def stats(self):
+        connections = 0
+        pooled_requests = 0
+        for key in list(self.adapter.poolmanager.pools.keys()):
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            pooled_requests += pool.num_requests
+        return {
+            "breaker_state": self.breaker.state,
+            "consecutive_failures": self.breaker.consecutive_failures,
+            "connections_opened": connections,
+            "requests_sent": pooled_requests,
+            "connection_reuse": 1 - connections / pooled_requests if pooled_requests else 0.0,
+            "retry_tokens": self.retry_budget.tokens,
+        }
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def outbound_service(name):
+    """Returns the shared OutboundService for `name`, configured from settings.OUTBOUND_HTTP."""
+    service = _services.get(name)
+    if service is not None:
+        return service
+
+    with _services_lock:
+        if name not in _services:
+            _services[name] = OutboundService(name, **settings.OUTBOUND_HTTP.get(name, {}))
+        return _services[name]
+
+
+metrics.register_collector(
+    "outbound_http",
+    lambda: {name: service.stats() for name, service in list(_services.items())}
+)
@@ -13,6 +13,7 @@ import os
 from pathlib import Path
 from dotenv import load_dotenv
 from django.core.management.utils import get_random_secret_key 
+from billing.constants import SubscriptionPlanOptions
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -52,7 +53,6 @@ INSTALLED_APPS = [
     "django.contrib.messages",
     "django.contrib.staticfiles",
     "django.contrib.sites",
-    "after_response",
     "accounts",
     "billing",
     "allauth",
@@ -204,6 +204,8 @@ if USE_S3:
     AWS_S3_OBJECT_PARAMETERS = {
         'CacheControl': 'max-age=86400',
     }
+    #generated sfx are stored under their content hash and never change (see main/storage.py)
+    SFX_CACHE_CONTROL = os.environ.get("SFX_CACHE_CONTROL", "public, max-age=31536000, immutable")
     
     #Static files settings
     STATIC_FILES_FOLDER = os.environ["STATIC_FILES_FOLDER"] #your-spaces-files-folder NOT END IN / 
@@ -215,11 +217,14 @@ if USE_S3:
 
     STORAGES = {
         "default": {
-            "BACKEND": "storages.backends.s3.S3Storage",
+            "BACKEND": "main.storage.SfxS3Storage",
             "OPTIONS": {
                 "location": MEDIA_FILES_FOLDER,
                 "default_acl": "publicRead",
-                "file_overwrite": False
+                "file_overwrite": False,
+                "object_parameters": {
+                    "CacheControl": SFX_CACHE_CONTROL,
+                },
             },
         },
         "staticfiles": {
@@ -239,6 +244,27 @@ else:
     MEDIA_URL = "media/"
     MEDIA_ROOT = BASE_DIR.parent / "dev-cdn" / "media"
 
+#SFX URL CACHE SETTINGS (see main/storage.py, only used with S3)
+#media urls are cached per process, signed ones until this many seconds before they expire
+SFX_URL_CACHE_SIZE = int(os.environ.get("SFX_URL_CACHE_SIZE", "10000"))
+SFX_URL_CACHE_MARGIN = int(os.environ.get("SFX_URL_CACHE_MARGIN", "300"))
+
+#LOCAL SPOOL STORAGE SETTINGS (see main/storage.py, only used with S3)
+#generated files are written to a local spool and uploaded to the bucket in the background,
+#the web process serves them from the spool until then so it has to see the same directory
+USE_SFX_SPOOL = USE_S3 and os.environ.get("USE_SFX_SPOOL", "FALSE") == "TRUE"
+SFX_SPOOL_DIR = os.environ.get("SFX_SPOOL_DIR", str(BASE_DIR.parent / "spool"))
+#past this much spooled data new files are uploaded directly
+SFX_SPOOL_MAX_BYTES = int(os.environ.get("SFX_SPOOL_MAX_BYTES", str(2 * 1024 ** 3)))
+SFX_SPOOL_FLUSH_INTERVAL = float(os.environ.get("SFX_SPOOL_FLUSH_INTERVAL", "1.0"))
+SFX_SPOOL_FLUSH_BATCH_SIZE = int(os.environ.get("SFX_SPOOL_FLUSH_BATCH_SIZE", "50"))
+SFX_SPOOL_FLUSH_CONCURRENCY = int(os.environ.get("SFX_SPOOL_FLUSH_CONCURRENCY", "8"))
+#failed uploads are retried with exponential backoff up to this many seconds apart
+SFX_SPOOL_FLUSH_MAX_DELAY = float(os.environ.get("SFX_SPOOL_FLUSH_MAX_DELAY", "300"))
+
+if USE_SFX_SPOOL:
+    STORAGES["default"]["BACKEND"] = "main.storage.SpoolingS3Storage"
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -257,6 +283,123 @@ TWITCH_WEBHOOK_CALLBACK = os.environ.get("TWITCH_WEBHOOK_CALLBACK", "")
 ELEVENLABS_API_KEY = os.environ.get("ELEVENLABS_API_KEY", "")
 ELEVENLABS_SFX_ENDPOINT = os.environ.get("ELEVENLABS_SFX_ENDPOINT", "")
 
+#SFX GENERATION QUEUE SETTINGS
+#seconds a claimed job stays invisible to other workers after its last heartbeat before it is considered crashed
+SFX_JOB_VISIBILITY_TIMEOUT = int(os.environ.get("SFX_JOB_VISIBILITY_TIMEOUT", "120"))
+#workers extend the leases of the jobs they are still running this often, well under the timeout
+SFX_JOB_HEARTBEAT_INTERVAL = float(os.environ.get("SFX_JOB_HEARTBEAT_INTERVAL", "30"))
+SFX_JOB_MAX_ATTEMPTS = int(os.environ.get("SFX_JOB_MAX_ATTEMPTS", "3"))
+#failed attempts are retried with exponential backoff until this long after the cheer was queued
+SFX_JOB_RETRY_DEADLINE = int(os.environ.get("SFX_JOB_RETRY_DEADLINE", "600"))
+SFX_RETRY_BASE_DELAY = float(os.environ.get("SFX_RETRY_BASE_DELAY", "2"))
+SFX_RETRY_MAX_DELAY = float(os.environ.get("SFX_RETRY_MAX_DELAY", "60"))
+SFX_WORKER_POLL_INTERVAL = float(os.environ.get("SFX_WORKER_POLL_INTERVAL", "1.0"))
+#cheers are not played on the overlay later than this after Twitch sent them, see main/deadlines.py
+SFX_CHEER_DEADLINE_SECONDS = int(os.environ.get("SFX_CHEER_DEADLINE_SECONDS", "120"))
+
+#GENERATION SCHEDULING SETTINGS (see main/scheduling.py)
+#head start in seconds a job gets each time the cheered bits double above the base amount
+SFX_PRIORITY_BASE_BITS = int(os.environ.get("SFX_PRIORITY_BASE_BITS", "100"))
+SFX_PRIORITY_SECONDS_PER_BITS_DOUBLING = float(os.environ.get("SFX_PRIORITY_SECONDS_PER_BITS_DOUBLING", "5"))
+SFX_PRIORITY_MAX_SECONDS = float(os.environ.get("SFX_PRIORITY_MAX_SECONDS", "60"))
+SFX_PLAN_PRIORITY_SECONDS = {
+    SubscriptionPlanOptions.PAID_PLAN: float(os.environ.get("SFX_PAID_PLAN_PRIORITY_SECONDS", "10")),
+}
+#relative share of the workers per broadcaster when several channels have queued work
+SFX_PLAN_WEIGHTS = {
+    SubscriptionPlanOptions.PAID_PLAN: float(os.environ.get("SFX_PAID_PLAN_WEIGHT", "2")),
+}
+
+#ASYNC GENERATION ENGINE SETTINGS (manage.py run_sfx_workers)
+SFX_ENGINE_MAX_IN_FLIGHT = int(os.environ.get("SFX_ENGINE_MAX_IN_FLIGHT", "200"))
+#keeps one channel in a hype train from taking every slot of a worker
+SFX_ENGINE_MAX_PER_BROADCASTER = int(os.environ.get("SFX_ENGINE_MAX_PER_BROADCASTER", "20"))
+#threads for the blocking db and storage work around each ElevenLabs call
+SFX_ENGINE_DB_THREADS = int(os.environ.get("SFX_ENGINE_DB_THREADS", "16"))
+#request rate allowed by our ElevenLabs plan, per worker process
+ELEVENLABS_REQUESTS_PER_SECOND = float(os.environ.get("ELEVENLABS_REQUESTS_PER_SECOND", "5"))
+ELEVENLABS_REQUESTS_BURST = int(os.environ.get("ELEVENLABS_REQUESTS_BURST", "10"))
+#starting AIMD window of concurrent elevenlabs calls, it adapts to 429/503 answers from there
+ELEVENLABS_INITIAL_CONCURRENCY = int(os.environ.get("ELEVENLABS_INITIAL_CONCURRENCY", "20"))
+#delay before retrying a rate limited cheer when elevenlabs sends no Retry-After
+ELEVENLABS_DEFAULT_RETRY_AFTER = float(os.environ.get("ELEVENLABS_DEFAULT_RETRY_AFTER", "5"))
+#identical prompts in flight are generated once, the others wait up to the lease ttl for its audio
+SFX_SINGLEFLIGHT_LEASE_TTL = int(os.environ.get("SFX_SINGLEFLIGHT_LEASE_TTL", "90"))
+SFX_SINGLEFLIGHT_POLL_INTERVAL = float(os.environ.get("SFX_SINGLEFLIGHT_POLL_INTERVAL", "0.25"))
+#audio is streamed from elevenlabs to storage, at most this many bytes per job wait in memory
+SFX_STREAM_CHUNK_SIZE = int(os.environ.get("SFX_STREAM_CHUNK_SIZE", str(64 * 1024)))
+SFX_STREAM_BUFFER_BYTES = int(os.environ.get("SFX_STREAM_BUFFER_BYTES", str(256 * 1024)))
+
+#OVERLAY FAST PATH SETTINGS (see main/fastclips.py)
+#generated clips are played from a short lived copy while the upload to storage finishes
+SFX_FAST_PATH = os.environ.get("SFX_FAST_PATH", "TRUE") == "TRUE"
+SFX_FAST_PATH_TTL = int(os.environ.get("SFX_FAST_PATH_TTL", "120"))
+#bigger clips only go through storage, this is also the most a job buffers for the fast path
+SFX_FAST_PATH_MAX_BYTES = int(os.environ.get("SFX_FAST_PATH_MAX_BYTES", str(1024 * 1024)))
+#used when redis is not configured, the web and worker processes have to share it
+SFX_FAST_PATH_DIR = os.environ.get("SFX_FAST_PATH_DIR", str(BASE_DIR.parent / "dev-cdn" / "fast-clips"))
+
+#OVERLAY PLAYBACK QUEUE SETTINGS (see main/playback.py)
+#each overlay plays clips one after the other, this many are sent ahead of the one playing to be preloaded
+OVERLAY_SEND_AHEAD = int(os.environ.get("OVERLAY_SEND_AHEAD", "2"))
+OVERLAY_QUEUE_MAX_LENGTH = int(os.environ.get("OVERLAY_QUEUE_MAX_LENGTH", "20"))
+#clips that waited this many seconds behind others are dropped, they are still on the dashboard
+OVERLAY_QUEUE_MAX_WAIT = int(os.environ.get("OVERLAY_QUEUE_MAX_WAIT", "300"))
+#seconds to wait for the overlay to ack a clip started, then finished, before sending the next one
+OVERLAY_ACK_START_TIMEOUT = float(os.environ.get("OVERLAY_ACK_START_TIMEOUT", "10"))
+OVERLAY_ACK_FINISH_TIMEOUT = float(os.environ.get("OVERLAY_ACK_FINISH_TIMEOUT", "60"))
+
+#OVERLAY REPLAY SETTINGS (see main/replay.py)
+#recent overlay events kept per broadcaster for overlays that reconnect, in redis when configured
+OVERLAY_REPLAY_SIZE = int(os.environ.get("OVERLAY_REPLAY_SIZE", "50"))
+#older events are not replayed, and the log of a quiet broadcaster expires after this many seconds
+OVERLAY_REPLAY_MAX_AGE = int(os.environ.get("OVERLAY_REPLAY_MAX_AGE", "120"))
+#broadcasters kept in memory when redis is not configured
+OVERLAY_REPLAY_MAX_CHANNELS = int(os.environ.get("OVERLAY_REPLAY_MAX_CHANNELS", "10000"))
+
+#OVERLAY PRESENCE SETTINGS (see main/presence.py)
+#connected overlays refresh their presence this often, a process that died is forgotten after the ttl
+OVERLAY_HEARTBEAT_INTERVAL = float(os.environ.get("OVERLAY_HEARTBEAT_INTERVAL", "30"))
+OVERLAY_PRESENCE_TTL = int(os.environ.get("OVERLAY_PRESENCE_TTL", "90"))
+#jobs of broadcasters waiting for their overlay are checked again this often
+OVERLAY_OFFLINE_RETRY_SECONDS = float(os.environ.get("OVERLAY_OFFLINE_RETRY_SECONDS", "15"))
+
+#GENERATED AUDIO CACHE SETTINGS (enforced by manage.py evict_audio_cache)
+SFX_AUDIO_CACHE_MAX_ENTRIES = int(os.environ.get("SFX_AUDIO_CACHE_MAX_ENTRIES", "50000"))
+SFX_AUDIO_CACHE_MAX_BYTES = int(os.environ.get("SFX_AUDIO_CACHE_MAX_BYTES", str(5 * 1024 ** 3)))
+
+#SFX STORAGE RETENTION SETTINGS (enforced by manage.py gc_sfx_storage, see main/retention.py)
+#days the sound effects of broadcasters on these billing plans keep their file, other plans keep them
+SFX_RETENTION_DAYS_BY_PLAN = {
+    SubscriptionPlanOptions.FREE_PLAN: int(os.environ.get("SFX_FREE_RETENTION_DAYS", "30")),
+    SubscriptionPlanOptions.CANCELED_PLAN: int(os.environ.get("SFX_CANCELED_RETENTION_DAYS", "30")),
+}
+#files nothing referenced or replayed for this many days move under SFX_ARCHIVE_PREFIX, 0 to never archive
+SFX_ARCHIVE_AFTER_DAYS = int(os.environ.get("SFX_ARCHIVE_AFTER_DAYS", "90"))
+SFX_ARCHIVE_PREFIX = os.environ.get("SFX_ARCHIVE_PREFIX", "sfx_files/archive/")
+#storage class of archived objects on S3 (e.g. STANDARD_IA), empty where the provider has none,
+#a lifecycle rule on the archive prefix does the same job there
+SFX_ARCHIVE_STORAGE_CLASS = os.environ.get("SFX_ARCHIVE_STORAGE_CLASS", "")
+#unreferenced files and abandoned uploads are deleted once they are this old
+SFX_STORAGE_GC_GRACE_SECONDS = int(os.environ.get("SFX_STORAGE_GC_GRACE_SECONDS", "3600"))
+SFX_STORAGE_GC_BATCH_SIZE = int(os.environ.get("SFX_STORAGE_GC_BATCH_SIZE", "500"))
+
+#NEAR DUPLICATE PROMPT MATCHING (MinHash/LSH, opt-in per broadcaster)
+#estimated Jaccard similarity between prompt shingles needed to reuse a clip
+SFX_SIMILARITY_THRESHOLD = float(os.environ.get("SFX_SIMILARITY_THRESHOLD", "0.8"))
+#more bands find more candidates (better recall) at the cost of more comparisons
+SFX_SIMILARITY_BANDS = int(os.environ.get("SFX_SIMILARITY_BANDS", "16"))
+#bands that must collide before a candidate is compared, see manage.py bench_prompt_similarity
+SFX_SIMILARITY_MIN_BAND_HITS = int(os.environ.get("SFX_SIMILARITY_MIN_BAND_HITS", "2"))
+SFX_SIMILARITY_REFRESH_INTERVAL = int(os.environ.get("SFX_SIMILARITY_REFRESH_INTERVAL", "60"))
+
+#CHEER INGEST BUFFER SETTINGS
+#webhook events are acked right away and written to the db in micro-batches
+CHEER_INGEST_BATCH_SIZE = int(os.environ.get("CHEER_INGEST_BATCH_SIZE", "100"))
+CHEER_INGEST_FLUSH_INTERVAL = float(os.environ.get("CHEER_INGEST_FLUSH_INTERVAL", "0.05"))
+#once this many events are waiting, new ones are refused so Twitch retries them later
+CHEER_INGEST_MAX_PENDING = int(os.environ.get("CHEER_INGEST_MAX_PENDING", "5000"))
+
 #LEMON API SETTINGS
 LEMON_API_KEY = os.environ.get("LEMON_API_KEY", "")
 LEMON_WEBHOOK_SECRET = os.environ.get("LEMON_WEBHOOK_SECRET", "")
@@ -264,14 +407,17 @@ LEMON_WEBHOOK_CALLBACK = os.environ.get("LEMON_WEBHOOK_CALLBACK", "")
 LEMON_CUSTOMER_PORTAL_URL = os.environ.get("LEMON_CUSTOMER_PORTAL_URL", "")
 
 #DJANGO CHANNELS GROUP SETTINGS 
+#clips are generated by manage.py run_sfx_workers and reach the overlays through the channel layer,
+#the in-memory layer can't cross processes so overlays only get them with USE_REDIS=TRUE
 USE_REDIS = os.environ.get("USE_REDIS", "FALSE") == "TRUE"
+REDIS_URL = os.environ["REDIS_URL"] if USE_REDIS else None
 
 if USE_REDIS:
     CHANNEL_LAYERS = {
         "default": {
             "BACKEND": "channels_redis.core.RedisChannelLayer",
             "CONFIG": {
-                "hosts": [os.environ["REDIS_URL"]]
+                "hosts": [REDIS_URL]
             }
         }
     }
@@ -283,6 +429,18 @@ else:
         }
     }
 
+#BROADCASTER ROUTING CACHE SETTINGS
+#how long another process may keep serving a route after it changed here
+BROADCASTER_ROUTE_CACHE_TTL = int(os.environ.get("BROADCASTER_ROUTE_CACHE_TTL", "60"))
+BROADCASTER_ROUTE_CACHE_SIZE = int(os.environ.get("BROADCASTER_ROUTE_CACHE_SIZE", "10000"))
+
+#TWITCH WEBHOOK DEDUP SETTINGS
+#twitch messages older than this are rejected, so the dedup window never needs to be longer
+TWITCH_MESSAGE_MAX_AGE = int(os.environ.get("TWITCH_MESSAGE_MAX_AGE", "600"))
+TWITCH_DEDUP_CACHE_SIZE = int(os.environ.get("TWITCH_DEDUP_CACHE_SIZE", "50000"))
+#shares seen message ids between processes when redis is available
+TWITCH_DEDUP_USE_REDIS = USE_REDIS and os.environ.get("TWITCH_DEDUP_USE_REDIS", "TRUE") == "TRUE"
+
 
 
 LOGGING = {
@@ -309,4 +467,43 @@ LOGGING = {
         }
     }
     
-}
\ No newline at end of file
+}
+#PROCESS METRICS SETTINGS (see twitch_bot/metrics.py)
+#manage.py run_sfx_workers publishes its metrics this often for /internal/metrics/, which
+#forgets a worker that stopped publishing after the ttl
+METRICS_PUBLISH_INTERVAL = float(os.environ.get("METRICS_PUBLISH_INTERVAL", "15"))
+METRICS_PUBLISH_TTL = int(os.environ.get("METRICS_PUBLISH_TTL", "60"))
+#used when redis is not configured, the web and worker processes have to share it
+METRICS_DIR = os.environ.get("METRICS_DIR", str(BASE_DIR.parent / "dev-cdn" / "metrics"))
+
+#OUTBOUND HTTP SETTINGS
+#one pooled keep-alive client per upstream service, see twitch_bot/outbound.py
+OUTBOUND_HTTP_CONNECT_TIMEOUT = float(os.environ.get("OUTBOUND_HTTP_CONNECT_TIMEOUT", "3.05"))
+OUTBOUND_HTTP_FAILURE_THRESHOLD = int(os.environ.get("OUTBOUND_HTTP_FAILURE_THRESHOLD", "5"))
+OUTBOUND_HTTP_RESET_TIMEOUT = int(os.environ.get("OUTBOUND_HTTP_RESET_TIMEOUT", "30"))
+
+OUTBOUND_HTTP = {
+    "twitch": {
+        "pool_maxsize": 10,
+        "connect_timeout": OUTBOUND_HTTP_CONNECT_TIMEOUT,
+        "read_timeout": 10,
+        "failure_threshold": OUTBOUND_HTTP_FAILURE_THRESHOLD,
+        "reset_timeout": OUTBOUND_HTTP_RESET_TIMEOUT,
+    },
+    "elevenlabs": {
+        #used by blocking callers, the generation engine has its own async pool
+        "pool_maxsize": int(os.environ.get("ELEVENLABS_POOL_SIZE", "20")),
+        "connect_timeout": OUTBOUND_HTTP_CONNECT_TIMEOUT,
+        #generation takes several seconds
+        "read_timeout": float(os.environ.get("ELEVENLABS_READ_TIMEOUT", "60")),
+        "failure_threshold": OUTBOUND_HTTP_FAILURE_THRESHOLD,
+        "reset_timeout": OUTBOUND_HTTP_RESET_TIMEOUT,
+    },
+    "lemon": {
+        "pool_maxsize": 10,
+        "connect_timeout": OUTBOUND_HTTP_CONNECT_TIMEOUT,
+        "read_timeout": 10,
+        "failure_threshold": OUTBOUND_HTTP_FAILURE_THRESHOLD,
+        "reset_timeout": OUTBOUND_HTTP_RESET_TIMEOUT,
+    },
+}
@@ -2,16 +2,18 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from main import views
-from .views import login_template, home, privacy_policy, terms_of_service, refund_policy
+from .views import login_template, home, privacy_policy, terms_of_service, refund_policy, internal_metrics
 from billing import views as billing_views
 urlpatterns = [
     path("", home, name="home"),
     path("admin/", admin.site.urls),
+    path("internal/metrics/", internal_metrics, name="internal-metrics"),
     path('accounts/', include("allauth.urls")),
     path("login/", login_template, name="login"),
     path("hooks/twitch/events/", views.twitch_eventsub_callback, name="twitch-hook"),
     path("hooks/lemon/events/", billing_views.lemon_webhook, name="lemon-webhook"),
     path("overlay/<str:user_id>/", views.broadcaster_overlay, name="overlay"),
+    path("overlay/clips/<uuid:token>/", views.overlay_fast_clip, name="overlay-clip"),
     path("dashboard/", include(("main.urls", "main"), namespace="dashboard")),
     path("legal/refunds-policy/", refund_policy, name="refunds-policy"),
     path("legal/privacy-policy/", privacy_policy, name="privacy-policy"),
@@ -23,4 +25,7 @@ if settings.DEBUG:
     from django.conf.urls.static import static
 
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+
+if settings.USE_SFX_SPOOL:
+    urlpatterns.append(path("spool/<path:name>", views.spooled_media, name="spooled-media"))
\ No newline at end of file
@@ -1,4 +1,8 @@
 from django.shortcuts import render, redirect
+from django.http import JsonResponse
+from django.contrib.admin.views.decorators import staff_member_required
+
+from .metrics import metrics, metrics_exporter
 
 
 def home(request):
@@ -16,4 +20,11 @@ def privacy_policy(request):
     return render(request, "legal/privacy.html")
 
 def terms_of_service(request):
-    return render(request, "legal/tos.html")
\ No newline at end of file
+    return render(request, "legal/tos.html")
+
+@staff_member_required
+def internal_metrics(request):
+    snapshot = metrics.snapshot()
+    # the workers', recorded in their own process
+    snapshot["processes"] = metrics_exporter.collect()
+    return JsonResponse(snapshot)
\ No newline at end of file